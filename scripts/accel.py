@@ -0,0 +1,38 @@
+#
+# Copyright 2020 Linaro
+#
+# Selection of the QEMU accelerator.
+#
+# KVM is used when /dev/kvm is usable and the guest has the same
+# architecture as the host.  Otherwise TCG is configured for
+# throughput: one host thread per vCPU and a translation block
+# cache sized to the guest.
+# cpu: max needs no change, under KVM it is the host cpu.
+#
+
+import os
+import platform
+
+# Names used by platform.machine() for the guest architectures.
+host_arch_names = {'aarch64': ["aarch64", "arm64"],
+                   'x86_64': ["x86_64", "amd64"]}
+
+def kvm_usable(guest_arch):
+    host_arch = platform.machine().lower()
+    if host_arch not in host_arch_names.get(guest_arch, [guest_arch]):
+        return False
+    return os.access("/dev/kvm", os.R_OK | os.W_OK)
+
+def get_tb_size(vcpus):
+    """Translation block cache size in MB.  Each vCPU thread translates
+       code of its own, so scale with the vCPUs, within QEMU's limits."""
+    return min(2048, max(256, 64 * vcpus))
+
+def select_accel(accel, guest_arch, vcpus):
+    """Resolve accel (auto, kvm or tcg) to the accelerator name and
+       the qemu arguments for it."""
+    if accel == "auto":
+        accel = "kvm" if kvm_usable(guest_arch) else "tcg"
+    if accel == "kvm":
+        return accel, "-accel kvm"
+    return accel, "-accel tcg,thread=multi,tb-size={}".format(get_tb_size(vcpus))
@@ -13,6 +13,132 @@ from subprocess import Popen,PIPE
 import argparse
 import yaml
 import time
+import shlex
+import selectors
+import collections
+import contextlib
+import atexit
+import cmd_trace
+
+class Command:
+    """A command started by BaseCmd.start_command.
+
+       Output is read without blocking, streamed to an optional log file
+       and only the last tail_lines lines are kept in memory.
+       Commands which are not captured are run through the shell and
+       write straight to our stdout."""
+    tail_lines = 1000
+    kill_grace_time = 5
+
+    def __init__(self, command, timeout=None, log_path=None, line_fn=None, capture=True):
+        self.command = command
+        self.timeout = timeout
+        self.log_path = log_path
+        self.line_fn = line_fn
+        self.capture = capture
+        self.rc = None
+        self.timed_out = False
+        self.process = None
+        self.rusage = None
+        self.start_time = None
+        self.end_time = None
+        self.lane = None
+        self._lines = collections.deque(maxlen=self.tail_lines)
+        self._partial = b""
+        self._log = None
+        self._deadline = None
+
+    def start(self):
+        self.start_time = time.time()
+        if not self.capture:
+            self.process = subprocess.Popen(self.command, shell=True)
+        else:
+            if self.log_path:
+                self._log = open(self.log_path, 'ab')
+            self.process = subprocess.Popen(shlex.split(self.command), stdout=subprocess.PIPE)
+            os.set_blocking(self.process.stdout.fileno(), False)
+        if self.timeout:
+            self._deadline = self.start_time + self.timeout
+
+    def fileno(self):
+        return self.process.stdout.fileno()
+
+    def done(self):
+        return self.rc != None
+
+    def output_lines(self):
+        return list(self._lines)
+
+    def _add_line(self, line):
+        line = str(line, 'utf-8', errors='replace')
+        self._lines.append(line)
+        if self.line_fn:
+            self.line_fn(line)
+
+    def read_output(self):
+        """Read what is available, returns False once the output is closed."""
+        try:
+            data = os.read(self.fileno(), 65536)
+        except BlockingIOError:
+            return True
+        if self._log:
+            self._log.write(data)
+        if not data:
+            if self._partial:
+                self._add_line(self._partial)
+                self._partial = b""
+            return False
+        lines = (self._partial + data).split(b"\n")
+        self._partial = lines.pop()
+        for line in lines:
+            self._add_line(line + b"\n")
+        return True
+
+    def expired(self):
+        return self._deadline != None and time.time() > self._deadline
+
+    def cancel(self):
+        if self.process == None or self.process.returncode != None:
+            return
+        self.process.terminate()
+        deadline = time.time() + self.kill_grace_time
+        while not self.reap(os.WNOHANG) and time.time() < deadline:
+            time.sleep(0.1)
+        if self.process.returncode == None:
+            self.process.kill()
+
+    def reap(self, options=0):
+        """Collect the exit status and resource usage of the process.
+           Returns True once the process has exited."""
+        if self.process.returncode != None:
+            return True
+        try:
+            pid, status, rusage = os.wait4(self.process.pid, options)
+        except ChildProcessError:
+            self.process.wait()
+            return True
+        if pid == 0:
+            return False
+        self.rusage = rusage
+        self.process.returncode = self.decode_status(status)
+        return True
+
+    @staticmethod
+    def decode_status(status):
+        # Like subprocess, a process killed by a signal returns -signal.
+        if os.WIFSIGNALED(status):
+            return -os.WTERMSIG(status)
+        return os.WEXITSTATUS(status)
+
+    def finish(self):
+        self.reap()
+        self.rc = self.process.returncode
+        self.end_time = time.time()
+        if self.process.stdout:
+            self.process.stdout.close()
+        if self._log:
+            self._log.close()
+            self._log = None
 
 class BaseCmd:
     
@@ -21,6 +147,8 @@ class BaseCmd:
         self.kernel_ver_minor = None
         self._debug = False
         self._dry_run = False
+        self._log_path = None
+        self._trace = None
 
     def set_debug(self, debug):
         self._debug = debug
@@ -28,6 +156,23 @@ class BaseCmd:
     def set_dry_run(self, dry_run):
         self._dry_run = dry_run
 
+    def set_log_path(self, log_path):
+        """Output of all captured commands is appended to log_path."""
+        self._log_path = log_path
+
+    def set_trace_path(self, trace_path):
+        """Record timing of all commands and phases, written to trace_path at exit."""
+        if not trace_path or self._trace:
+            return
+        self._trace = cmd_trace.CmdTrace(os.path.abspath(trace_path))
+        atexit.register(self._trace.write)
+
+    def phase(self, name):
+        """Context manager grouping the commands issued inside it in the trace."""
+        if self._trace == None:
+            return contextlib.suppress()
+        return self._trace.phase(name)
+
     def print(self, trace, debug=False):
         if not debug or self._debug:
             print("{}: {}".format(sys.argv[0], trace))
@@ -37,35 +182,104 @@ class BaseCmd:
             exit(err)
             
     def issue_cmd(self, cmd, show_cmd=False, fail_on_err=True, 
-                  err_msg=None, enable_stdout=True, no_capture=False):
-        rc, output = self.run_command(cmd, show_cmd, enable_stdout=enable_stdout, no_capture=no_capture)
+                  err_msg=None, enable_stdout=True, no_capture=False, timeout=None):
+        rc, output = self.run_command(cmd, show_cmd, enable_stdout=enable_stdout,
+                                      no_capture=no_capture, timeout=timeout)
+        self.check_rc(cmd, rc, fail_on_err, err_msg)
+        return rc, output
+
+    def issue_cmds(self, cmds, show_cmd=False, fail_on_err=True,
+                   err_msg=None, enable_stdout=True, timeout=None):
+        """Run several commands concurrently.
+           Returns a list of (rc, output) in the order of cmds."""
+        commands = [self.start_command(cmd, show_cmd, enable_stdout=enable_stdout,
+                                       timeout=timeout) for cmd in cmds]
+        self.wait_commands(commands)
+        for command in commands:
+            self.check_rc(command.command, command.rc, fail_on_err, err_msg)
+        return [(command.rc, command.output_lines()) for command in commands]
+
+    def check_rc(self, cmd, rc, fail_on_err, err_msg):
         if fail_on_err and rc != 0:
             self.print("cmd failed with status: {} cmd: {}".format(rc, cmd))
             if (err_msg):
                 self.print(err_msg)
             self.terminate(1)
-        return rc, output
-    
-    def run_command(self, command, show_cmd=False, enable_stdout=True, no_capture=False):
-        output_lines = []
+
+    def start_command(self, command, show_cmd=False, enable_stdout=True,
+                      timeout=None, log_path=None, capture=True, line_fn=None):
+        """Start a command without waiting for it, see wait_commands().
+           line_fn is called with each line of output."""
         if show_cmd or self._debug:
             print("{}: {} ".format(sys.argv[0], command))
+        def handle_line(line):
+            if enable_stdout:
+                self.print(line.strip())
+            if line_fn:
+                line_fn(line)
+        cmd = Command(command, timeout=timeout, log_path=log_path or self._log_path,
+                      line_fn=handle_line, capture=capture)
         if self._dry_run:
             print("")
-            return 0, output_lines
-        if no_capture:
-            rc = subprocess.call(command, shell=True)
-            return rc, output_lines
-        process = subprocess.Popen(command.split(), stdout=subprocess.PIPE) #shlex.split(command)
-        while True:
-            output = process.stdout.readline()
-            if (not output or output == '') and process.poll() is not None:
-                break
-            if output and enable_stdout:
-                self.print(str(output, 'utf-8').strip())
-            output_lines.append(str(output, 'utf-8'))
-        rc = process.poll()
-        return rc, output_lines
+            cmd.rc = 0
+            return cmd
+        cmd.start()
+        if self._trace:
+            cmd.lane = self._trace.acquire_lane()
+        return cmd
+
+    def finish_command(self, cmd):
+        cmd.finish()
+        if self._trace:
+            self._trace.add_command(cmd, cmd.lane)
+            self._trace.release_lane(cmd.lane)
+
+    def wait_commands(self, commands, until=None, poll=None):
+        """Stream output of the commands until all of them exit,
+           or until() returns True, which leaves them running.
+           poll() is called on each pass, for example to follow a log.
+           Commands past their timeout are terminated.
+           On an interrupt, all the commands are cancelled."""
+        selector = selectors.DefaultSelector()
+        running = [cmd for cmd in commands if not cmd.done()]
+        for cmd in running:
+            if cmd.capture:
+                selector.register(cmd, selectors.EVENT_READ)
+        try:
+            while running:
+                if poll:
+                    poll()
+                if until and until():
+                    return
+                for key, mask in selector.select(timeout=0.1):
+                    cmd = key.fileobj
+                    if not cmd.read_output():
+                        selector.unregister(cmd)
+                        self.finish_command(cmd)
+                        running.remove(cmd)
+                for cmd in [c for c in running if not c.capture]:
+                    if cmd.reap(os.WNOHANG):
+                        self.finish_command(cmd)
+                        running.remove(cmd)
+                for cmd in running:
+                    if cmd.expired() and not cmd.timed_out:
+                        self.print("cmd timed out after {}s: {}".format(cmd.timeout,
+                                                                       cmd.command))
+                        cmd.timed_out = True
+                        cmd.cancel()
+        except BaseException:
+            for cmd in running:
+                cmd.cancel()
+            raise
+        finally:
+            selector.close()
+
+    def run_command(self, command, show_cmd=False, enable_stdout=True, no_capture=False,
+                    timeout=None):
+        cmd = self.start_command(command, show_cmd, enable_stdout=enable_stdout,
+                                 timeout=timeout, capture=not no_capture)
+        self.wait_commands([cmd])
+        return cmd.rc, cmd.output_lines()
 
     def get_kernel_img_version(self, image):
         if self.kernel_ver:
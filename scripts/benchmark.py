@@ -0,0 +1,382 @@
+#
+# Copyright 2020 Linaro
+#
+# End to end benchmark of the build, install and boot workflow.
+#
+# benchmark.py --stages [stages] --repeat [N] --kernel_pkg [.deb] -- [launch_image.py args]
+#
+#    Runs each stage N times through build_image.py, install_kernel.py
+#    and launch_image.py, and records the wall time, cpu time and the
+#    time of each phase of their timing traces.  The results are written
+#    to build/benchmark/results-[date-time].yml and compared against a
+#    stored baseline.  Metrics slower than the baseline by more than
+#    --threshold percent, and by more than the noise of the samples,
+#    are flagged as regressions and make the exit status non zero.
+#
+#    Stages:
+#       qemu_build      build QEMU, as far as the build stamp requires.
+#       image_build     build a new image.
+#       convert         convert the image to raw and back to qcow2.
+#       install_chroot  install kernel packages in a chroot.
+#       install_vm      install kernel packages in a VM.
+#       boot_cold       boot the image on an overlay until ssh is ready.
+#       boot_warm       restore the VM snapshot until ssh is ready.
+#
+#    With --dry_run the scripts are run with --dry_run, so only the
+#    Python overhead of the workflow is measured.
+#
+
+import sys
+import os
+import argparse
+from argparse import RawTextHelpFormatter
+import glob
+import json
+import shutil
+import statistics
+import time
+import yaml
+import base_cmd
+import rtapp_calib
+
+class Benchmark(base_cmd.BaseCmd):
+    build_path_rel = "build"
+    qemu_build_path_rel = "external/qemu/build"
+    qemu_stamp_name = "lisa-qemu-stamp.yml"
+    stages = ["qemu_build", "image_build", "convert", "install_chroot", "install_vm",
+              "boot_cold", "boot_warm"]
+    # Stages only made of commands, without Python to measure.
+    command_stages = ["convert"]
+    install_stages = ["install_chroot", "install_vm"]
+
+    def __init__(self):
+        super(Benchmark, self).__init__()
+        self.script_path = os.path.dirname(os.path.realpath(__file__))
+        self.root_path = os.path.realpath(os.path.join(self.script_path, "../"))
+        self.build_path = os.path.join(self.root_path, self.build_path_rel)
+        self.qemu_build_path = os.path.join(self.root_path, self.qemu_build_path_rel)
+        self.parse_args()
+        self.set_debug(self._args.debug)
+        self.continue_on_error = True
+        self.output_path = os.path.realpath(self._args.output_dir)
+        self.work_path = os.path.join(self.output_path, "work")
+        self.baseline_path = os.path.realpath(self._args.baseline or
+                                              os.path.join(self.output_path, "baseline.yml"))
+        self.image_name = "{}.img".format(self._args.image_type)
+        self.samples = {}
+
+    def parse_args(self):
+        parser = argparse.ArgumentParser(formatter_class=RawTextHelpFormatter,
+                                         description="Benchmark the build, install and boot "\
+                                         "workflow end to end.",
+                                         epilog="examples:\n"\
+                                         "    {0} --repeat 5 --save_baseline\n"\
+                                         "    {0} --stages boot_cold boot_warm -- --accel kvm\n"\
+                                         "    {0} --dry_run --repeat 10\n".format(sys.argv[0]))
+        parser.add_argument("--debug", action="store_true",
+                            help="enable debug output")
+        parser.add_argument("--dry_run", action="store_true",
+                            help="Run the scripts with --dry_run, to measure their\n"\
+                            "Python overhead alone.  convert and the install stages,\n"\
+                            "which need real images and packages, are skipped.")
+        parser.add_argument("--stages", nargs="+", default=self.stages, choices=self.stages,
+                            help="Stages to run.\n"\
+                            "default is all of them")
+        parser.add_argument("--repeat", type=int, default=3,
+                            help="Number of samples of each stage.\n"\
+                            "default is 3")
+        parser.add_argument("--image_type", default="ubuntu.aarch64",
+                            help="Image type to build and boot.\n"\
+                            "default is ubuntu.aarch64")
+        parser.add_argument("--config", default="",
+                            help="Config file to build and launch with.\n"\
+                            "default is that of build_image.py and launch_image.py")
+        parser.add_argument("--image", default="",
+                            help="Image to convert, install kernels into and boot.\n"\
+                            "default is build/VM-[image_type]/[image_type].img, or the\n"\
+                            "image built by the image_build stage if there is none.")
+        parser.add_argument("--kernel_pkg", nargs="+", default=[],
+                            help="Kernel packages for the install stages.\n"\
+                            "The install stages are skipped without them.")
+        parser.add_argument("--qemu_rebuild", action="store_true",
+                            help="Remove the QEMU build stamp before each qemu_build\n"\
+                            "sample, so that configure and make run every time.")
+        parser.add_argument("--output_dir", default=os.path.join(self.build_path, "benchmark"),
+                            help="Directory for the results, logs and traces.\n"\
+                            "default is build/benchmark")
+        parser.add_argument("--baseline", default="",
+                            help="Results to compare against.\n"\
+                            "default is baseline.yml in --output_dir")
+        parser.add_argument("--save_baseline", action="store_true",
+                            help="Store the results as the new baseline.")
+        parser.add_argument("--threshold", type=float, default=10,
+                            help="Percentage by which a metric must be slower than\n"\
+                            "the baseline to be a regression.\n"\
+                            "default is 10")
+        parser.add_argument("launch_args", nargs=argparse.REMAINDER,
+                            help="Arguments after -- are passed to build_image.py\n"\
+                            "and launch_image.py")
+        self._args = parser.parse_args()
+        if self._args.launch_args and self._args.launch_args[0] == "--":
+            self._args.launch_args = self._args.launch_args[1:]
+
+    def get_script_cmd(self, script, args):
+        if self._args.dry_run:
+            args = args + ["--dry_run"]
+        if self._args.debug:
+            args = args + ["--debug"]
+        return " ".join([sys.executable, os.path.join(self.script_path, script)] + args)
+
+    def get_build_args(self):
+        args = ["--image_type", self._args.image_type]
+        if self._args.config:
+            args += ["--config", os.path.realpath(self._args.config)]
+        return args
+
+    def get_base_image(self):
+        if self._args.image:
+            return os.path.realpath(self._args.image)
+        image_path = os.path.join(self.build_path, "VM-" + self._args.image_type,
+                                  self.image_name)
+        built_path = os.path.join(self.work_path, "image-build", self.image_name)
+        if not os.path.exists(image_path) and os.path.exists(built_path):
+            return built_path
+        return image_path
+
+    def run_sample(self, stage, index, cmd):
+        """Run one sample of a stage and record its wall and cpu time,
+           and the time of each phase of its trace."""
+        name = "{}-{}".format(stage, index)
+        log_path = os.path.join(self.output_path, "logs", name + ".log")
+        trace_path = os.path.join(self.output_path, "traces", name + ".trace.json")
+        if os.path.exists(log_path):
+            os.remove(log_path)
+        if os.path.exists(trace_path):
+            os.remove(trace_path)
+        cmd += " --trace {}".format(trace_path)
+        command = self.start_command(cmd, enable_stdout=False, log_path=log_path)
+        self.wait_commands([command])
+        if command.rc != 0:
+            raise Exception("{} failed with status {}, see {}".format(name, command.rc, log_path))
+        sample = {}
+        sample[stage] = command.end_time - command.start_time
+        sample[stage + "/cpu"] = command.rusage.ru_utime + command.rusage.ru_stime
+        if os.path.exists(trace_path):
+            with open(trace_path) as f:
+                phases = json.load(f)['metadata']['phases']
+            for phase, entry in phases.items():
+                sample["{}/{}".format(stage, phase)] = entry['wall_s']
+        self.print("{}: {:.2f}s".format(name, sample[stage]))
+        return sample
+
+    def add_sample(self, sample):
+        for metric, value in sample.items():
+            self.samples.setdefault(metric, []).append(round(value, 3))
+
+    def run_command_sample(self, cmd):
+        command = self.start_command(cmd, enable_stdout=False)
+        self.wait_commands([command])
+        self.check_rc(cmd, command.rc, True, None)
+        return command.end_time - command.start_time
+
+    def stage_qemu_build(self, index):
+        stamp_path = os.path.join(self.qemu_build_path, self.qemu_stamp_name)
+        if self._args.qemu_rebuild and os.path.exists(stamp_path) and not self._args.dry_run:
+            os.remove(stamp_path)
+        cmd = self.get_script_cmd("build_image.py", self.get_build_args() + ["--qemu_only"] +
+                                  self._args.launch_args)
+        return self.run_sample("qemu_build", index, cmd)
+
+    def stage_image_build(self, index):
+        image_dir = os.path.join(self.work_path, "image-build")
+        image_path = os.path.join(image_dir, self.image_name)
+        if os.path.exists(image_path):
+            os.remove(image_path)
+        cmd = self.get_script_cmd("build_image.py", self.get_build_args() +
+                                  ["--image_dir", image_dir] + self._args.launch_args)
+        return self.run_sample("image_build", index, cmd)
+
+    def stage_convert(self, index):
+        qemu_img = os.path.join(self.qemu_build_path, "qemu-img")
+        raw_path = os.path.join(self.work_path, "convert.raw")
+        qcow2_path = os.path.join(self.work_path, "convert.qcow2")
+        sample = {}
+        try:
+            sample['convert/raw'] = self.run_command_sample(
+                "{} convert -O raw {} {}".format(qemu_img, self.get_base_image(), raw_path))
+            sample['convert/qcow2'] = self.run_command_sample(
+                "{} convert -O qcow2 {} {}".format(qemu_img, raw_path, qcow2_path))
+        finally:
+            for path in [raw_path, qcow2_path]:
+                if os.path.exists(path):
+                    os.remove(path)
+        sample['convert'] = sample['convert/raw'] + sample['convert/qcow2']
+        self.print("convert-{}: {:.2f}s".format(index, sample['convert']))
+        return sample
+
+    def setup_install(self):
+        # Kernels are installed into a copy of the image, so that the
+        # images and configs next to the base image are left alone.
+        image_dir = os.path.join(self.work_path, "install")
+        if os.path.exists(image_dir):
+            shutil.rmtree(image_dir)
+        os.makedirs(image_dir)
+        base_image = self.get_base_image()
+        for name in ["conf.yml", "id_rsa", "id_rsa.pub"]:
+            path = os.path.join(os.path.dirname(base_image), name)
+            if os.path.exists(path):
+                shutil.copy2(path, image_dir)
+        image_path = os.path.join(image_dir, self.image_name)
+        self.issue_cmd("cp --reflink=auto {} {}".format(base_image, image_path))
+        return image_path
+
+    def stage_install(self, stage, index, image_path):
+        args = ["--image", image_path, "--kernel_pkg"] + \
+               [os.path.realpath(pkg) for pkg in self._args.kernel_pkg]
+        if self._args.config:
+            args += ["--config", os.path.realpath(self._args.config)]
+        if stage == "install_vm":
+            args.append("--vm")
+        cmd = self.get_script_cmd("install_kernel.py", args)
+        if os.geteuid() != 0:
+            cmd = "sudo -n " + cmd
+        try:
+            return self.run_sample(stage, index, cmd)
+        finally:
+            for path in glob.glob(image_path + ".kernel-*") + \
+                        glob.glob(os.path.join(os.path.dirname(image_path), "conf-kernel-*")):
+                os.remove(path)
+
+    def stage_boot(self, stage, index):
+        args = self.get_build_args() + \
+               ["--image_path", self.get_base_image(),
+                "--ssh_port", "auto", "--guest_cmd", "true", "--rtapp_calib", "off",
+                "--lisa_config", os.path.join(self.work_path, "boot_vm.yml")]
+        args.append("--snapshot" if stage == "boot_warm" else "--overlay")
+        cmd = self.get_script_cmd("launch_image.py", args + self._args.launch_args)
+        return self.run_sample(stage, index, cmd)
+
+    def run_stage(self, stage):
+        if self._args.dry_run and stage in self.command_stages + self.install_stages:
+            self.print("{}: skipped in a dry run".format(stage))
+            return
+        if stage in self.install_stages:
+            if not self._args.kernel_pkg:
+                self.print("{}: skipped, no --kernel_pkg given".format(stage))
+                return
+            image_path = self.setup_install()
+        if stage == "boot_warm":
+            # The first launch creates the snapshot which the others restore.
+            self.stage_boot(stage, "setup")
+        for index in range(self._args.repeat):
+            if stage in self.install_stages:
+                sample = self.stage_install(stage, index, image_path)
+            elif stage in ["boot_cold", "boot_warm"]:
+                sample = self.stage_boot(stage, index)
+            else:
+                sample = getattr(self, "stage_" + stage)(index)
+            self.add_sample(sample)
+
+    def get_revision(self, path):
+        if not os.path.exists(path):
+            return "unknown"
+        rc, output = self.issue_cmd("git -C {} describe --always --dirty".format(path),
+                                    fail_on_err=False, enable_stdout=False)
+        return output[-1].strip() if rc == 0 and output else "unknown"
+
+    def get_results(self):
+        metrics = {}
+        for metric, samples in sorted(self.samples.items()):
+            metrics[metric] = {'samples': samples,
+                               'mean': round(statistics.mean(samples), 3),
+                               'median': round(statistics.median(samples), 3),
+                               'stdev': round(statistics.stdev(samples), 3)
+                                        if len(samples) > 1 else 0,
+                               'min': min(samples),
+                               'max': max(samples)}
+        meta = {'date': time.strftime("%Y-%m-%d %H:%M:%S"),
+                'dry_run': self._args.dry_run,
+                'repeat': self._args.repeat,
+                'image_type': self._args.image_type,
+                'config': self._args.config,
+                'launch_args': self._args.launch_args,
+                'host_cpu': rtapp_calib.get_host_cpu(),
+                'host_cpus': os.cpu_count(),
+                'lisa_qemu_revision': self.get_revision(self.root_path),
+                'qemu_revision': self.get_revision(os.path.join(self.root_path, "external/qemu"))}
+        return {'meta': meta, 'metrics': metrics}
+
+    def compare(self, results, baseline):
+        """Compare the medians of the metrics in both results.
+           Returns the names of the metrics which regressed."""
+        for key in ['dry_run', 'host_cpu', 'launch_args']:
+            if baseline['meta'].get(key) != results['meta'][key]:
+                self.print("baseline {} differs: {} vs {}".format(key,
+                           baseline['meta'].get(key), results['meta'][key]))
+        regressions = []
+        print("{:<32} {:>10} {:>10} {:>8}".format("metric", "baseline", "median", "change"))
+        for metric, current in results['metrics'].items():
+            if metric not in baseline['metrics']:
+                continue
+            base = baseline['metrics'][metric]
+            delta = current['median'] - base['median']
+            change = delta / base['median'] * 100 if base['median'] else 0
+            # Differences within the spread of the samples are noise.
+            noise = 2 * max(base['stdev'], current['stdev'])
+            status = ""
+            if change > self._args.threshold and delta > noise:
+                status = "REGRESSION"
+                regressions.append(metric)
+            elif change < -self._args.threshold and -delta > noise:
+                status = "improved"
+            print("{:<32} {:>10.3f} {:>10.3f} {:>+7.1f}%  {}".format(metric, base['median'],
+                  current['median'], change, status))
+        return regressions
+
+    def write_results(self, path, results):
+        with open(path, 'w') as f:
+            yaml.dump(results, f, default_flow_style=False)
+
+    def run(self):
+        for path in [self.output_path, self.work_path,
+                     os.path.join(self.output_path, "logs"),
+                     os.path.join(self.output_path, "traces")]:
+            if not os.path.exists(path):
+                os.makedirs(path)
+        failed = []
+        for stage in self.stages:
+            if stage not in self._args.stages:
+                continue
+            try:
+                self.run_stage(stage)
+            except Exception as e:
+                self.print("{} failed: {}".format(stage, e))
+                failed.append(stage)
+        results = self.get_results()
+        results['meta']['failed_stages'] = failed
+        if os.path.exists(self.baseline_path):
+            with open(self.baseline_path) as f:
+                baseline = yaml.safe_load(f)
+            regressions = self.compare(results, baseline)
+            results['baseline'] = {'path': self.baseline_path, 'regressions': regressions}
+            if regressions:
+                self.print("{} regressions against {}".format(len(regressions),
+                                                              self.baseline_path))
+        else:
+            regressions = []
+            self.print("no baseline {}, use --save_baseline to store one".format(self.baseline_path))
+        results_path = os.path.join(self.output_path,
+                                    "results-{}.yml".format(time.strftime("%Y%m%d-%H%M%S")))
+        self.write_results(results_path, results)
+        self.print("results written to {}".format(results_path))
+        if self._args.save_baseline:
+            if failed:
+                self.print("stages failed, baseline not saved")
+            else:
+                self.write_results(self.baseline_path, results)
+                self.print("baseline saved to {}".format(self.baseline_path))
+        return 1 if failed or regressions else 0
+
+if __name__ == "__main__":
+    inst_obj = Benchmark()
+    exit(inst_obj.run())
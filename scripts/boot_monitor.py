@@ -0,0 +1,127 @@
+#
+# Copyright 2020 Linaro
+#
+# Detects when a launched VM is ready for ssh and records how long it took.
+#
+# The serial console log is followed to timestamp boot milestones such
+# as the kernel start and the login prompt, and optionally copied with
+# the time each line was seen.  Once the console shows sshd started or
+# the login prompt, the guest sshd is probed until it answers with its
+# banner through the forwarded port, which is the time it is ready.
+# The QEMU user network accepts connections on the host port before
+# the guest is listening, so a connection alone does not mean the guest
+# is ready, and QEMU has no event for it.  Without a console, or if it
+# never shows the markers, sshd is probed on a slower timer instead.
+#
+
+import os
+import socket
+import time
+
+class BootMonitor:
+    ssh_banner = b"SSH-"
+    probe_interval = 0.2
+    # Probes of a console which did not show sshd start yet.
+    fallback_interval = 2
+    console_markers = [("kernel", "Booting Linux"),
+                       ("init", "Run /sbin/init"),
+                       ("sshd", "OpenBSD Secure Shell server"),
+                       ("login", "login:")]
+    ready_markers = ["sshd", "login"]
+
+    def __init__(self, ssh_port, console_path=None, host="127.0.0.1", timestamps_path=None):
+        self.ssh_port = ssh_port
+        self.console_path = console_path
+        self.timestamps_path = timestamps_path
+        self.host = host
+        self.start_time = None
+        self.ready_time = None
+        self.milestones = {}
+        self.max_rss_kb = None
+        self._console = None
+        self._console_partial = ""
+        self._timestamps = None
+        self._last_probe = 0
+
+    def start(self):
+        self.start_time = time.time()
+
+    @property
+    def ready(self):
+        return self.ready_time != None
+
+    def probe_ssh(self):
+        try:
+            with socket.create_connection((self.host, self.ssh_port), timeout=0.5) as sock:
+                return sock.recv(len(self.ssh_banner)) == self.ssh_banner
+        except OSError:
+            return False
+
+    def read_console(self):
+        if self._console == None:
+            if not os.path.exists(self.console_path):
+                return
+            self._console = open(self.console_path, 'r', errors='replace')
+            if self.timestamps_path:
+                self._timestamps = open(self.timestamps_path, 'w')
+        data = self._console.read()
+        if not data:
+            return
+        now = time.time()
+        lines = (self._console_partial + data).split("\n")
+        self._console_partial = lines.pop()
+        for line in lines + [self._console_partial]:
+            for name, marker in self.console_markers:
+                if name not in self.milestones and marker in line:
+                    self.milestones[name] = round(now - self.start_time, 2)
+        if self._timestamps:
+            for line in lines:
+                self.write_timestamp(now, line)
+
+    def write_timestamp(self, now, line):
+        self._timestamps.write("[{:9.3f}] {}\n".format(now - self.start_time, line.rstrip("\r")))
+
+    def get_probe_interval(self):
+        if not self.console_path or \
+           any([name in self.milestones for name in self.ready_markers]):
+            return self.probe_interval
+        return self.fallback_interval
+
+    def poll(self):
+        """Check for progress, returns True once ssh is ready."""
+        if self.console_path:
+            self.read_console()
+        now = time.time()
+        if not self.ready and now - self._last_probe >= self.get_probe_interval():
+            self._last_probe = now
+            if self.probe_ssh():
+                self.ready_time = time.time()
+                self.milestones['ssh'] = round(self.ready_time - self.start_time, 2)
+        return self.ready
+
+    def set_rusage(self, rusage):
+        # The launcher waits for QEMU, so its peak RSS is included.
+        if rusage:
+            self.max_rss_kb = rusage.ru_maxrss
+
+    def close(self):
+        if self._console:
+            self.read_console()
+            self._console.close()
+            self._console = None
+        if self._timestamps:
+            if self._console_partial:
+                self.write_timestamp(time.time(), self._console_partial)
+            self._timestamps.close()
+            self._timestamps = None
+
+    def report(self):
+        report = {'ssh_port': self.ssh_port,
+                  'start_time': self.start_time,
+                  'ssh_ready_s': self.milestones.get('ssh'),
+                  'milestones': dict(self.milestones)}
+        if self.console_path:
+            report['console_log'] = self.timestamps_path or self.console_path
+        if self.max_rss_kb != None:
+            report['max_rss_mb'] = round(self.max_rss_kb / 1024, 1)
+        return report
@@ -0,0 +1,171 @@
+#
+# Copyright 2020 Linaro
+#
+# Boot time profile of a guest, see launch_image.py --profile_boot.
+#
+# The guest command waits for systemd to finish booting, then prints
+# systemd-analyze and dmesg output in sections.  This is combined with
+# the milestones seen by the host, from the serial console and the ssh
+# probes, into a single timeline.  Times on the timeline are from the
+# start of the launch when the kernel start was seen on the console,
+# otherwise from the start of the kernel.
+#
+
+import re
+import time
+
+section_marker = "@@lisa-boot-profile "
+sections = [("uname", "uname -r"),
+            ("time", "systemd-analyze time"),
+            ("chain", "systemd-analyze critical-chain --no-pager"),
+            ("blame", "systemd-analyze blame --no-pager"),
+            ("dmesg", "sudo dmesg")]
+# Up to 5 minutes for systemd to reach its default target.
+wait_cmd = "i=0; while systemctl is-system-running 2>/dev/null | "\
+           "grep -q -e initializing -e starting && [ $i -lt 600 ]; do sleep 0.5; i=$((i+1)); done"
+kernel_args = "initcall_debug printk.time=1"
+top_count = 15
+dmesg_events = [("root mounted", re.compile(r"EXT4-fs \(\S+\): mounted")),
+                ("free init memory", re.compile(r"Freeing unused kernel memory")),
+                ("run init", re.compile(r"Run (\S+) as init process"))]
+dmesg_re = re.compile(r"^\[\s*(\d+\.\d+)\]\s?(.*)$")
+initcall_re = re.compile(r"initcall (\S+) returned (-?\d+) after (\d+) usecs")
+chain_re = re.compile(r"(\S+) @(.+?)(?: \+(.+))?$")
+
+def get_guest_cmd():
+    """Command run in the guest once ssh is up."""
+    cmds = [wait_cmd]
+    for name, cmd in sections:
+        cmds.append("echo {}{}; {}".format(section_marker, name, cmd))
+    return "; ".join(cmds)
+
+def add_kernel_args(qemu_args):
+    """Add initcall_debug to the kernel command line of qemu_args.
+       Returns the new qemu_args, unchanged if there is no -append."""
+    match = re.search(r'-append\s+"([^"]*)"', qemu_args)
+    if not match or kernel_args in match.group(1):
+        return qemu_args
+    append = '-append "{} {}"'.format(match.group(1), kernel_args)
+    return qemu_args[:match.start()] + append + qemu_args[match.end():]
+
+def split_sections(lines):
+    result = {}
+    current = None
+    for line in lines:
+        line = line.rstrip("\r\n")
+        if section_marker in line:
+            current = line.split(section_marker, 1)[1].strip()
+            result[current] = []
+        elif current:
+            result[current].append(line)
+    return result
+
+def parse_duration(text):
+    """Seconds of a systemd time span such as 1min 2.345s or 120ms."""
+    units = {'h': 3600, 'min': 60, 's': 1, 'ms': 0.001, 'us': 0.000001, 'µs': 0.000001}
+    total = 0
+    for value, unit in re.findall(r"(\d+(?:\.\d+)?)\s*(h|min|ms|us|µs|s)\b", text):
+        total += float(value) * units[unit]
+    return round(total, 3)
+
+def parse_startup(lines):
+    """Phases of Startup finished in 1.2s (kernel) + 3.4s (userspace) = 4.6s"""
+    phases = {}
+    for line in lines:
+        if "Startup finished in" not in line:
+            continue
+        spans = line.split("Startup finished in", 1)[1].split("=")[0]
+        for span in spans.split("+"):
+            match = re.match(r"\s*(.+?)\s*\((\w+)\)", span)
+            if match:
+                phases[match.group(2)] = parse_duration(match.group(1))
+    return phases
+
+def parse_blame(lines):
+    units = []
+    for line in lines:
+        fields = line.split()
+        if len(fields) >= 2:
+            units.append({'unit': fields[-1], 's': parse_duration(" ".join(fields[:-1]))})
+    return sorted(units, key=lambda unit: unit['s'], reverse=True)[:top_count]
+
+def parse_chain(lines):
+    """Units of the critical chain, with their start in seconds
+       from the start of userspace."""
+    units = []
+    for line in lines:
+        match = chain_re.search(line.strip(" │└├─"))
+        if match:
+            unit = {'unit': match.group(1), 'start_s': parse_duration(match.group(2))}
+            if match.group(3):
+                unit['s'] = parse_duration(match.group(3))
+            units.append(unit)
+    return sorted(units, key=lambda unit: unit['start_s'])
+
+def parse_dmesg(lines):
+    """Kernel events and the slowest initcalls, with their time from
+       the kernel start."""
+    events = []
+    initcalls = []
+    for line in lines:
+        match = dmesg_re.match(line)
+        if not match:
+            continue
+        stamp, text = float(match.group(1)), match.group(2)
+        initcall = initcall_re.search(text)
+        if initcall:
+            initcalls.append({'initcall': initcall.group(1).split("+")[0],
+                              'at_s': stamp,
+                              'ms': round(int(initcall.group(3)) / 1000, 3)})
+            continue
+        for name, event_re in dmesg_events:
+            if event_re.search(text) and name not in [e['event'] for e in events]:
+                events.append({'event': name, 'at_s': stamp})
+    initcalls = sorted(initcalls, key=lambda initcall: initcall['ms'], reverse=True)
+    return events, initcalls[:top_count]
+
+def make_report(boot_report, output_lines, meta):
+    """Timeline report of a boot, from the BootMonitor report of the
+       launch and the output of the guest command."""
+    guest = split_sections(output_lines)
+    startup = parse_startup(guest.get('time', []))
+    chain = parse_chain(guest.get('chain', []))
+    kernel_events, initcalls = parse_dmesg(guest.get('dmesg', []))
+    milestones = boot_report.get('milestones', {})
+    # The kernel start on the console aligns the guest times with the launch.
+    kernel_start = milestones.get('kernel')
+    base = kernel_start if kernel_start != None else 0
+    timeline = []
+    if kernel_start != None:
+        timeline.append({'at_s': 0, 'source': "host", 'event': "launch"})
+    for name, at in milestones.items():
+        if kernel_start != None or name == "kernel":
+            timeline.append({'at_s': at, 'source': "host",
+                             'event': "ssh ready" if name == "ssh" else "console: " + name})
+    for event in kernel_events:
+        timeline.append({'at_s': round(base + event['at_s'], 3), 'source': "kernel",
+                         'event': event['event']})
+    if 'kernel' in startup:
+        userspace = startup['kernel'] + startup.get('initrd', 0)
+        if 'initrd' in startup:
+            timeline.append({'at_s': round(base + startup['kernel'], 3), 'source': "systemd",
+                             'event': "initrd start"})
+        timeline.append({'at_s': round(base + userspace, 3), 'source': "systemd",
+                         'event': "userspace start"})
+        for unit in chain:
+            entry = {'at_s': round(base + userspace + unit['start_s'], 3), 'source': "systemd",
+                     'event': unit['unit']}
+            if 's' in unit:
+                entry['s'] = unit['s']
+            timeline.append(entry)
+    report = dict(meta)
+    report.update({'date': time.strftime("%Y-%m-%d %H:%M:%S"),
+                   'kernel_release': guest.get('uname', ["unknown"])[0].strip() or "unknown",
+                   'timeline_base': "launch" if kernel_start != None else "kernel start",
+                   'summary': {'ssh_ready_s': boot_report.get('ssh_ready_s'),
+                               'kernel_start_s': kernel_start,
+                               'systemd': startup},
+                   'timeline': sorted(timeline, key=lambda entry: entry['at_s']),
+                   'slowest_units': parse_blame(guest.get('blame', [])),
+                   'slowest_initcalls': initcalls})
+    return report
@@ -19,22 +19,47 @@ import shutil
 import subprocess
 from subprocess import Popen,PIPE
 import argparse
+import shlex
 from argparse import RawTextHelpFormatter
 import yaml
+import hashlib
+import tempfile
+import time
+import socket
+import itertools
 import base_cmd
+import boot_monitor
+import boot_profile
+import host_topology
+import accel
+import disk_io
+import numa_topology
+import image_cache
+import qmp
+import rtapp_calib
+import step_graph
+import vm_snapshot
 
 class BuildImage(base_cmd.BaseCmd):
     qemu_path_rel = "external/qemu"
     qemu_build_path_rel = "external/qemu/build"
     build_path_rel = "build"
+    image_cache_path_rel = "build/image-cache"
     def_key_path_rel = "default-keys"
     build_image_cmd = "env {} python3 -B ../tests/vm/{} --image {} --force {} --build-image {}"
     launch_cmd = "env {} python3 -B ../tests/vm/{} --image {} {} {}"
     default_config_file = "conf/conf_default.yml"
     qemu_key_path_rel = "tests/keys"
+    qemu_stamp_name = "lisa-qemu-stamp.yml"
+    step_times_name = "step-times.yml"
+    overlay_create_cmd = "{} create -f qcow2 -F qcow2 -b {} {}"
+    ready_marker = "lisa-qemu-ssh-ready"
+    run_ids = itertools.count()
+    modules_mount_cmd = "sudo mount -t 9p -o trans=virtio,version=9p2000.L,ro {} /lib/modules && "\
+                        "sudo udevadm trigger --action=add && sudo udevadm settle; "
     key_files = ["id_rsa", "id_rsa.pub"]
     
-    def __init__(self, ssh=False):
+    def __init__(self, ssh=False, args=None):
         super(BuildImage, self).__init__()
         self.script_path = os.path.dirname(os.path.realpath(__file__))
         self.root_path = os.path.realpath(os.path.join(self.script_path, "../"))
@@ -49,16 +74,21 @@ class BuildImage(base_cmd.BaseCmd):
             self.default_config_path = self.orig_default_config_path
         self.qemu_path = os.path.join(self.root_path, self.qemu_path_rel)
         self.test_vm_path = os.path.join(self.qemu_path, "tests/vm")
-        self.parse_args()
+        self.parse_args(args)
         self.set_debug(self._args.debug)
         self.set_dry_run(self._args.dry_run)
+        self.set_trace_path(self._args.trace)
         self.build_path = os.path.realpath(os.path.join(self.root_path, self.build_path_rel))
         self.qemu_build_path = os.path.realpath(os.path.join(self.root_path, 
                                                              self.qemu_build_path_rel))
         self.image_name = "{}.img".format(self._args.image_type)
         self.lisa_name = "VM-" + self._args.image_type
         self.image_dir_path = os.path.join(self.build_path, self.lisa_name)
+        if self._args.image_dir:
+            self.image_dir_path = os.path.realpath(self._args.image_dir)
         self.lisa_config_path = os.path.join(self.build_path, "current_vm_config.yml")
+        if self._args.lisa_config:
+            self.lisa_config_path = os.path.realpath(self._args.lisa_config)
         if self._args.image_path:
             self.image_path = os.path.realpath(self._args.image_path)
         else:
@@ -84,6 +114,16 @@ class BuildImage(base_cmd.BaseCmd):
         self.src_ssh_pub_key = os.path.join(self.def_key_path, "id_rsa.pub")
         self.dest_ssh_pub_key = os.path.join(self.image_dir_path, "id_rsa.pub")
         self.ssh_port = 0
+        self.new_run_id()
+        # Guest architectures of the QEMU build with --minimal_qemu,
+        # by default that of the image type.
+        self.qemu_archs = []
+        self.console_path = None
+        self.qmp_path = None
+        self.placement = None
+        self.topology = None
+        self.boot_report = None
+        self.rtapp_calib = None
         self.start_ssh = (ssh or self._args.ssh)
         self.building_image = not os.path.exists(self.image_path)
         
@@ -93,7 +133,7 @@ class BuildImage(base_cmd.BaseCmd):
         # Normally the config is parsed and generated, 
         # to convert relative paths to absolute, but
         # in this case we assume the user provided absolute paths.
-        if self.start_ssh and not self.building_image and \
+        if self.start_ssh and not self.building_image and not self._args.cache and \
            self._args.config != self.orig_default_config_path:
             self.vm_config_path = self._args.config
 
@@ -114,7 +154,7 @@ class BuildImage(base_cmd.BaseCmd):
                 index = 0
         return types_str
     
-    def parse_args(self):
+    def parse_args(self, args=None):
         image_types = self.get_image_types()
         parser = argparse.ArgumentParser(formatter_class=RawTextHelpFormatter,
                                          description="Build the qemu VM image for use with lisa.",
@@ -131,6 +171,10 @@ class BuildImage(base_cmd.BaseCmd):
                             help="Just show commands issued by script, do not execute them.")
         parser.add_argument("--ssh", action="store_true",
                             help="Launch VM and open an ssh shell.")
+        parser.add_argument("--trace", default=os.environ.get('LISA_QEMU_TRACE', ""),
+                            help="Write a timing trace of all commands and phases\n"\
+                            "to this file in Chrome trace format.\n"\
+                            "Can also be set with environment variable LISA_QEMU_TRACE.")
         parser.add_argument("--image_type", default="ubuntu.aarch64",
                             help="Type of image to build.\n"\
                             "From external/qemu/tests/vm.\n"\
@@ -140,19 +184,169 @@ class BuildImage(base_cmd.BaseCmd):
         parser.add_argument("--config", default=self.default_config_path,
                             help="config file.\n"\
                             "default is conf/conf_default.yml.")
+        parser.add_argument("--snapshot", action="store_true",
+                            help="Warm start the VM from a saved VM state.\n"\
+                            "The first launch boots the VM and saves its state once\n"\
+                            "ssh is ready, later launches restore that state.\n"\
+                            "The state is discarded when the image, kernel or\n"\
+                            "qemu_args change.")
+        parser.add_argument("--overlay", action="store_true",
+                            help="Run the VM on a throwaway qcow2 overlay of the image,\n"\
+                            "so the image is not modified and several VMs can share it.\n"\
+                            "The overlay is deleted when the VM exits.")
+        parser.add_argument("--keep_overlay", action="store_true",
+                            help="Keep the overlay of --overlay or --snapshot for inspection.")
+        parser.add_argument("--numa_bind", action="store_true",
+                            help="Bind the memory of each guest NUMA node to a host node.\n"\
+                            "Guest nodes are spread over the host nodes, and the launch\n"\
+                            "fails if a host node does not have enough free memory.")
+        parser.add_argument("--numa_memory", default="ram", choices=["ram", "memfd", "hugepages"],
+                            help="Memory backend used with --numa_bind.\n"\
+                            "hugepages requires free hugepages on the host nodes.\n"\
+                            "default is ram")
+        parser.add_argument("--pin_vcpus", action="store_true",
+                            help="Pin each vCPU thread to a dedicated host core on the\n"\
+                            "host node of its guest NUMA node.  The launch fails if\n"\
+                            "there are not enough host cores.")
+        parser.add_argument("--accel", default="",  choices=["", "auto", "kvm", "tcg"],
+                            help="Accelerator for the image build and launch.\n"\
+                            "auto uses KVM when /dev/kvm is usable for the guest\n"\
+                            "architecture, otherwise multi threaded TCG.\n"\
+                            "Overrides accel of the config file, default is auto.")
+        parser.add_argument("--image_dir", default="",
+                            help="Allows overriding the directory holding the image,\n"\
+                            "keys and generated configs.\n"\
+                            "default is build/VM-[image_type]")
+        parser.add_argument("--ssh_port", default="",
+                            help="Overrides the ssh_port of the config file.\n"\
+                            "Use auto to pick a free port on the host.\n"\
+                            "ssh_port: auto is also accepted in the config file.")
+        parser.add_argument("--lisa_config", default="",
+                            help="Where to write the LISA target config on launch.\n"\
+                            "default is build/current_vm_config.yml")
+        parser.add_argument("--console_log", action="store_true",
+                            help="Keep the serial console log of the launched VM.\n"\
+                            "The console is always followed to timestamp boot milestones\n"\
+                            "and detect when sshd starts, in run/console-[run id].log,\n"\
+                            "which is removed when the VM exits unless this is given.")
+        parser.add_argument("--profile_boot", action="store_true",
+                            help="Boot the VM once on an overlay to profile its boot.\n"\
+                            "The serial console is logged with timestamps, and the\n"\
+                            "systemd-analyze and initcall_debug timings of the guest\n"\
+                            "are merged into a timeline written next to the config as\n"\
+                            "[config]-boot-profile.yml.  The VM then shuts down.")
+        parser.add_argument("--boot_timeout", default=1200, type=int,
+                            help="Seconds to wait for ssh of a VM booted to save a snapshot,\n"\
+                            "calibrate rt-app or profile the boot, before it is stopped.\n"\
+                            "default is 1200")
+        parser.add_argument("--rtapp_calib", default="auto", choices=["auto", "off", "force"],
+                            help="rt-app calibration of the launched VM, written to the\n"\
+                            "LISA platform info.  auto reuses the calibration cached\n"\
+                            "next to the image, or measures it with LISA if there is none.\n"\
+                            "force measures it again.\n"\
+                            "default is auto")
+        parser.add_argument("--guest_cmd", default="/bin/bash",
+                            help="Command to run in the launched VM over ssh.\n"\
+                            "The VM shuts down once it exits.\n"\
+                            "default is /bin/bash")
         parser.add_argument("--build_qemu", action="store_true",
                             help="Build QEMU. QEMU is built initially and not repeated\n"\
                                  "unless this argument is selected.")
-        self._args = parser.parse_args()
+        parser.add_argument("--qemu_only", action="store_true",
+                            help="Only build QEMU, do not build or launch an image.")
+        parser.add_argument("--minimal_qemu", action="store_true",
+                            help="Only configure the QEMU target needed for --image_type,\n"\
+                            "such as aarch64-softmmu, plus the tools like qemu-img.")
+        parser.add_argument("--cache", action="store_true",
+                            help="Use the image cache under build/image-cache.\n"\
+                            "Images are keyed by the resolved config, image type\n"\
+                            "and QEMU revision.  A matching image is reused,\n"\
+                            "otherwise a new one is built.")
+        parser.add_argument("--cache_size", type=float, default=64,
+                            help="Maximum size of the image cache in GB.\n"\
+                            "Least recently used images are evicted beyond this.\n"\
+                            "default is 64")
+        self._args = parser.parse_args(args)
         
+    def get_guest_arch(self, image_type=None):
+        # ubuntu.aarch64 -> aarch64, other images are x86_64.
+        image_type = image_type or self._args.image_type
+        arch = image_type.split(".")[-1]
+        if arch == image_type:
+            arch = "x86_64"
+        return arch
+
+    def get_qemu_targets(self):
+        """softmmu targets to build, None for all of them."""
+        if not self._args.minimal_qemu:
+            return None
+        archs = self.qemu_archs or [self.get_guest_arch()]
+        return sorted(set(["{}-softmmu".format(arch) for arch in archs]))
+
+    def qemu_targets_built(self, stamp):
+        # A build of more targets, or of all of them, also serves.
+        built = stamp.get('targets', [])
+        needed = self.get_qemu_targets()
+        if built == None:
+            return True
+        return needed != None and set(needed) <= set(built)
+
+    def get_configure_args(self):
+        args = []
+        targets = self.get_qemu_targets()
+        if targets:
+            args.append("--target-list={}".format(",".join(targets)))
+        return args
+
     def configure_qemu(self):
-        cmd = "../configure"
+        cmd = " ".join(["../configure"] + self.get_configure_args())
         self.issue_cmd(cmd, show_cmd=True)
+
+    def get_output(self, cmd):
+        # Read only helper commands, these are issued even with --dry_run.
+        try:
+            return subprocess.check_output(cmd, shell=True, stderr=subprocess.DEVNULL)
+        except (subprocess.CalledProcessError, OSError):
+            return b""
+
+    def get_configure_fingerprint(self):
+        # configure needs to be repeated if the QEMU commit or the
+        # toolchain change, or if targets are missing, see qemu_targets_built.
+        sha = hashlib.sha256()
+        sha.update(self.get_output("git -C {} rev-parse HEAD".format(self.qemu_path)))
+        sha.update(self.get_output("{} --version".format(os.environ.get('CC', 'cc'))))
+        return sha.hexdigest()
+
+    def get_source_fingerprint(self):
+        # make needs to be repeated if the QEMU sources changed,
+        # either by a new commit or by local modifications.
+        sha = hashlib.sha256()
+        git_cmd = "git -C {} ".format(self.qemu_path)
+        exclude = " -- . ':(exclude){}'".format(os.path.basename(self.qemu_build_path))
+        sha.update(self.get_output(git_cmd + "rev-parse HEAD"))
+        sha.update(self.get_output(git_cmd + "diff HEAD" + exclude))
+        sha.update(self.get_output(git_cmd + "status --porcelain" + exclude))
+        return sha.hexdigest()
+
+    def read_qemu_stamp(self):
+        stamp_path = os.path.join(self.qemu_build_path, self.qemu_stamp_name)
+        if not os.path.exists(stamp_path):
+            return None
+        with open(stamp_path) as f:
+            return yaml.safe_load(f)
+
+    def write_qemu_stamp(self, stamp):
+        if self._dry_run:
+            return
+        stamp_path = os.path.join(self.qemu_build_path, self.qemu_stamp_name)
+        with open(stamp_path, 'w') as f:
+            yaml.dump(stamp, f)
+        self.print("QEMU stamp {} written".format(stamp_path), debug=True)
         
     def create_dir(self, dir):
         if not os.path.exists(dir):
             self.print("Create {}".format(dir), debug=True)
-            os.mkdir(dir)
+            os.makedirs(dir, exist_ok=True)
 
     def setup_dirs(self):
         self.create_dir(self.qemu_build_path)
@@ -210,12 +404,88 @@ class BuildImage(base_cmd.BaseCmd):
                 target_dict['ssh_pub_key'] = self.dest_ssh_pub_key
             self.print("src_ssh_pub_key: {}".format(self.src_ssh_pub_key),debug=True)
             self.print("dest_ssh_pub_key: {}".format(self.dest_ssh_pub_key),debug=True)
+            if self._args.ssh_port:
+                target_dict['ssh_port'] = self._args.ssh_port
+            if target_dict.get('ssh_port') == "auto":
+                target_dict['ssh_port'] = self.get_free_port()
+                self.print("using free ssh port {}".format(target_dict['ssh_port']))
             if 'ssh_port' in target_dict:
+                target_dict['ssh_port'] = int(target_dict['ssh_port'])
                 self.ssh_port = target_dict['ssh_port']
+            self.resolve_topology(target_dict)
+            self.resolve_accel(target_dict)
+            self.resolve_drive(target_dict)
         else:
             raise Exception("config file {} format is invalid.".format(config_file))
         self.yaml_dict = yaml_dict
 
+    def set_generated_args(self, target_dict, key, args):
+        # Generated qemu_args are also recorded under key, so that the
+        # ones from a previous parse can be replaced.
+        qemu_args = target_dict.get('qemu_args', "")
+        if target_dict.get(key):
+            qemu_args = qemu_args.replace(target_dict[key], "").strip()
+        target_dict[key] = args
+        target_dict['qemu_args'] = "{} {}".format(qemu_args, args).strip()
+
+    def resolve_topology(self, target_dict):
+        # A topology spec generates the -smp, -numa and memory backend qemu_args.
+        if 'topology' not in target_dict:
+            return
+        qemu_args = target_dict.get('qemu_args', "")
+        if target_dict.get('topology_args'):
+            qemu_args = qemu_args.replace(target_dict['topology_args'], "")
+        if numa_topology.strip_topology_args(qemu_args) != " ".join(qemu_args.split()):
+            raise Exception("config file has a topology, remove its -smp, -numa "\
+                            "and memory backend qemu_args")
+        if 'memory' not in target_dict:
+            raise Exception("config file has a topology but no memory")
+        try:
+            self.topology = numa_topology.NumaTopology(target_dict['topology'],
+                                                       target_dict['memory'],
+                                                       target_dict.get('machine', ""))
+        except host_topology.TopologyError as e:
+            raise Exception("config file topology is invalid: {}".format(e))
+        self.set_generated_args(target_dict, 'topology_args', self.topology.get_qemu_args())
+
+    def resolve_accel(self, target_dict):
+        # The accelerator is resolved on every parse, so a config written
+        # on one host picks the right accelerator on another.
+        # The selection is recorded as accel_selected and accel_args.
+        if self._args.accel:
+            target_dict['accel'] = self._args.accel
+        requested = target_dict.setdefault('accel', "auto")
+        vcpus = host_topology.get_smp_cpus(target_dict.get('qemu_args', ""))
+        selected, accel_args = accel.select_accel(requested, self.get_guest_arch(), vcpus)
+        target_dict['accel_selected'] = selected
+        self.set_generated_args(target_dict, 'accel_args', accel_args)
+        self.print("accelerator: {} ({})".format(selected, accel_args), debug=True)
+
+    def resolve_drive(self, target_dict):
+        # The device args are also recorded as drive_device_args, as they
+        # are left out of the image build, see disk_io.py.
+        qemu_args = target_dict.get('qemu_args', "")
+        if target_dict.get('drive_args'):
+            qemu_args = qemu_args.replace(target_dict['drive_args'], "")
+        vcpus = host_topology.get_smp_cpus(qemu_args)
+        try:
+            device_args = disk_io.get_device_args(target_dict, vcpus, qemu_args)
+            io_uring = disk_io.io_uring_supported(self.qemu_build_path)
+            drive_args = "{} {}".format(disk_io.get_drive_args(target_dict, io_uring),
+                                        device_args).strip()
+        except ValueError as e:
+            raise Exception("config file drive settings are invalid: {}".format(e))
+        target_dict['drive_device_args'] = device_args
+        self.set_generated_args(target_dict, 'drive_args', drive_args)
+        if drive_args:
+            self.print("drive: {}".format(drive_args), debug=True)
+
+    @staticmethod
+    def get_free_port():
+        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+            sock.bind(("127.0.0.1", 0))
+            return sock.getsockname()[1]
+
     def create_config_file(self):
         # Rewrite the config file.
         with open(self.vm_config_path, 'w') as f:
@@ -235,21 +505,171 @@ class BuildImage(base_cmd.BaseCmd):
         with open(self.lisa_config_path, 'w') as f:
             yaml_dict = yaml.dump(yaml_dict, f)
             self.print("current config {} written".format(self.lisa_config_path), debug=True)
+        # The LISA target template includes both files, so they are
+        # always written together.  The calibration is added on launch.
+        self.write_platform_info()
+        launch_marker_path = self.get_launch_marker_path()
+        if os.path.exists(launch_marker_path):
+            os.remove(launch_marker_path)
+
+    def get_platform_info_path(self):
+        return os.path.splitext(self.lisa_config_path)[0] + "_platform_info.yml"
+
+    def get_launch_marker_path(self):
+        return os.path.splitext(self.lisa_config_path)[0] + "_launching.yml"
+
+    def write_launch_marker(self):
+        # The platform info is written before the calibration, so this
+        # tells tools starting more VMs of the image, like run_tests.py,
+        # that the calibration is done and cached.
+        with open(self.get_launch_marker_path(), 'w') as f:
+            yaml.dump({'rtapp_calib': self.rtapp_calib}, f)
+
+    def write_platform_info(self):
+        # Written next to the LISA target config, and included by
+        # the platform-info of conf/lisa/qemu_target_default.yml.
+        conf = {'name': self.lisa_name}
+        if self.topology:
+            conf.update(self.topology.get_platform_info())
+        if self.rtapp_calib:
+            conf['rtapp'] = {'calib': self.rtapp_calib}
+        platform_info_path = self.get_platform_info_path()
+        with open(platform_info_path, 'w') as f:
+            yaml.dump({'conf': conf}, f)
+        self.print("platform info {} written".format(platform_info_path), debug=True)
+
+    def get_qemu_revision(self):
+        cmd = "git -C {} describe --always --dirty".format(self.qemu_path)
+        return self.get_output(cmd).decode().strip() or "unknown"
+
+    def setup_image_cache(self):
+        # Resolve the image path from the cache.
+        # Returns True if a matching image already exists.
+        self.parse_config_file(self.config_path)
+        self.image_cache = image_cache.ImageCache(os.path.join(self.root_path,
+                                                               self.image_cache_path_rel),
+                                                  self._args.cache_size, self.print)
+        self.cache_key = image_cache.ImageCache.compute_key(self.yaml_dict,
+                                                            self._args.image_type,
+                                                            self.get_qemu_revision(),
+                                                            [self.src_ssh_key,
+                                                             self.src_ssh_pub_key])
+        cached_path = self.image_cache.lookup(self.cache_key)
+        if cached_path:
+            self.image_path = cached_path
+        else:
+            self.image_cache.prepare(self.cache_key)
+            self.image_path = self.image_cache.image_path(self.cache_key, self.image_name)
+        self.link_cached_image()
+        return cached_path != None
+
+    def link_cached_image(self):
+        # Point the default image path at the cached image so that
+        # install_kernel.py and launch_image.py pick it up.
+        link_path = os.path.join(self.image_dir_path, self.image_name)
+        if os.path.exists(link_path) and not os.path.islink(link_path):
+            self.print("{} is not a link to the cache, leaving it alone.".format(link_path))
+            return
+        if os.path.islink(link_path):
+            os.remove(link_path)
+        os.symlink(self.image_path, link_path)
+        self.print("link {} -> {}".format(link_path, self.image_path), debug=True)
 
     def build_qemu(self):
-        print("configuring QEMU.   Please be patient, this may take several minutes...")
-        self.configure_qemu()
-        print("QEMU configure complete.")
-        
+        stamp = self.read_qemu_stamp() or {}
+        configure_fp = self.get_configure_fingerprint()
+        source_fp = self.get_source_fingerprint()
+        configured = os.path.exists(os.path.join(self.qemu_build_path, "config-host.mak"))
+        if configured and stamp.get('configure') == configure_fp and \
+           self.qemu_targets_built(stamp):
+            self.print("QEMU configuration unchanged, skipping configure.")
+        else:
+            print("configuring QEMU.   Please be patient, this may take several minutes...")
+            with self.phase("configure"):
+                self.configure_qemu()
+            print("QEMU configure complete.")
+            stamp = {'configure': configure_fp, 'targets': self.get_qemu_targets()}
+            self.write_qemu_stamp(stamp)
+
+        if stamp.get('source') == source_fp:
+            self.print("QEMU sources unchanged, skipping make.")
+            return
         print("building QEMU.   Please be patient, this may take several minutes...")
         cmd = "make -j {}".format(os.cpu_count())        
-        self.issue_cmd(cmd, no_capture=True)
+        with self.phase("make"):
+            rc, output = self.issue_cmd(cmd, no_capture=True)
+        if rc == 0:
+            stamp['source'] = source_fp
+            self.write_qemu_stamp(stamp)
         print("QEMU build complete")
 
+    def qemu_up_to_date(self):
+        # We need to build qemu since we will be using it to run the qemu image.
+        # Once a stamp exists, build_qemu only does what changed.
+        if self.require_build:
+            return False
+        stamp = self.read_qemu_stamp()
+        if stamp == None:
+            return not self._args.build_qemu
+        configured = os.path.exists(os.path.join(self.qemu_build_path, "config-host.mak"))
+        return configured and stamp.get('configure') == self.get_configure_fingerprint() and \
+               self.qemu_targets_built(stamp) and \
+               stamp.get('source') == self.get_source_fingerprint()
+
+    def create_image(self):
+        # Next we create a qemu image using the image template.
+        rc = self.build_image()
+        if self._args.cache and not self._args.image_path and rc == 0:
+            self.image_cache.commit(self.cache_key, self.image_name,
+                                    {'image_type': self._args.image_type,
+                                     'config': self.config_path})
+
+    def get_steps(self, build):
+        # The steps of the image generation and what they depend on.
+        # The keys and config do not wait for QEMU to build.
+        graph = step_graph.StepGraph(os.path.join(self.build_path, self.step_times_name),
+                                     self.print, self._dry_run)
+        key_inputs = [os.path.join(self.qemu_key_path, file) for file in self.key_files]
+        graph.add("keys", self.create_default_keys, inputs=key_inputs,
+                  outputs=[os.path.join(self.def_key_path, file) for file in self.key_files])
+        # The resolved config depends on the host, like free ports and
+        # the accelerator, so it is written every time.
+        graph.add("config", self.create_config_file, inputs=[self.config_path], outputs=[self.vm_config_path],
+                  check=lambda: False)
+        graph.add("copy keys", self.copy_key_files, deps=["keys", "config"],
+                  inputs=lambda: [self.src_ssh_key, self.src_ssh_pub_key],
+                  outputs=lambda: [self.dest_ssh_key, self.dest_ssh_pub_key])
+        if build:
+            graph.add("qemu", self.build_qemu, check=self.qemu_up_to_date)
+            graph.add("image", self.create_image, deps=["config", "copy keys", "qemu"],
+                      outputs=[self.image_path], check=lambda: False)
+        return graph
+
+    def run_steps(self, graph):
+        if self._dry_run:
+            graph.print_plan()
+        graph.run()
+
+    def write_build_config(self):
+        # The drive device args would also apply to the cloud-init seed
+        # drive attached by the build, see disk_io.py.
+        conf = self.yaml_dict['qemu-conf']
+        if not conf.get('drive_device_args'):
+            return self.vm_config_path
+        config_path = self.get_run_path("conf-build.yml")
+        yaml_dict = dict(self.yaml_dict)
+        yaml_dict['qemu-conf'] = dict(conf)
+        yaml_dict['qemu-conf']['qemu_args'] = " ".join(conf.get('qemu_args', "")\
+                                              .replace(conf['drive_device_args'], "").split())
+        with open(config_path, 'w') as f:
+            yaml.dump(yaml_dict, f)
+        return config_path
+
     def build_image(self):
+        config_path = self.write_build_config()
         args = "--build-path {} ".format(self.qemu_build_path)
         env_vars = "QEMU_LOCAL=1 "
-        env_vars += "QEMU_CONFIG={} ".format(self.vm_config_path)
+        env_vars += "QEMU_CONFIG={} ".format(config_path)
         if self._args.debug:
             args += "--debug"
         print("\n")
@@ -260,44 +680,464 @@ class BuildImage(base_cmd.BaseCmd):
                                           self.image_path, 
                                           args,
                                           self.image_path)
-        rc, output = self.issue_cmd(cmd, no_capture=True)
+        try:
+            with self.phase("build image"):
+                rc, output = self.issue_cmd(cmd, no_capture=True)
+        finally:
+            if config_path != self.vm_config_path and os.path.exists(config_path):
+                os.remove(config_path)
         if rc != 0:
             print("Image creation failed.")
         else:
             print("Image creation successful.")
             print("Image path: {}\n".format(self.image_path))
+        return rc
 
-    def ssh(self):
-        print("Conf:        {}".format(self.vm_config_path))
-        print("Image type:  {}".format(self._args.image_type))
-        print("Image path:  {}\n".format(self.image_path))
+    def get_launch_cmd(self, config_path, image_path, guest_cmd):
         args = "--build-path {} ".format(self.qemu_build_path)
         env_vars = "QEMU_LOCAL=1 "
-        env_vars += "QEMU_CONFIG={} ".format(self.vm_config_path)
+        env_vars += "QEMU_CONFIG={} ".format(config_path)
         if self._args.debug:
             args += "--debug"
+        return self.launch_cmd.format(env_vars, self._args.image_type, image_path, args, guest_cmd)
+
+    def create_overlay(self, backing_path, overlay_path):
+        if os.path.exists(overlay_path):
+            os.remove(overlay_path)
+        cmd = self.overlay_create_cmd.format(os.path.join(self.qemu_build_path, "qemu-img"),
+                                             backing_path, overlay_path)
+        self.issue_cmd(cmd, enable_stdout=False)
+
+    def boot_until_ready(self, config_path, image_path, phase):
+        # Boot the VM with a guest command that prints a marker once
+        # ssh is ready, then keeps the VM up until it is told to quit.
+        # Returns the running launch and the boot time, None if the
+        # VM exited or was stopped before it was ready.
+        guest_cmd = "'sync; echo {}; sleep 3600'".format(self.ready_marker)
+        cmd = self.get_launch_cmd(config_path, image_path, guest_cmd)
+        ready = []
+        def check_ready(line):
+            if self.ready_marker in line:
+                ready.append(time.time())
+        start = time.time()
+        deadline = start + self._args.boot_timeout
+        with self.phase(phase):
+            launch = self.start_command(cmd, line_fn=check_ready)
+            self.wait_commands([launch], until=lambda: len(ready) > 0 or time.time() > deadline)
+            if not ready and not launch.done():
+                self.print("VM not ready for ssh after {}s, stopped.".format(self._args.boot_timeout))
+                launch.cancel()
+                self.finish_command(launch)
+        return launch, (ready[0] - start if ready else None)
+
+    def quit_vm(self, qmp_path, launch):
+        try:
+            monitor = qmp.QMPClient(qmp_path)
+            monitor.connect()
+            monitor.cmd("quit")
+            monitor.close()
+        except qmp.QMPError:
+            # The guest is left sleeping, do not wait for it.
+            launch.cancel()
+            raise
+        self.wait_commands([launch])
+
+    def save_snapshot(self, snapshot):
+        # Boot the VM on a new overlay, and once ssh is ready, migrate
+        # its state to a file and quit.  The overlay is then frozen
+        # together with the saved state.
+        print("No VM snapshot found.  Booting to create one, this may take several minutes...")
+        snapshot.prepare()
+        self.create_overlay(self.image_path, snapshot.disk_path)
+        qmp_path = os.path.join(tempfile.mkdtemp(prefix="lisa-qemu-"), "qmp.sock")
+        config_path = snapshot.write_config("-qmp unix:{},server,nowait".format(qmp_path))
+        launch, boot_time = self.boot_until_ready(config_path, snapshot.disk_path,
+                                                  "snapshot boot")
+        if self._dry_run:
+            return
+        if boot_time == None:
+            self.print("VM was not ready for ssh, no snapshot saved.")
+            self.terminate(1)
+            return
+        self.print("ssh ready after {:.1f}s, saving VM state".format(boot_time))
+        with self.phase("snapshot save"):
+            state_tmp_path = snapshot.state_path + ".tmp"
+            try:
+                monitor = qmp.QMPClient(qmp_path)
+                monitor.connect()
+                monitor.cmd("migrate", uri="exec:cat>{}".format(state_tmp_path))
+                monitor.wait_migration()
+                monitor.cmd("quit")
+                monitor.close()
+            except qmp.QMPError:
+                # The guest is left sleeping, do not wait for it.
+                launch.cancel()
+                raise
+            self.wait_commands([launch])
+            os.rename(state_tmp_path, snapshot.state_path)
+        shutil.rmtree(os.path.dirname(qmp_path), ignore_errors=True)
+        snapshot.commit(boot_time)
+        self.print("VM snapshot saved in {}".format(snapshot.path))
+
+    def get_rtapp_calib(self):
+        # Calibration of the VM for the rt-app workloads of LISA,
+        # from the cache or measured on a throwaway boot of the VM.
+        if self._args.rtapp_calib == "off":
+            return None
+        cache = rtapp_calib.CalibrationCache(self.image_dir_path, self.image_path,
+                                             self.yaml_dict)
+        calib = cache.lookup()
+        if calib and self._args.rtapp_calib != "force":
+            self.print("using cached rt-app calibration {}".format(cache.key), debug=True)
+            return calib
+        if not rtapp_calib.lisa_available():
+            self.print("LISA is not installed, rt-app calibration is left to LISA.")
+            return None
+        print("Measuring rt-app calibration of the VM, this may take several minutes...")
+        calib = self.measure_rtapp_calib()
+        if calib:
+            cache.commit(calib)
+            self.print("rt-app calibration cached in {}".format(cache.path))
+        return calib
+
+    def measure_rtapp_calib(self):
+        overlay_path = self.get_run_path("calib.qcow2")
+        output_path = self.get_run_path("calib.yml")
+        target_conf_path = self.get_run_path("calib-target.yml")
+        qmp_path = os.path.join(tempfile.mkdtemp(prefix="lisa-qemu-"), "qmp.sock")
+        config_path = self.get_run_path("conf-calib.yml")
+        yaml_dict = dict(self.yaml_dict)
+        yaml_dict['qemu-conf'] = dict(yaml_dict['qemu-conf'])
+        yaml_dict['qemu-conf']['qemu_args'] = "{} -qmp unix:{},server,nowait"\
+                                             .format(yaml_dict['qemu-conf'].get('qemu_args', ""),
+                                                     qmp_path)
+        with open(config_path, 'w') as f:
+            yaml.dump(yaml_dict, f)
+        with open(target_conf_path, 'w') as f:
+            yaml.dump({'target-conf': {'kind': "linux",
+                                       'name': self.lisa_name,
+                                       'host': "127.0.0.1",
+                                       'username': "root",
+                                       'keyfile': self.dest_ssh_key,
+                                       'port': self.ssh_port}}, f)
+        self.create_overlay(self.image_path, overlay_path)
+        calib = None
+        try:
+            launch, boot_time = self.boot_until_ready(config_path, overlay_path, "calib boot")
+            if boot_time == None:
+                if not self._dry_run:
+                    self.print("VM was not ready for ssh, rt-app calibration skipped.")
+                return None
+            with self.phase("calibrate"):
+                rc, output = self.issue_cmd("{} {} --target_conf {} --output {}"\
+                                            .format(sys.executable,
+                                                    os.path.join(self.script_path, "rtapp_calib.py"),
+                                                    target_conf_path, output_path),
+                                            fail_on_err=False)
+            self.quit_vm(qmp_path, launch)
+            if rc == 0:
+                with open(output_path) as f:
+                    calib = yaml.safe_load(f)['calib']
+                self.print("rt-app calibration: {}".format(calib))
+            else:
+                self.print("rt-app calibration failed, it is left to LISA.")
+        finally:
+            for path in [overlay_path, output_path, target_conf_path, config_path]:
+                if os.path.exists(path):
+                    os.remove(path)
+            shutil.rmtree(os.path.dirname(qmp_path), ignore_errors=True)
+        return calib
+
+    def restore_snapshot(self, snapshot, guest_cmd):
+        # Every launch runs on a new overlay so the snapshot disk stays
+        # consistent with the saved state.
+        extra_args = "-incoming exec:cat<{} {}".format(snapshot.state_path,
+                                                       self.get_launch_args())
+        config_path = snapshot.write_config(extra_args, self.get_run_path("conf.yml"))
+        print("Restoring VM snapshot {}".format(snapshot.path))
+        self.launch_vm_on_overlay(config_path, snapshot.disk_path, guest_cmd)
+
+    def launch_vm_on_overlay(self, config_path, backing_path, guest_cmd):
+        overlay_path = self.get_run_path("overlay.qcow2")
+        self.create_overlay(backing_path, overlay_path)
+        try:
+            return self.launch_vm(config_path, overlay_path, guest_cmd)
+        finally:
+            if self._args.keep_overlay:
+                print("Overlay kept: {}".format(overlay_path))
+            elif os.path.exists(overlay_path):
+                self.print("remove overlay {}".format(overlay_path), debug=True)
+                os.remove(overlay_path)
+
+    def new_run_id(self):
+        # Unique to the process and launch, unlike the ssh port which
+        # is the same for every launch of a config with a fixed port.
+        self.run_id = "{}-{}".format(os.getpid(), next(BuildImage.run_ids))
+
+    def get_run_path(self, name):
+        # Files of a single launch, named by run id so that
+        # several VMs of the same image can run at once.
+        run_path = os.path.join(self.image_dir_path, "run")
+        self.create_dir(run_path)
+        base, ext = os.path.splitext(name)
+        return os.path.join(run_path, "{}-{}{}".format(base, self.run_id, ext))
+
+    def get_console_args(self):
+        self.console_path = self.get_run_path("console.log")
+        if os.path.exists(self.console_path):
+            os.remove(self.console_path)
+        return "-chardev file,id=lisa-console,path={} "\
+               "-serial chardev:lisa-console".format(self.console_path)
+
+    def get_launch_args(self):
+        args = self.get_console_args()
+        if self._args.pin_vcpus:
+            self.qmp_path = os.path.join(tempfile.mkdtemp(prefix="lisa-qemu-"), "qmp.sock")
+            args += " -qmp unix:{},server,nowait".format(self.qmp_path)
+        return args
+
+    def place_guest(self):
+        # Map the guest NUMA nodes onto the host before launching,
+        # so that we fail fast if the host cannot provide the layout.
+        conf = self.yaml_dict['qemu-conf']
+        try:
+            layout = host_topology.GuestNumaLayout(conf.get('qemu_args', ""),
+                                                   conf.get('memory', "1G"))
+            self.placement = layout.place(host_topology.HostTopology(),
+                                          self._args.numa_memory, self._args.pin_vcpus)
+        except host_topology.TopologyError as e:
+            self.print("host cannot satisfy the guest layout: {}".format(e))
+            self.terminate(1)
+            return
+        for p in self.placement:
+            self.print("guest node {} -> host node {}, vcpus -> cores {}".format(p['nodeid'],
+                       p['host_node'], p['vcpus']), debug=True)
+        if self._args.numa_bind:
+            conf['qemu_args'] = layout.get_qemu_args(self.placement, self._args.numa_memory)
+
+    def pin_vcpus(self):
+        cores = {}
+        for p in self.placement:
+            cores.update(p['vcpus'])
+        monitor = qmp.QMPClient(self.qmp_path)
+        monitor.connect()
+        cpus = monitor.cmd("query-cpus-fast")
+        monitor.close()
+        threads = {}
+        for cpu in cpus:
+            if cpu['cpu-index'] not in cores:
+                self.print("vCPU {} is not in any guest NUMA node, not pinned".format(cpu['cpu-index']))
+                continue
+            threads.setdefault(cpu['thread-id'], set()).add(cores[cpu['cpu-index']])
+        if len(threads) < len(cpus):
+            self.print("vCPUs share threads, use multi threaded TCG or KVM for exclusive pinning.")
+        for thread_id, thread_cores in threads.items():
+            self.print("pin thread {} to cores {}".format(thread_id, sorted(thread_cores)),
+                       debug=True)
+            os.sched_setaffinity(thread_id, thread_cores)
+        shutil.rmtree(os.path.dirname(self.qmp_path), ignore_errors=True)
+
+    def write_launch_config(self):
+        # The launcher reads its settings, like the ssh port, from the
+        # config file, so write what we resolved for this launch.
+        config_path = self.get_run_path("conf.yml")
+        yaml_dict = dict(self.yaml_dict)
+        yaml_dict['qemu-conf'] = dict(yaml_dict['qemu-conf'])
+        yaml_dict['qemu-conf']['qemu_args'] = "{} {}".format(yaml_dict['qemu-conf'].get('qemu_args', ""),
+                                                             self.get_launch_args())
+        with open(config_path, 'w') as f:
+            yaml.dump(yaml_dict, f)
+        self.print("launch config {} written".format(config_path), debug=True)
+        return config_path
+
+    def launch_vm(self, config_path, image_path, guest_cmd):
+        cmd = self.get_launch_cmd(config_path, image_path, guest_cmd)
+        monitor = boot_monitor.BootMonitor(self.ssh_port, self.console_path)
+        with self.phase("launch"):
+            launch = self.start_command(cmd, capture=False)
+            monitor.start()
+            if self._args.pin_vcpus and not self._dry_run:
+                try:
+                    self.pin_vcpus()
+                except (qmp.QMPError, OSError) as e:
+                    self.print("could not pin vCPUs: {}".format(e))
+                    launch.cancel()
+                    self.terminate(1)
+            with self.phase("boot"):
+                self.wait_commands([launch], until=monitor.poll)
+            if monitor.ready:
+                self.print("time to SSH-ready: {:.2f}s".format(monitor.milestones['ssh']))
+                with open(self.get_run_path("boot.yml"), 'w') as f:
+                    yaml.dump(self.get_boot_report(monitor), f)
+            self.wait_commands([launch])
+            monitor.close()
+            monitor.set_rusage(launch.rusage)
+            self.boot_report = self.get_boot_report(monitor)
+        if not self._args.console_log and self.console_path and \
+           os.path.exists(self.console_path):
+            os.remove(self.console_path)
+        self.check_rc(cmd, launch.rc, True, None)
+        return monitor
+
+    def get_boot_report(self, monitor):
+        report = monitor.report()
+        if not self._args.console_log:
+            # The console log is removed once the VM exits.
+            report.pop('console_log', None)
+        return report
+
+    def get_guest_cmd(self):
+        # The launcher passes the command on to ssh as one argument.
+        guest_cmd = self._args.guest_cmd
+        modules_share = self.yaml_dict['qemu-conf'].get('modules_share')
+        if modules_share:
+            # Modules of a kernel booted from a build tree are shared by
+            # the host, see install_kernel.py --build_tree.  Devices which
+            # found no module during boot are probed again once mounted.
+            guest_cmd = self.modules_mount_cmd.format(modules_share) + guest_cmd
+        return shlex.quote(guest_cmd)
+
+    def get_boot_profile_path(self, suffix):
+        # Named after the config, so each kernel and boot profile of
+        # an image keeps its own report.
+        name = os.path.splitext(os.path.basename(self.vm_config_path))[0]
+        return os.path.join(self.image_dir_path, "{}-{}".format(name, suffix))
+
+    def profile_boot(self):
+        # A captured launch on an overlay, so the output of the guest
+        # command can be collected before the VM shuts down.
+        self._args.console_log = True
+        conf = self.yaml_dict['qemu-conf']
+        qemu_args = boot_profile.add_kernel_args(conf.get('qemu_args', ""))
+        if qemu_args == conf.get('qemu_args', ""):
+            self.print("no -append in qemu_args, initcall timings are not collected.")
+        conf['qemu_args'] = qemu_args
+        config_path = self.write_launch_config()
+        overlay_path = self.get_run_path("overlay.qcow2")
+        console_path = self.get_boot_profile_path("boot-console.log")
+        self.create_overlay(self.image_path, overlay_path)
+        cmd = self.get_launch_cmd(config_path, overlay_path,
+                                  shlex.quote(boot_profile.get_guest_cmd()))
+        monitor = boot_monitor.BootMonitor(self.ssh_port, self.console_path,
+                                           timestamps_path=console_path)
+        output = []
+        # The guest command bounds its own wait for systemd, so only
+        # the wait for ssh needs a timeout.
+        deadline = time.time() + self._args.boot_timeout
+        print("Profiling the boot of the VM, this may take several minutes...")
+        try:
+            with self.phase("profile boot"):
+                launch = self.start_command(cmd, enable_stdout=self._debug,
+                                            line_fn=output.append)
+                monitor.start()
+                # Keep following the console until the VM exits.
+                self.wait_commands([launch], poll=monitor.poll,
+                                   until=lambda: not monitor.ready and time.time() > deadline)
+                if not launch.done():
+                    launch.cancel()
+                    self.finish_command(launch)
+                monitor.close()
+        finally:
+            if os.path.exists(overlay_path):
+                os.remove(overlay_path)
+        if not monitor.ready and not self._dry_run:
+            self.print("VM not ready for ssh after {}s, see {}".format(self._args.boot_timeout,
+                                                                      console_path))
+            self.terminate(1)
+            return
+        self.check_rc(cmd, launch.rc, True, None)
+        if self._dry_run:
+            return
+        meta = {'image': self.image_path,
+                'image_type': self._args.image_type,
+                'config': self.vm_config_path}
+        if 'boot-profile' in self.yaml_dict:
+            meta['boot_profile'] = self.yaml_dict['boot-profile']['profile']
+        report = boot_profile.make_report(monitor.report(), output, meta)
+        report['console_log'] = console_path
+        report_path = self.get_boot_profile_path("boot-profile.yml")
+        with open(report_path, 'w') as f:
+            yaml.dump(report, f)
+        summary = report['summary']
+        self.print("kernel {}: ssh ready after {}s, systemd {}".format(report['kernel_release'],
+                   summary['ssh_ready_s'],
+                   " + ".join("{}s ({})".format(s, phase)
+                              for phase, s in summary['systemd'].items()) or "not reported"))
+        self.print("boot profile written to {}".format(report_path))
+
+    def find_overlays(self):
+        """qcow2 overlays next to the image which it is the backing file of,
+           like the kernel images of install_kernel.py --overlay."""
+        image_path = os.path.realpath(self.image_path)
+        overlays = []
+        # Only the files directly in the image dir can be kernel images,
+        # run/ and the modules dirs of --build_tree are not looked at.
+        for name in sorted(os.listdir(self.image_dir_path)):
+            path = os.path.join(self.image_dir_path, name)
+            if ".kernel-" not in name and not name.endswith(".qcow2") or \
+               not os.path.isfile(path):
+                continue
+            backing = image_cache.ImageCache.backing_file(path)
+            if backing and os.path.realpath(backing) == image_path:
+                overlays.append(path)
+        return overlays
+
+    def ssh(self):
+        print("Conf:        {}".format(self.vm_config_path))
+        print("Image type:  {}".format(self._args.image_type))
+        print("Image path:  {}\n".format(self.image_path))
+        if self._args.profile_boot:
+            self.profile_boot()
+            return
+        if self._args.numa_bind or self._args.pin_vcpus:
+            self.place_guest()
+        self.rtapp_calib = self.get_rtapp_calib()
+        self.write_platform_info()
+        self.write_launch_marker()
+        if self._args.snapshot:
+            snapshot = vm_snapshot.VMSnapshot(self.image_dir_path, self.image_path,
+                                              self.yaml_dict, self.qemu_build_path)
+            if not snapshot.valid():
+                self.save_snapshot(snapshot)
+                if not snapshot.valid() and not self._dry_run:
+                    return
+            self.restore_snapshot(snapshot, self.get_guest_cmd())
+            return
+        if not self._args.overlay:
+            overlays = self.find_overlays()
+            if overlays:
+                # Writing to the image would corrupt the overlays on top of it.
+                print("{} is the backing image of {}, launching on an overlay.".format(
+                      self.image_path, " ".join(overlays)))
+                self._args.overlay = True
         print("Launching Image.  Please be patient, this may take several minutes...")
         print("To enable more verbose tracing of each step, please use the --debug option.\n")
-        cmd = self.launch_cmd.format(env_vars, self._args.image_type, self.image_path, args, "/bin/bash")
-        self.issue_cmd(cmd, no_capture=True)
+        if self._args.overlay:
+            self.launch_vm_on_overlay(self.write_launch_config(), self.image_path,
+                                      self.get_guest_cmd())
+        else:
+            self.launch_vm(self.write_launch_config(), self.image_path, self.get_guest_cmd())
         
     def run(self):
         self.require_build = not os.path.exists(self.qemu_build_path)
         self.setup_dirs()
-        
-        if not self.start_ssh or not os.path.exists(self.image_path):
+        if self._args.qemu_only:
+            self.build_qemu()
+            return
+        cache_hit = False
+        if self._args.cache:
+            if self._args.image_path:
+                self.print("--image_path given, not using the image cache.")
+            else:
+                cache_hit = self.setup_image_cache()
+
+        if cache_hit:
+            self.print("Using cached image {}".format(self.image_path))
+            self.run_steps(self.get_steps(build=False))
+        elif not self.start_ssh or not os.path.exists(self.image_path):
             self.print("Start image file generation.", debug=True)
             self.parse_config_file(self.config_path)
-            self.create_default_keys()
-            self.create_config_file()
-            self.copy_key_files()
-            
-            if self.require_build or self._args.build_qemu:
-                # We need to build qemu since we will be using it to run the qemu image.
-                self.build_qemu()
-        
-            # Next we create a qemu image using the image template.
-            self.build_image()
+            self.run_steps(self.get_steps(build=True))
         else:
             self.print("skip image file generation, already exists.", debug=True)
             
@@ -0,0 +1,195 @@
+#
+# Copyright 2020 Linaro
+#
+# Builds a matrix of images concurrently.
+#
+# build_matrix.py --image_types [image types] --configs [config yamls] --jobs [N]
+#
+#    Every combination of image type and config is built by its own
+#    BuildImage in a separate worker process.  Each build gets its own
+#    image directory, log file and ssh port.
+#    Any arguments after -- are passed on to every build.
+#
+
+import sys
+import os
+import argparse
+from argparse import RawTextHelpFormatter
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import traceback
+import time
+import yaml
+import base_cmd
+import build_image
+
+def run_job(job):
+    """Build one image of the matrix.  Runs in a worker process."""
+    result = {'name': job['name'], 'log': job['log'], 'status': "failed"}
+    start = time.time()
+    sys.stdout.flush()
+    sys.stderr.flush()
+    # Redirect at the fd level so output of child commands goes to the log too.
+    with open(job['log'], 'w') as log:
+        os.dup2(log.fileno(), sys.stdout.fileno())
+        os.dup2(log.fileno(), sys.stderr.fileno())
+        inst_obj = None
+        try:
+            sys.argv = [job['name']]
+            inst_obj = build_image.BuildImage(args=job['args'])
+            inst_obj.run()
+            if os.path.exists(inst_obj.image_path) or job['dry_run']:
+                result['status'] = "ok"
+                result['image_path'] = inst_obj.image_path
+        except SystemExit as e:
+            print("build exited with status: {}".format(e.code))
+        except Exception:
+            traceback.print_exc()
+        finally:
+            # Worker processes do not run atexit handlers.
+            if inst_obj and inst_obj._trace:
+                inst_obj._trace.write()
+            sys.stdout.flush()
+            sys.stderr.flush()
+    result['duration'] = round(time.time() - start, 1)
+    return result
+
+class BuildMatrix(base_cmd.BaseCmd):
+    build_path_rel = "build"
+    default_config_file = "conf/conf_default.yml"
+
+    def __init__(self):
+        super(BuildMatrix, self).__init__()
+        self.script_path = os.path.dirname(os.path.realpath(__file__))
+        self.root_path = os.path.realpath(os.path.join(self.script_path, "../"))
+        self.build_path = os.path.join(self.root_path, self.build_path_rel)
+        self.parse_args()
+        self.set_debug(self._args.debug)
+        self.set_dry_run(self._args.dry_run)
+        self.set_trace_path(self._args.trace)
+        self.continue_on_error = True
+        self.log_path = os.path.realpath(self._args.log_dir)
+        self.summary_path = os.path.join(self.log_path, "summary.yml")
+
+    def parse_args(self):
+        parser = argparse.ArgumentParser(formatter_class=RawTextHelpFormatter,
+                                         description="Build a matrix of image types and configs concurrently.",
+                                         epilog="examples:\n"\
+                                         "    {} --image_types ubuntu.aarch64 "\
+                                         "--configs conf/conf_default.yml conf/my_conf.yml "\
+                                         "--jobs 2 -- --cache\n".format(sys.argv[0]))
+        parser.add_argument("--debug", action="store_true",
+                            help="enable debug output")
+        parser.add_argument("--dry_run", action="store_true",
+                            help="Just show commands issued by each build, do not execute them.")
+        parser.add_argument("--image_types", nargs="+", default=["ubuntu.aarch64"],
+                            help="Image types to build.\n"\
+                            "default is ubuntu.aarch64")
+        parser.add_argument("--configs", nargs="+",
+                            default=[os.path.join(self.root_path, self.default_config_file)],
+                            help="Config files to build each image type with.\n"\
+                            "default is conf/conf_default.yml")
+        parser.add_argument("--jobs", "-j", type=int, default=2,
+                            help="Number of builds to run at once.\n"\
+                            "default is 2")
+        parser.add_argument("--base_port", type=int, default=5600,
+                            help="ssh port of the first build, the following builds\n"\
+                            "use the next ports.\n"\
+                            "default is 5600")
+        parser.add_argument("--trace", default=os.environ.get('LISA_QEMU_TRACE', ""),
+                            help="Write a timing trace of all commands and phases\n"\
+                            "to this file in Chrome trace format.\n"\
+                            "Can also be set with environment variable LISA_QEMU_TRACE.")
+        parser.add_argument("--log_dir", default=os.path.join(self.build_path, "matrix"),
+                            help="Directory for the per build logs and the summary.\n"\
+                            "default is build/matrix")
+        parser.add_argument("build_args", nargs=argparse.REMAINDER,
+                            help="Arguments after -- are passed to build_image.py")
+        self._args = parser.parse_args()
+        if self._args.build_args and self._args.build_args[0] == "--":
+            self._args.build_args = self._args.build_args[1:]
+
+    def get_jobs(self):
+        jobs = []
+        for image_type in self._args.image_types:
+            for config in self._args.configs:
+                config_name = os.path.splitext(os.path.basename(config))[0]
+                name = "{}-{}".format(image_type, config_name)
+                port = self._args.base_port + len(jobs)
+                args = ["--image_type", image_type,
+                        "--config", os.path.realpath(config),
+                        "--image_dir", os.path.join(self.build_path, "VM-" + name),
+                        "--ssh_port", str(port)]
+                if self._debug:
+                    args.append("--debug")
+                if self._dry_run:
+                    args.append("--dry_run")
+                if self._trace:
+                    # Each build writes its own trace next to its log.
+                    args += ["--trace", os.path.join(self.log_path, name + ".trace.json")]
+                else:
+                    args += ["--trace", ""]
+                jobs.append({'name': name,
+                             'args': args + self._args.build_args,
+                             'log': os.path.join(self.log_path, name + ".log"),
+                             'dry_run': self._dry_run})
+        return jobs
+
+    def prepare_builds(self, args):
+        # Build QEMU for the guest architectures of all the image types,
+        # and create the default keys, once up front so the jobs do not
+        # all do it at once.
+        sys.argv = [sys.argv[0]]
+        inst_obj = build_image.BuildImage(args=args)
+        inst_obj.qemu_archs = [inst_obj.get_guest_arch(image_type)
+                               for image_type in self._args.image_types]
+        require_build = not os.path.exists(inst_obj.qemu_build_path)
+        inst_obj.setup_dirs()
+        if require_build or inst_obj._args.build_qemu or inst_obj.read_qemu_stamp():
+            with self.phase("build qemu"):
+                inst_obj.build_qemu()
+        inst_obj.create_default_keys()
+        os.chdir(self.root_path)
+
+    def write_summary(self, results, duration):
+        summary = {'duration': round(duration, 1),
+                   'failed': len([r for r in results if r['status'] != "ok"]),
+                   'jobs': results}
+        with open(self.summary_path, 'w') as f:
+            yaml.dump(summary, f)
+        print("")
+        print("{:<50} {:>8} {:>10}".format("build", "status", "duration"))
+        for result in results:
+            print("{:<50} {:>8} {:>9}s".format(result['name'], result['status'],
+                                                result['duration']))
+        print("total: {}s, {} of {} failed".format(summary['duration'],
+                                                   summary['failed'], len(results)))
+        print("summary: {}".format(self.summary_path))
+
+    def run(self):
+        if not os.path.exists(self.log_path):
+            os.makedirs(self.log_path)
+        jobs = self.get_jobs()
+        start = time.time()
+        # The matrix trace already covers the QEMU build.
+        self.prepare_builds(jobs[0]['args'] + ["--trace", ""])
+        self.print("building {} images with {} workers".format(len(jobs), self._args.jobs))
+        results = []
+        with ProcessPoolExecutor(max_workers=self._args.jobs) as executor:
+            futures = {executor.submit(run_job, job): job for job in jobs}
+            for future in as_completed(futures):
+                job = futures[future]
+                try:
+                    result = future.result()
+                except Exception as e:
+                    result = {'name': job['name'], 'log': job['log'],
+                              'status': "failed", 'duration': 0, 'error': str(e)}
+                self.print("{} {} in {}s, log: {}".format(result['name'], result['status'],
+                                                        result['duration'], result['log']))
+                results.append(result)
+        results.sort(key=lambda r: r['name'])
+        self.write_summary(results, time.time() - start)
+        return 0 if all([r['status'] == "ok" for r in results]) else 1
+
+if __name__ == "__main__":
+    inst_obj = BuildMatrix()
+    exit(inst_obj.run())
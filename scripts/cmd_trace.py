@@ -0,0 +1,124 @@
+#
+# Copyright 2020 Linaro
+#
+# Timing trace of the commands issued by our command objects.
+#
+# Records the wall time, cpu time, peak RSS and exit status of every
+# command, grouped into named phases.  The result is written in the
+# Chrome trace event format, which can be loaded into chrome://tracing
+# or https://ui.perfetto.dev, with a per phase summary in its metadata.
+#
+# Phases can be entered from several threads, like the steps of
+# step_graph.py, so each thread has its own stack of phases.
+#
+
+import os
+import sys
+import json
+import time
+import contextlib
+import threading
+
+class CmdTrace:
+    def __init__(self, trace_path):
+        self.trace_path = trace_path
+        self.pid = os.getpid()
+        self.start_time = time.time()
+        self.events = []
+        self.lanes = set()
+        self.lock = threading.Lock()
+        self.local = threading.local()
+
+    def timestamp(self, t):
+        # Chrome trace timestamps are in microseconds.
+        return int((t - self.start_time) * 1000000)
+
+    @property
+    def phases(self):
+        """The stack of phases of the calling thread."""
+        if not hasattr(self.local, 'phases'):
+            self.local.phases = []
+        return self.local.phases
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        start = time.time()
+        phases = self.phases
+        if not phases:
+            # Phases of the main thread go on thread 0 of the trace,
+            # those of other threads on a lane of their own.
+            main = threading.current_thread() is threading.main_thread()
+            self.local.lane = 0 if main else self.acquire_lane()
+        phases.append(name)
+        try:
+            yield
+        finally:
+            phases.pop()
+            self.add_event({'name': name, 'cat': "phase", 'ph': "X",
+                            'ts': self.timestamp(start),
+                            'dur': self.timestamp(time.time()) - self.timestamp(start),
+                            'pid': self.pid, 'tid': self.local.lane,
+                            'args': {'parent': "/".join(phases)}})
+            if not phases and self.local.lane:
+                self.release_lane(self.local.lane)
+
+    def add_event(self, event):
+        with self.lock:
+            self.events.append(event)
+
+    def acquire_lane(self):
+        # Commands running at the same time are put on separate
+        # threads of the trace, so that the events nest properly.
+        with self.lock:
+            lane = 1
+            while lane in self.lanes:
+                lane += 1
+            self.lanes.add(lane)
+            return lane
+
+    def release_lane(self, lane):
+        with self.lock:
+            self.lanes.discard(lane)
+
+    def add_command(self, cmd, lane):
+        args = {'command': cmd.command,
+                'phase': "/".join(self.phases),
+                'rc': cmd.rc,
+                'timed_out': cmd.timed_out,
+                'wall_s': round(cmd.end_time - cmd.start_time, 3)}
+        if cmd.rusage:
+            args['user_s'] = round(cmd.rusage.ru_utime, 3)
+            args['sys_s'] = round(cmd.rusage.ru_stime, 3)
+            # ru_maxrss is in kilobytes on Linux.
+            args['max_rss_kb'] = cmd.rusage.ru_maxrss
+        name = " ".join(cmd.command.split()[:2])
+        self.add_event({'name': name, 'cat': "cmd", 'ph': "X",
+                        'ts': self.timestamp(cmd.start_time),
+                        'dur': self.timestamp(cmd.end_time) - self.timestamp(cmd.start_time),
+                        'pid': self.pid, 'tid': lane, 'args': args})
+
+    def summary(self):
+        phases = {}
+        for event in self.events:
+            if event['cat'] == "phase":
+                entry = phases.setdefault(event['name'], {'count': 0, 'wall_s': 0})
+                entry['count'] += 1
+                entry['wall_s'] = round(entry['wall_s'] + event['dur'] / 1000000, 3)
+        commands = [e for e in self.events if e['cat'] == "cmd"]
+        return {'script': os.path.basename(sys.argv[0]),
+                'argv': sys.argv[1:],
+                'start_time': self.start_time,
+                'wall_s': round(time.time() - self.start_time, 3),
+                'commands': len(commands),
+                'failed_commands': len([e for e in commands if e['args']['rc'] != 0]),
+                'phases': phases}
+
+    def write(self):
+        trace_dir = os.path.dirname(os.path.abspath(self.trace_path))
+        if not os.path.exists(trace_dir):
+            os.makedirs(trace_dir)
+        with open(self.trace_path, 'w') as f:
+            json.dump({'traceEvents': sorted(self.events, key=lambda e: e['ts']),
+                       'displayTimeUnit': "ms",
+                       'metadata': self.summary()}, f, indent=1)
+        print("{}: trace written to {}".format(sys.argv[0], self.trace_path))
@@ -0,0 +1,462 @@
+#
+# Copyright 2020 Linaro
+#
+# Long running controller keeping VMs warm between requests.
+#
+# controller.py --socket [path] --idle_timeout [seconds]
+#
+#    Serves requests on a Unix socket, normally sent with qemu_ctl.py.
+#    The protocol is that of QMP: a greeting, then one JSON object per
+#    line, {"execute": [request], "arguments": {...}}, answered with
+#    {"return": ...} or {"error": {"desc": ...}}.
+#
+#    Requests:
+#       launch    start a VM, or return the running VM of that name.
+#                 VMs are named by the vm_name argument.
+#       stop      power off a VM.
+#       run       run a command in a VM, over a persistent ssh connection.
+#       snapshot  create the warm start snapshot of an image and config.
+#       list      the VMs and their state.
+#       shutdown  stop all VMs and exit.
+#
+#    VMs not used for idle_timeout seconds are powered off.
+#
+#    The config of each image type, config file and launch arguments is
+#    resolved once, like launch_image.py does, and kept until the config
+#    file changes.  A launch then only writes the files of that VM and
+#    starts the QEMU launcher.  Launches which have to create a snapshot,
+#    or place the guest on the host, run launch_image.py instead.
+#
+
+import sys
+import os
+import argparse
+from argparse import RawTextHelpFormatter
+import copy
+import json
+import shlex
+import signal
+import socket
+import socketserver
+import subprocess
+import threading
+import time
+import yaml
+import base_cmd
+import build_image
+import rtapp_calib
+import run_tests
+import vm_snapshot
+
+class ManagedVM(run_tests.TestVM):
+    """A VM launched by the controller, kept running with a sleeping
+       guest command until it is stopped."""
+
+    def __init__(self, name, path):
+        super(ManagedVM, self).__init__(0, path)
+        self.name = name
+        self.launch_cmd = None
+        self.cwd = None
+        self.cleanup_paths = []
+        self.control_path = os.path.join(path, "ssh-control")
+        self.process = None
+        self.last_used = time.time()
+
+    def reset(self):
+        """Remove the files of a previous launch."""
+        if not os.path.exists(self.path):
+            os.makedirs(self.path)
+        for path in [self.lisa_config_path, self.platform_info_path]:
+            if os.path.exists(path):
+                os.remove(path)
+
+    def start(self):
+        cmd = self.launch_cmd
+        if isinstance(cmd, str):
+            cmd = shlex.split(cmd)
+        with open(self.launch_log_path, 'w') as log:
+            # A session of its own, so the launch and QEMU can be
+            # signalled together.
+            self.process = subprocess.Popen(cmd, cwd=self.cwd, stdout=log,
+                                            stderr=subprocess.STDOUT,
+                                            start_new_session=True)
+
+    def cleanup(self):
+        for path in self.cleanup_paths:
+            if os.path.exists(path):
+                os.remove(path)
+        self.cleanup_paths = []
+
+    def alive(self):
+        return self.process != None and self.process.poll() == None
+
+    def touch(self):
+        self.last_used = time.time()
+
+    def state(self):
+        if not self.alive():
+            return "exited"
+        return "ready" if self.poll_ready() else "booting"
+
+    def info(self):
+        info = {'name': self.name,
+                'state': self.state(),
+                'log': self.launch_log_path,
+                'idle_s': round(time.time() - self.last_used, 1)}
+        if self.lisa_config:
+            info['port'] = self.lisa_config['port']
+            info['target_conf'] = self.target_conf_path
+        return info
+
+    def ssh_cmd(self, command):
+        return ["ssh"] + run_tests.RunTests.ssh_opts.split() + \
+               ["-o", "ControlMaster=auto", "-o", "ControlPath={}".format(self.control_path),
+                "-o", "ControlPersist=600",
+                "-p", str(self.lisa_config['port']), "-i", self.lisa_config['keyfile'],
+                "root@127.0.0.1", command]
+
+class Controller(base_cmd.BaseCmd):
+    build_path_rel = "build"
+    test_vm_path_rel = "external/qemu/tests/vm"
+    default_config_file = "conf/conf_default.yml"
+    guest_cmd = run_tests.RunTests.guest_cmd
+    stop_timeout = 120
+    reap_interval = 10
+    # These act on the host or the guest at launch, only launch_image.py does.
+    launch_image_args = ["--numa_bind", "--pin_vcpus", "--profile_boot", "--cache",
+                         "--rtapp_calib"]
+
+    def __init__(self):
+        super(Controller, self).__init__()
+        self.script_path = os.path.dirname(os.path.realpath(__file__))
+        self.root_path = os.path.realpath(os.path.join(self.script_path, "../"))
+        self.build_path = os.path.join(self.root_path, self.build_path_rel)
+        self.parse_args()
+        self.set_debug(self._args.debug)
+        self.continue_on_error = True
+        self.socket_path = os.path.realpath(self._args.socket)
+        self.state_path = os.path.join(self.build_path, "controller")
+        self.vms = {}
+        self.configs = {}
+        self.launchers = {}
+        # lock guards the VM table and the names being launched,
+        # launchers_lock the resolved configs, so that a slow launch
+        # does not hold up the requests on other VMs.
+        self.lock = threading.Lock()
+        self.launchers_lock = threading.Lock()
+        self.launching = set()
+        self.server = None
+        self.image_types = self.get_image_types()
+
+    def parse_args(self):
+        parser = argparse.ArgumentParser(formatter_class=RawTextHelpFormatter,
+                                         description="Controller keeping VMs warm, "\
+                                         "see qemu_ctl.py.")
+        parser.add_argument("--debug", action="store_true",
+                            help="enable debug output")
+        parser.add_argument("--socket", default=os.path.join(self.build_path, "controller.sock"),
+                            help="Unix socket to serve requests on.\n"\
+                            "default is build/controller.sock")
+        parser.add_argument("--idle_timeout", type=float, default=1800,
+                            help="Seconds after which an unused VM is powered off.\n"\
+                            "default is 1800")
+        self._args = parser.parse_args()
+
+    def get_image_types(self):
+        # Listed once, rather than on every launch.
+        test_vm_path = os.path.join(self.root_path, self.test_vm_path_rel)
+        if not os.path.exists(test_vm_path):
+            return []
+        return sorted([name for name in os.listdir(test_vm_path)
+                       if not name.startswith(("Make", "aarch64", "basevm", "__"))
+                       and os.path.isfile(os.path.join(test_vm_path, name))])
+
+    def get_config(self, path):
+        """The parsed config, only read again when the file changed."""
+        path = os.path.realpath(path)
+        mtime = os.stat(path).st_mtime_ns
+        if path not in self.configs or self.configs[path][0] != mtime:
+            with open(path) as f:
+                yaml_dict = yaml.safe_load(f)
+            if 'qemu-conf' not in yaml_dict:
+                raise Exception("config file {} format is invalid.".format(path))
+            self.configs[path] = (mtime, yaml_dict)
+        return self.configs[path][1]
+
+    @staticmethod
+    def get_stamp(paths):
+        return [os.stat(path).st_mtime_ns if os.path.exists(path) else None for path in paths]
+
+    def get_launcher(self, image_type, config, launch_args):
+        """The BuildImage of launch_image.py with its config resolved,
+           resolved again only when the config files changed."""
+        with self.launchers_lock:
+            return self._get_launcher(image_type, config, launch_args)
+
+    def _get_launcher(self, image_type, config, launch_args):
+        config = os.path.realpath(config)
+        key = (image_type, config, tuple(launch_args))
+        if key in self.launchers:
+            paths, stamp, launcher = self.launchers[key]
+            if self.get_stamp(paths) == stamp:
+                return launcher
+        args = ["--image_type", image_type, "--config", config, "--ssh_port", "auto",
+                "--guest_cmd", self.guest_cmd] + list(launch_args)
+        try:
+            launcher = build_image.BuildImage(ssh=True, args=args)
+            if not os.path.exists(launcher.image_path):
+                raise Exception("image {} does not exist, "\
+                                "build it with build_image.py".format(launcher.image_path))
+            launcher.parse_config_file(launcher.vm_config_path)
+        except SystemExit:
+            raise Exception("could not resolve config {} for {}".format(config, image_type))
+        # Only a cached calibration, measuring one is left to launch_image.py.
+        launcher.rtapp_calib = rtapp_calib.CalibrationCache(launcher.image_dir_path,
+                                                            launcher.image_path,
+                                                            launcher.yaml_dict).lookup()
+        paths = [config, launcher.vm_config_path, launcher.image_path]
+        self.launchers[key] = (paths, self.get_stamp(paths), launcher)
+        self.print("resolved {} for {}".format(launcher.vm_config_path, image_type))
+        return launcher
+
+    def prepare_launch(self, vm, launcher, snapshot):
+        """Write the files of a launch of vm on an overlay and set its
+           launch command.  Returns False if there is no snapshot yet."""
+        launch = copy.copy(launcher)
+        launch.yaml_dict = copy.deepcopy(launcher.yaml_dict)
+        launch.new_run_id()
+        launch.ssh_port = launch.get_free_port()
+        launch.yaml_dict['qemu-conf']['ssh_port'] = launch.ssh_port
+        launch.lisa_config_path = vm.lisa_config_path
+        if snapshot:
+            snap = vm_snapshot.VMSnapshot(launch.image_dir_path, launch.image_path,
+                                          launch.yaml_dict, launch.qemu_build_path)
+            if not snap.valid():
+                return False
+            extra_args = "-incoming exec:cat<{} {}".format(snap.state_path,
+                                                           launch.get_launch_args())
+            config_path = snap.write_config(extra_args, launch.get_run_path("conf.yml"))
+            backing_path = snap.disk_path
+        else:
+            config_path = launch.write_launch_config()
+            backing_path = launch.image_path
+        overlay_path = launch.get_run_path("overlay.qcow2")
+        vm.cleanup_paths = [config_path, overlay_path]
+        if launch.console_path and not launch._args.console_log:
+            vm.cleanup_paths.append(launch.console_path)
+        try:
+            launch.create_overlay(backing_path, overlay_path)
+        except SystemExit:
+            vm.cleanup()
+            raise Exception("could not create overlay {}".format(overlay_path))
+        launch.write_current_config()
+        vm.launch_cmd = launch.get_launch_cmd(config_path, overlay_path, launch.get_guest_cmd())
+        vm.cwd = launch.qemu_build_path
+        return True
+
+    def get_launch_cmd(self, name, path, image_type, config, snapshot, launch_args):
+        with self.launchers_lock:
+            self.get_config(config)
+        cmd = [sys.executable, os.path.join(self.script_path, "launch_image.py"),
+               "--image_type", image_type, "--config", os.path.realpath(config),
+               "--ssh_port", "auto", "--lisa_config", os.path.join(path, "target_vm.yml"),
+               "--guest_cmd", self.guest_cmd]
+        cmd.append("--snapshot" if snapshot else "--overlay")
+        return cmd + list(launch_args)
+
+    def get_vm(self, name):
+        if name not in self.vms:
+            raise Exception("no VM named {}".format(name))
+        vm = self.vms[name]
+        vm.touch()
+        return vm
+
+    def wait_ready(self, vm, timeout):
+        deadline = time.time() + timeout
+        while not vm.poll_ready():
+            if not vm.alive():
+                raise Exception("VM {} exited before it was ready, see {}".format(vm.name,
+                                vm.launch_log_path))
+            if time.time() > deadline:
+                raise Exception("VM {} not ready after {}s".format(vm.name, timeout))
+            time.sleep(0.2)
+        if not os.path.exists(vm.target_conf_path):
+            vm.write_target_conf()
+
+    def do_launch(self, vm_name, image_type="ubuntu.aarch64", config=None, snapshot=False,
+                  wait=True, timeout=1800, launch_args=[]):
+        with self.lock:
+            vm = self.vms.get(vm_name)
+            running = vm and vm.alive()
+            if running:
+                vm.touch()
+            elif vm_name in self.launching:
+                raise Exception("VM {} is already being launched".format(vm_name))
+            else:
+                # Exited on its own, like after a poweroff in the guest.
+                exited = self.vms.pop(vm_name, None)
+                self.launching.add(vm_name)
+        if not running:
+            try:
+                if exited:
+                    exited.cleanup()
+                vm = self.start_launch(vm_name, image_type, config, snapshot, launch_args)
+            except BaseException:
+                with self.lock:
+                    self.launching.discard(vm_name)
+                raise
+            with self.lock:
+                self.vms[vm_name] = vm
+                self.launching.discard(vm_name)
+        if wait:
+            self.wait_ready(vm, timeout)
+        return vm.info()
+
+    def start_launch(self, vm_name, image_type, config, snapshot, launch_args):
+        """Start a new VM, without holding the lock of the VM table."""
+        if self.image_types and image_type not in self.image_types:
+            raise Exception("unknown image type {}, valid types: {}".format(image_type,
+                            " ".join(self.image_types)))
+        config = config or os.path.join(self.root_path, self.default_config_file)
+        vm = ManagedVM(vm_name, os.path.join(self.state_path, vm_name))
+        vm.reset()
+        if any(arg.split("=")[0] in self.launch_image_args for arg in launch_args) or \
+           not self.prepare_launch(vm, self.get_launcher(image_type, config, launch_args),
+                                   snapshot):
+            vm.launch_cmd = self.get_launch_cmd(vm_name, vm.path, image_type, config,
+                                                snapshot, launch_args)
+        vm.start()
+        cmd = vm.launch_cmd
+        self.print("{} launching: {}".format(vm_name, cmd if isinstance(cmd, str)
+                                                      else " ".join(cmd)))
+        return vm
+
+    def do_stop(self, vm_name):
+        with self.lock:
+            vm = self.get_vm(vm_name)
+            del self.vms[vm_name]
+        self.stop_vm(vm)
+        return {'name': vm_name, 'state': "stopped"}
+
+    def stop_vm(self, vm):
+        if vm.alive() and vm.poll_ready():
+            subprocess.run(vm.ssh_cmd("poweroff"), stdout=subprocess.DEVNULL,
+                           stderr=subprocess.DEVNULL)
+            try:
+                vm.process.wait(timeout=self.stop_timeout)
+            except subprocess.TimeoutExpired:
+                pass
+        if vm.alive():
+            os.killpg(vm.process.pid, signal.SIGTERM)
+            vm.process.wait()
+        vm.cleanup()
+        self.print("{} stopped".format(vm.name))
+
+    def do_run(self, vm_name, command, timeout=None):
+        vm = self.get_vm(vm_name)
+        if vm.state() != "ready":
+            raise Exception("VM {} is {}".format(vm_name, vm.state()))
+        start = time.time()
+        try:
+            result = subprocess.run(vm.ssh_cmd(command), stdout=subprocess.PIPE,
+                                    stderr=subprocess.PIPE, timeout=timeout)
+        except subprocess.TimeoutExpired:
+            raise Exception("command timed out after {}s".format(timeout))
+        vm.touch()
+        return {'rc': result.returncode,
+                'stdout': result.stdout.decode(errors='replace'),
+                'stderr': result.stderr.decode(errors='replace'),
+                'duration': round(time.time() - start, 3)}
+
+    def do_snapshot(self, image_type="ubuntu.aarch64", config=None, launch_args=[]):
+        # A launch with --snapshot creates the snapshot if there is none,
+        # so later launches with snapshot restore it.
+        path = os.path.join(self.state_path, "snapshot-" + image_type)
+        cmd = self.get_launch_cmd("snapshot", path, image_type,
+                                  config or os.path.join(self.root_path, self.default_config_file),
+                                  True, launch_args)
+        cmd[cmd.index("--guest_cmd") + 1] = "true"
+        if not os.path.exists(path):
+            os.makedirs(path)
+        log_path = os.path.join(path, "snapshot.log")
+        with open(log_path, 'w') as log:
+            rc = subprocess.call(cmd, stdout=log, stderr=subprocess.STDOUT)
+        if rc != 0:
+            raise Exception("snapshot failed with status {}, see {}".format(rc, log_path))
+        return {'image_type': image_type, 'log': log_path}
+
+    def do_list(self):
+        with self.lock:
+            return [vm.info() for vm in self.vms.values()]
+
+    def do_shutdown(self):
+        threading.Thread(target=self.shutdown).start()
+        return {}
+
+    def shutdown(self):
+        with self.lock:
+            vms = list(self.vms.values())
+            self.vms = {}
+        for vm in vms:
+            self.stop_vm(vm)
+        self.server.shutdown()
+
+    def reap_idle(self):
+        while True:
+            time.sleep(self.reap_interval)
+            with self.lock:
+                idle = [vm for vm in self.vms.values()
+                        if not vm.alive() or time.time() - vm.last_used > self._args.idle_timeout]
+                for vm in idle:
+                    del self.vms[vm.name]
+            for vm in idle:
+                self.print("{} idle or exited, stopping".format(vm.name))
+                self.stop_vm(vm)
+
+    def handle(self, request):
+        try:
+            handler = getattr(self, "do_" + request.get('execute', ""), None)
+            if request.get('execute') == "qmp_capabilities":
+                return {'return': {}}
+            if handler == None:
+                raise Exception("unknown request {}".format(request.get('execute')))
+            return {'return': handler(**request.get('arguments', {}))}
+        except Exception as e:
+            return {'error': {'class': type(e).__name__, 'desc': str(e)}}
+
+    def run(self):
+        controller = self
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                greeting = {'QMP': {'version': "lisa-qemu controller",
+                                    'image_types': controller.image_types}}
+                self.wfile.write(json.dumps(greeting).encode() + b"\n")
+                for line in self.rfile:
+                    response = controller.handle(json.loads(line))
+                    self.wfile.write(json.dumps(response).encode() + b"\n")
+        if not os.path.exists(self.state_path):
+            os.makedirs(self.state_path)
+        if os.path.exists(self.socket_path):
+            try:
+                with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+                    sock.connect(self.socket_path)
+                self.print("a controller is already serving on {}".format(self.socket_path))
+                return 1
+            except ConnectionRefusedError:
+                # Left over from a controller which did not exit cleanly.
+                os.remove(self.socket_path)
+        self.server = socketserver.ThreadingUnixStreamServer(self.socket_path, Handler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.reap_idle, daemon=True).start()
+        signal.signal(signal.SIGTERM, lambda signum, frame: self.do_shutdown())
+        self.print("serving on {}".format(self.socket_path))
+        try:
+            self.server.serve_forever()
+        finally:
+            self.server.server_close()
+            os.remove(self.socket_path)
+        return 0
+
+if __name__ == "__main__":
+    inst_obj = Controller()
+    exit(inst_obj.run())
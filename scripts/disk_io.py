@@ -0,0 +1,109 @@
+#
+# Copyright 2020 Linaro
+#
+# How the image drive is attached to the guest.
+#
+# The launcher in external/qemu/tests/vm creates the drive itself as
+#   -drive file=[image],if=none,id=drive0 -device virtio-blk,drive=drive0
+# so its options are changed with -set and -global arguments.
+# The drive options are set on drive0 only.  The device has no id for
+# -set to name it, so the iothread and queues of the device are set with
+# -global, which applies to every virtio-blk-pci device.  These are left
+# out of the image build, whose boot also attaches the cloud-init seed,
+# and refused when qemu_args attach other virtio-blk drives.
+#
+# qemu-conf keys:
+#    disk_io:         benchmark, selects all of the below for throughput.
+#    drive_iothread:  true, to run the drive in its own iothread instead
+#                     of the main QEMU loop.
+#    drive_aio:       io_uring, native or threads.  benchmark falls back
+#                     to native when QEMU is not built with liburing.
+#    drive_cache:     none or writeback.
+#    drive_queues:    auto (one per vCPU) or a number of virtio-blk queues.
+#    drive_discard:   unmap or ignore.
+#
+
+import os
+import re
+
+drive_id = "drive0"
+device_type = "virtio-blk-pci"
+iothread_id = "lisa-iothread0"
+# Drives of qemu_args which would also get the -global properties.
+virtio_blk_re = re.compile(r"-device\s+virtio-blk|if=virtio")
+
+benchmark_defaults = {'drive_iothread': True,
+                      'drive_aio': "io_uring",
+                      'drive_cache': "none",
+                      'drive_queues': "auto",
+                      'drive_discard': "unmap"}
+
+valid_values = {'drive_aio': ["io_uring", "native", "threads"],
+                'drive_cache': ["none", "writeback"],
+                'drive_discard': ["unmap", "ignore"]}
+
+def io_uring_supported(qemu_build_path):
+    """Whether the QEMU build has io_uring, None if it is not built yet."""
+    found = False
+    for name in ["config-host.mak", "config-host.h"]:
+        path = os.path.join(qemu_build_path, name)
+        if not os.path.exists(path):
+            continue
+        found = True
+        with open(path) as f:
+            if re.search(r"^(CONFIG_LINUX_IO_URING=y|#define CONFIG_LINUX_IO_URING 1)$",
+                         f.read(), re.MULTILINE):
+                return True
+    return False if found else None
+
+def get_drive_settings(conf, io_uring=True):
+    """The drive settings of conf.  io_uring tells whether QEMU supports
+       it, False or None (unknown) picks native aio for benchmark."""
+    settings = {}
+    if conf.get('disk_io') == "benchmark":
+        settings.update(benchmark_defaults)
+        if not io_uring:
+            # Valid as the benchmark settings use cache=none.
+            settings['drive_aio'] = "native"
+    elif conf.get('disk_io') not in [None, "default"]:
+        raise ValueError("invalid disk_io: {}".format(conf['disk_io']))
+    for key in benchmark_defaults:
+        if key in conf:
+            settings[key] = conf[key]
+    for key, values in valid_values.items():
+        if key in settings and settings[key] not in values:
+            raise ValueError("invalid {}: {}, valid values: {}".format(key, settings[key],
+                                                                       ", ".join(values)))
+    if settings.get('drive_aio') == "native" and settings.get('drive_cache') != "none":
+        raise ValueError("drive_aio: native requires drive_cache: none")
+    if settings.get('drive_aio') == "io_uring" and io_uring == False:
+        raise ValueError("drive_aio: io_uring requires QEMU built with liburing")
+    return settings
+
+def get_drive_args(conf, io_uring=True):
+    """Return the qemu arguments for the settings of the image drive in conf."""
+    settings = get_drive_settings(conf, io_uring)
+    args = []
+    for key in ['aio', 'cache', 'discard']:
+        if 'drive_' + key in settings:
+            args.append("-set drive.{}.{}={}".format(drive_id, key, settings['drive_' + key]))
+    return " ".join(args)
+
+def get_device_args(conf, vcpus, qemu_args=""):
+    """Return the qemu arguments for the settings of the image device in conf.
+       qemu_args are the other arguments of the launch, which must not
+       attach other virtio-blk drives."""
+    settings = get_drive_settings(conf)
+    args = []
+    if settings.get('drive_iothread'):
+        args += ["-object iothread,id={}".format(iothread_id),
+                 "-global {}.iothread={}".format(device_type, iothread_id)]
+    queues = settings.get('drive_queues')
+    if queues:
+        if queues == "auto":
+            queues = vcpus
+        args.append("-global {}.num-queues={}".format(device_type, int(queues)))
+    if args and virtio_blk_re.search(qemu_args):
+        raise ValueError("drive_iothread and drive_queues need the image to be "\
+                         "the only virtio-blk drive of qemu_args")
+    return " ".join(args)
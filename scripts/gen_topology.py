@@ -0,0 +1,194 @@
+#
+# Copyright 2020 Linaro
+#
+# Expands the topology spec of a config file, and benchmarks how the
+# guest scales with the number of vCPUs and NUMA nodes.
+#
+# gen_topology.py --config [config yaml] --output [config yaml] --platform_info [yaml]
+#
+#    Validates the topology of the config, see scripts/numa_topology.py,
+#    and writes a config with the generated qemu_args and
+#    the matching LISA platform-info block.
+#
+# gen_topology.py --benchmark --scale 16:2 64:4 256:8 -- [launch_image.py args]
+#
+#    Launches the image once per vCPUs:nodes point, and reports the
+#    time until ssh is ready and the peak RSS of QEMU for each.
+#
+
+import sys
+import os
+import argparse
+from argparse import RawTextHelpFormatter
+import time
+import yaml
+import base_cmd
+import build_image
+import numa_topology
+from host_topology import TopologyError
+
+class GenTopology(base_cmd.BaseCmd):
+    build_path_rel = "build"
+    default_config_file = "conf/conf_aarch64_256core_8numa.yml"
+
+    def __init__(self):
+        super(GenTopology, self).__init__()
+        self.script_path = os.path.dirname(os.path.realpath(__file__))
+        self.root_path = os.path.realpath(os.path.join(self.script_path, "../"))
+        self.build_path = os.path.join(self.root_path, self.build_path_rel)
+        self.parse_args()
+        self.set_debug(self._args.debug)
+        self.set_dry_run(self._args.dry_run)
+        self.continue_on_error = False
+        self.config_path = os.path.realpath(self._args.config)
+        self.log_path = os.path.realpath(self._args.log_dir)
+        self.results_path = os.path.join(self.log_path, "results.yml")
+
+    def parse_args(self):
+        parser = argparse.ArgumentParser(formatter_class=RawTextHelpFormatter,
+                                         description="Generate a guest topology from the topology\n"\
+                                         "spec of a config, or benchmark topologies.",
+                                         epilog="examples:\n"\
+                                         "    {0} --config conf/conf_aarch64_256core_8numa.yml "\
+                                         "--output build/conf_256.yml\n"\
+                                         "    {0} --benchmark --scale 16:2 64:4 256:8 "\
+                                         "-- --accel tcg\n".format(sys.argv[0]))
+        parser.add_argument("--debug", action="store_true",
+                            help="enable debug output")
+        parser.add_argument("--dry_run", action="store_true",
+                            help="Just show commands issued by the benchmark, do not execute them.")
+        parser.add_argument("--config", default=os.path.join(self.root_path,
+                                                             self.default_config_file),
+                            help="config file with a topology in qemu-conf.\n"\
+                            "default is {}".format(self.default_config_file))
+        parser.add_argument("--output", default="",
+                            help="Write the config with the generated qemu_args\n"\
+                            "in place of the topology to this file.")
+        parser.add_argument("--platform_info", default="",
+                            help="Write the LISA platform-info block to this file.")
+        parser.add_argument("--benchmark", action="store_true",
+                            help="Launch the image with each topology of --scale\n"\
+                            "and report boot time and QEMU memory use.")
+        parser.add_argument("--scale", nargs="+", default=["8:1", "16:2", "64:4", "128:8", "256:8"],
+                            help="vCPUs:nodes points of the benchmark.\n"\
+                            "default is 8:1 16:2 64:4 128:8 256:8")
+        parser.add_argument("--log_dir", default=os.path.join(self.build_path, "topology"),
+                            help="Directory for the benchmark configs and results.\n"\
+                            "default is build/topology")
+        parser.add_argument("launch_args", nargs=argparse.REMAINDER,
+                            help="Arguments after -- are passed to launch_image.py")
+        self._args = parser.parse_args()
+        if self._args.launch_args and self._args.launch_args[0] == "--":
+            self._args.launch_args = self._args.launch_args[1:]
+
+    def load_config(self):
+        with open(self.config_path) as f:
+            yaml_dict = yaml.safe_load(f)
+        if 'qemu-conf' not in yaml_dict:
+            raise Exception("config file {} format is invalid.".format(self.config_path))
+        return yaml_dict
+
+    def get_topology(self, conf):
+        try:
+            return numa_topology.NumaTopology(conf['topology'], conf['memory'],
+                                              conf.get('machine', ""))
+        except TopologyError as e:
+            self.print("topology is invalid: {}".format(e))
+            self.terminate(1)
+
+    def generate(self):
+        yaml_dict = self.load_config()
+        conf = yaml_dict['qemu-conf']
+        if 'topology' not in conf:
+            self.print("config file {} has no topology".format(self.config_path))
+            self.terminate(1)
+        topology = self.get_topology(conf)
+        qemu_args = numa_topology.strip_topology_args(conf.get('qemu_args', ""))
+        conf['qemu_args'] = "{} {}".format(topology.get_qemu_args(), qemu_args).strip()
+        del conf['topology']
+        print(yaml.dump(topology.describe(), default_flow_style=None), end="")
+        print("qemu_args: {}".format(conf['qemu_args']))
+        if self._args.output:
+            with open(self._args.output, 'w') as f:
+                yaml.dump(yaml_dict, f)
+            self.print("config {} written".format(self._args.output))
+        if self._args.platform_info:
+            with open(self._args.platform_info, 'w') as f:
+                yaml.dump({'conf': topology.get_platform_info()}, f)
+            self.print("platform info {} written".format(self._args.platform_info))
+        return 0
+
+    def write_point_config(self, vcpus, nodes):
+        # The topology of a point is a single socket split into nodes,
+        # so that only the vCPU and node counts change between points.
+        yaml_dict = self.load_config()
+        conf = yaml_dict['qemu-conf']
+        conf['qemu_args'] = numa_topology.strip_topology_args(conf.get('qemu_args', ""))
+        conf['topology'] = {'sockets': 1, 'cores': vcpus, 'nodes': nodes}
+        self.get_topology(conf)
+        config_path = os.path.join(self.log_path, "conf-{}cpu-{}node.yml".format(vcpus, nodes))
+        with open(config_path, 'w') as f:
+            yaml.dump(yaml_dict, f)
+        return config_path
+
+    def run_point(self, vcpus, nodes):
+        name = "{}cpu-{}node".format(vcpus, nodes)
+        result = {'vcpus': vcpus, 'nodes': nodes, 'status': "failed"}
+        args = ["--config", self.write_point_config(vcpus, nodes),
+                "--overlay", "--ssh_port", "auto", "--guest_cmd", "true", "--rtapp_calib", "off",
+                "--lisa_config", os.path.join(self.log_path, "lisa-{}.yml".format(name)),
+                "--trace", ""]
+        if self._debug:
+            args.append("--debug")
+        if self._dry_run:
+            args.append("--dry_run")
+        start = time.time()
+        try:
+            inst_obj = build_image.BuildImage(ssh=True, args=args + self._args.launch_args)
+            inst_obj.run()
+            report = inst_obj.boot_report or {}
+            result['ssh_ready_s'] = report.get('ssh_ready_s')
+            result['max_rss_mb'] = report.get('max_rss_mb')
+            if result['ssh_ready_s'] != None or self._dry_run:
+                result['status'] = "ok"
+        except SystemExit as e:
+            self.print("launch of {} exited with status: {}".format(name, e.code))
+        finally:
+            os.chdir(self.root_path)
+        result['duration'] = round(time.time() - start, 1)
+        return result
+
+    def write_results(self, results):
+        with open(self.results_path, 'w') as f:
+            yaml.dump({'config': self.config_path, 'points': results}, f)
+        print("")
+        print("{:>6} {:>6} {:>8} {:>12} {:>12} {:>14}".format("vcpus", "nodes", "status",
+                                                            "ssh ready", "max rss",
+                                                            "rss per vcpu"))
+        for r in results:
+            rss = r.get('max_rss_mb')
+            print("{:>6} {:>6} {:>8} {:>11}s {:>10}MB {:>12}MB"\
+                  .format(r['vcpus'], r['nodes'], r['status'], r.get('ssh_ready_s', "-"),
+                          rss if rss != None else "-",
+                          round(rss / r['vcpus'], 1) if rss != None else "-"))
+        print("results: {}".format(self.results_path))
+
+    def benchmark(self):
+        if not os.path.exists(self.log_path):
+            os.makedirs(self.log_path)
+        results = []
+        for point in self._args.scale:
+            vcpus, nodes = [int(value) for value in point.split(":")]
+            self.print("launching {} vCPUs in {} nodes".format(vcpus, nodes))
+            results.append(self.run_point(vcpus, nodes))
+        self.write_results(results)
+        return 0 if all([r['status'] == "ok" for r in results]) else 1
+
+    def run(self):
+        if self._args.benchmark:
+            return self.benchmark()
+        return self.generate()
+
+if __name__ == "__main__":
+    inst_obj = GenTopology()
+    exit(inst_obj.run())
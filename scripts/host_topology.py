@@ -0,0 +1,204 @@
+#
+# Copyright 2020 Linaro
+#
+# Host NUMA topology and placement of the guest NUMA nodes on it.
+#
+# Used by launch_image.py to bind the memory of each guest NUMA node
+# to a host node and to pin each vCPU thread to a dedicated host core,
+# so that guest NUMA experiments are not disturbed by the host scheduler.
+#
+
+import os
+import re
+import glob
+
+class TopologyError(Exception):
+    pass
+
+def parse_cpulist(cpulist):
+    """Parse a cpu list like 0-3,8,10-11 into a list of ints."""
+    cpus = []
+    for entry in cpulist.strip().split(","):
+        if not entry:
+            continue
+        if "-" in entry:
+            first, last = entry.split("-")
+            cpus += list(range(int(first), int(last) + 1))
+        else:
+            cpus.append(int(entry))
+    return cpus
+
+def parse_size(size):
+    """Parse a QEMU style size like 16G or 512M into bytes."""
+    match = re.match(r"^(\d+(?:\.\d+)?)([KMGT]?)B?$", str(size).strip().upper())
+    if not match:
+        raise TopologyError("invalid size {}".format(size))
+    shift = {'': 20, 'K': 10, 'M': 20, 'G': 30, 'T': 40}[match.group(2)]
+    # A size without a suffix is in MB, like -m.
+    return int(float(match.group(1)) * (1 << shift))
+
+def get_smp_cpus(qemu_args):
+    """Number of vCPUs given by -smp in qemu_args."""
+    args = qemu_args.split()
+    for index, arg in enumerate(args[:-1]):
+        if arg == "-smp":
+            for opt in args[index + 1].split(","):
+                if opt.startswith("cpus="):
+                    return int(opt[len("cpus="):])
+                if opt.isdigit():
+                    return int(opt)
+    return 1
+
+class HostTopology:
+    node_path = "/sys/devices/system/node"
+
+    def __init__(self):
+        self.nodes = {}
+        for path in sorted(glob.glob(os.path.join(self.node_path, "node[0-9]*"))):
+            node = int(os.path.basename(path)[len("node"):])
+            with open(os.path.join(path, "cpulist")) as f:
+                cpus = parse_cpulist(f.read())
+            if not cpus:
+                # Memory only node.
+                continue
+            self.nodes[node] = {'cpus': cpus,
+                                'mem_free': self.read_meminfo(path, "MemFree"),
+                                'hugepages': self.read_hugepages(path)}
+        if not self.nodes:
+            # No NUMA support in the host kernel, treat it as one node.
+            self.nodes[0] = {'cpus': sorted(os.sched_getaffinity(0)),
+                             'mem_free': self.read_meminfo(None, "MemFree"),
+                             'hugepages': {}}
+
+    @staticmethod
+    def read_meminfo(node_path, field):
+        path = os.path.join(node_path, "meminfo") if node_path else "/proc/meminfo"
+        with open(path) as f:
+            for line in f:
+                if field + ":" in line:
+                    # Values are in kB.
+                    return int(line.split(field + ":")[1].split()[0]) * 1024
+        return 0
+
+    @staticmethod
+    def read_hugepages(node_path):
+        """Returns {page size in bytes: free pages}."""
+        hugepages = {}
+        for path in glob.glob(os.path.join(node_path, "hugepages", "hugepages-*kB")):
+            size = int(os.path.basename(path)[len("hugepages-"):-len("kB")]) * 1024
+            with open(os.path.join(path, "free_hugepages")) as f:
+                hugepages[size] = int(f.read())
+        return hugepages
+
+class GuestNumaLayout:
+    """The NUMA layout of the guest as described by qemu_args and memory."""
+
+    def __init__(self, qemu_args, memory):
+        self.args = qemu_args.split()
+        self.nodes = []
+        backend_sizes = {}
+        for index, arg in enumerate(self.args[:-1]):
+            if arg == "-object" and self.args[index + 1].startswith("memory-backend-"):
+                opts = self.parse_opts(self.args[index + 1])
+                backend_sizes[opts.get('id', [""])[0]] = parse_size(opts['size'][0])
+        for index, arg in enumerate(self.args[:-1]):
+            if arg == "-numa" and self.args[index + 1].startswith("node"):
+                opts = self.parse_opts(self.args[index + 1])
+                cpus = []
+                for cpulist in opts.get('cpus', []):
+                    cpus += parse_cpulist(cpulist)
+                memdev = opts.get('memdev', [None])[0]
+                self.nodes.append({'nodeid': int(opts.get('nodeid', [len(self.nodes)])[0]),
+                                   'cpus': cpus,
+                                   'size': backend_sizes.get(memdev)})
+        if not self.nodes:
+            # No NUMA in the guest, so it is a single node with all the vCPUs.
+            self.nodes.append({'nodeid': 0, 'cpus': list(range(get_smp_cpus(qemu_args))),
+                               'size': parse_size(memory), 'implicit': True})
+        # Nodes without a sized backend share what is left of the memory.
+        unsized = [node for node in self.nodes if node['size'] == None]
+        if unsized:
+            remaining = parse_size(memory) - sum([n['size'] for n in self.nodes if n['size']])
+            for node in unsized:
+                node['size'] = remaining // len(unsized)
+
+    @staticmethod
+    def parse_opts(opts):
+        """Parse QEMU options like node,cpus=0-3,cpus=8,nodeid=0.
+           Keys can repeat, so values are lists."""
+        result = {}
+        for opt in opts.split(",")[1:]:
+            if "=" in opt:
+                key, value = opt.split("=", 1)
+                result.setdefault(key, []).append(value)
+        return result
+
+    def place(self, host, memory_type="ram", pin=False):
+        """Map each guest node to a host node.  Guest nodes are spread
+           round robin over the host nodes.  Raises TopologyError if the
+           host cannot provide the memory or the dedicated cores."""
+        host_nodes = sorted(host.nodes)
+        mem_needed = {node: 0 for node in host_nodes}
+        cores_free = {node: list(host.nodes[node]['cpus']) for node in host_nodes}
+        placement = []
+        for index, node in enumerate(self.nodes):
+            host_node = host_nodes[index % len(host_nodes)]
+            mem_needed[host_node] += node['size']
+            cores = []
+            if pin:
+                if len(cores_free[host_node]) < len(node['cpus']):
+                    raise TopologyError("host node {} has {} free cores, guest node {} "\
+                                        "needs {}".format(host_node, len(cores_free[host_node]),
+                                                          node['nodeid'], len(node['cpus'])))
+                cores = cores_free[host_node][:len(node['cpus'])]
+                cores_free[host_node] = cores_free[host_node][len(node['cpus']):]
+            placement.append({'nodeid': node['nodeid'], 'host_node': host_node,
+                              'size': node['size'],
+                              'vcpus': dict(zip(node['cpus'], cores))})
+        for host_node, needed in mem_needed.items():
+            if memory_type == "hugepages":
+                available = sum([size * free for size, free in
+                                 host.nodes[host_node]['hugepages'].items()])
+            else:
+                available = host.nodes[host_node]['mem_free']
+            if needed > available:
+                raise TopologyError("host node {} has {} MB of free {} memory, "\
+                                    "guest needs {} MB".format(host_node, available >> 20,
+                                                               memory_type, needed >> 20))
+        return placement
+
+    def get_qemu_args(self, placement, memory_type="ram"):
+        """Return qemu_args with one memory backend bound to its host node
+           per guest node, or for the whole memory of a guest without
+           NUMA nodes.  Any memory backends in the original args are
+           replaced."""
+        backend = {'ram': "memory-backend-ram",
+                   'memfd': "memory-backend-memfd",
+                   'hugepages': "memory-backend-memfd,hugetlb=on,prealloc=on"}[memory_type]
+        args = []
+        skip = False
+        nodes = {p['nodeid']: p for p in placement}
+        for index, arg in enumerate(self.args):
+            if skip:
+                skip = False
+                continue
+            next_arg = self.args[index + 1] if index + 1 < len(self.args) else ""
+            if arg == "-object" and next_arg.startswith("memory-backend-"):
+                skip = True
+                continue
+            if arg == "-numa" and next_arg.startswith("node"):
+                opts = [o for o in next_arg.split(",") if not o.startswith("memdev=")]
+                nodeid = int(self.parse_opts(next_arg).get('nodeid', [0])[0])
+                args += [arg, ",".join(opts + ["memdev=lisa-ram-node{}".format(nodeid)])]
+                skip = True
+                continue
+            args.append(arg)
+        for nodeid, p in sorted(nodes.items()):
+            args += ["-object", "{},size={}M,policy=bind,host-nodes={},"\
+                     "id=lisa-ram-node{}".format(backend, p['size'] >> 20,
+                                                 p['host_node'], nodeid)]
+        if self.nodes[0].get('implicit'):
+            # Without guest NUMA nodes, the backend is the main memory of
+            # the machine.  -machine options are merged with the others.
+            args += ["-machine", "memory-backend=lisa-ram-node0"]
+        return " ".join(args)
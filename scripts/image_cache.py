@@ -0,0 +1,218 @@
+#
+# Copyright 2020 Linaro
+#
+# Content addressed cache of images built by build_image.py.
+#
+# Each cache slot is a directory under build/image-cache named by
+# the hash of everything which determines the contents of the image.
+# A slot is only considered valid once its metadata file is written,
+# which happens after the image was built successfully.
+# Slots still being built, and slots which a link or a qcow2 overlay
+# under the build directory still points into, are never evicted.
+#
+
+import os
+import fcntl
+import shutil
+import hashlib
+import struct
+import time
+import yaml
+
+class ImageCache:
+    metadata_name = "cache.yml"
+    lock_name = ".lock"
+    qcow2_magic = b"QFI\xfb"
+    ignored_keys = ['ssh_key', 'ssh_pub_key', 'ssh_port',
+                    'accel', 'accel_selected', 'accel_args',
+                    'disk_io', 'drive_iothread', 'drive_aio', 'drive_cache',
+                    'drive_queues', 'drive_discard', 'drive_args', 'drive_device_args']
+    generated_args_keys = ['accel_args', 'drive_args']
+
+    def __init__(self, cache_path, max_size_gb, print_fn=print, ref_paths=None):
+        self.cache_path = cache_path
+        self.max_size = int(max_size_gb * 1024 * 1024 * 1024)
+        self.print = print_fn
+        # Where to look for links and overlays using the cached images,
+        # by default the build directory holding the cache.
+        if ref_paths == None:
+            ref_paths = [os.path.dirname(os.path.realpath(cache_path))]
+        self.ref_paths = ref_paths
+
+    @staticmethod
+    def compute_key(yaml_dict, image_type, qemu_rev, extra_files=[]):
+        """Return the cache key for the resolved config, image type
+           and qemu revision.  The contents of extra_files, such as
+           the ssh keys, are also part of the key."""
+        sha = hashlib.sha256()
+        sha.update(image_type.encode())
+        sha.update(qemu_rev.encode())
+        # Key paths and the ssh port do not change the image contents.
+        yaml_dict = dict(yaml_dict)
+        if 'qemu-conf' in yaml_dict:
+            conf = yaml_dict['qemu-conf']
+            yaml_dict['qemu-conf'] = {k: v for k, v in conf.items()
+                                      if k not in ImageCache.ignored_keys}
+            # Neither do the accelerator and drive settings it was built with.
+            for key in ImageCache.generated_args_keys:
+                if conf.get(key) and 'qemu_args' in yaml_dict['qemu-conf']:
+                    yaml_dict['qemu-conf']['qemu_args'] = \
+                        yaml_dict['qemu-conf']['qemu_args'].replace(conf[key], "").strip()
+        sha.update(yaml.dump(yaml_dict).encode())
+        for file in extra_files:
+            if os.path.exists(file):
+                with open(file, 'rb') as f:
+                    sha.update(f.read())
+        return sha.hexdigest()[:16]
+
+    def slot_path(self, key):
+        return os.path.join(self.cache_path, key)
+
+    def metadata_path(self, key):
+        return os.path.join(self.slot_path(key), self.metadata_name)
+
+    def image_path(self, key, image_name):
+        return os.path.join(self.slot_path(key), image_name)
+
+    def read_metadata(self, key):
+        path = self.metadata_path(key)
+        if not os.path.exists(path):
+            return None
+        with open(path) as f:
+            return yaml.safe_load(f)
+
+    def write_metadata(self, key, metadata):
+        with open(self.metadata_path(key), 'w') as f:
+            yaml.dump(metadata, f)
+
+    def lock(self):
+        """Lock of the whole cache, shared by all the processes using it."""
+        os.makedirs(self.cache_path, exist_ok=True)
+        lock_file = open(os.path.join(self.cache_path, self.lock_name), 'w')
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        return lock_file
+
+    def lookup(self, key):
+        """Return the image path for key if the slot is valid, else None.
+           A hit updates the last used time of the slot."""
+        with self.lock():
+            return self._lookup(key)
+
+    def _lookup(self, key):
+        metadata = self.read_metadata(key)
+        if metadata == None:
+            return None
+        image_path = self.image_path(key, metadata['image_name'])
+        if not os.path.exists(image_path):
+            return None
+        metadata['last_used'] = time.time()
+        self.write_metadata(key, metadata)
+        self.print("image cache hit {}: {}".format(key, image_path))
+        return image_path
+
+    def prepare(self, key):
+        """Create an empty slot for key, removing any partial build."""
+        slot_path = self.slot_path(key)
+        if os.path.exists(slot_path):
+            shutil.rmtree(slot_path, ignore_errors=True)
+        os.makedirs(slot_path)
+        self.print("image cache miss {}: building into {}".format(key, slot_path))
+        return slot_path
+
+    def commit(self, key, image_name, metadata={}):
+        """Mark the slot for key as valid and evict old slots."""
+        metadata = dict(metadata)
+        metadata['image_name'] = image_name
+        metadata['created'] = time.time()
+        metadata['last_used'] = metadata['created']
+        self.write_metadata(key, metadata)
+        self.evict(keep=[key])
+
+    @staticmethod
+    def disk_usage(path):
+        # Images are sparse, so count allocated blocks rather than file size.
+        total = 0
+        for root, dirs, files in os.walk(path):
+            for file in files:
+                file_path = os.path.join(root, file)
+                if not os.path.islink(file_path):
+                    total += os.lstat(file_path).st_blocks * 512
+        return total
+
+    @staticmethod
+    def backing_file(path):
+        """The backing file of a qcow2 image, None for any other file."""
+        try:
+            with open(path, 'rb') as f:
+                header = f.read(20)
+                if len(header) < 20 or header[:4] != ImageCache.qcow2_magic:
+                    return None
+                offset, size = struct.unpack(">QI", header[8:20])
+                if offset == 0 or size == 0:
+                    return None
+                f.seek(offset)
+                backing = f.read(size).decode(errors='replace')
+        except OSError:
+            return None
+        # A relative backing file is relative to the overlay.
+        return os.path.join(os.path.dirname(path), backing)
+
+    def referenced_keys(self):
+        """Keys of the slots that links or qcow2 overlays point into."""
+        cache_path = os.path.realpath(self.cache_path)
+        keys = set()
+        def add_target(target):
+            target = os.path.realpath(target)
+            if target.startswith(cache_path + os.sep):
+                keys.add(os.path.relpath(target, cache_path).split(os.sep)[0])
+        for ref_path in self.ref_paths:
+            for root, dirs, files in os.walk(ref_path):
+                if os.path.realpath(root) == cache_path:
+                    dirs[:] = []
+                    continue
+                for name in dirs + files:
+                    path = os.path.join(root, name)
+                    if os.path.islink(path):
+                        add_target(path)
+                    elif name in files:
+                        backing = self.backing_file(path)
+                        if backing:
+                            add_target(backing)
+        return keys
+
+    def slots(self):
+        """Return list of (last_used, key, size), least recently used first.
+           last_used is None for a slot still being built."""
+        entries = []
+        if not os.path.exists(self.cache_path):
+            return entries
+        for key in os.listdir(self.cache_path):
+            if not os.path.isdir(self.slot_path(key)):
+                continue
+            metadata = self.read_metadata(key)
+            last_used = metadata['last_used'] if metadata else None
+            entries.append((last_used, key, self.disk_usage(self.slot_path(key))))
+        return sorted(entries, key=lambda entry: (entry[0] == None, entry[0] or 0, entry[1]))
+
+    def evict(self, keep=[]):
+        """Remove least recently used slots until the cache fits in max_size."""
+        with self.lock():
+            self._evict(keep)
+
+    def _evict(self, keep):
+        entries = self.slots()
+        total = sum([size for last_used, key, size in entries])
+        if total <= self.max_size:
+            return
+        referenced = self.referenced_keys()
+        for last_used, key, size in entries:
+            if total <= self.max_size:
+                break
+            if last_used == None or key in keep:
+                continue
+            if key in referenced:
+                self.print("image cache {} is still in use, not evicted".format(key))
+                continue
+            self.print("image cache evict {} ({} MB)".format(key, size // (1024 * 1024)))
+            shutil.rmtree(self.slot_path(key), ignore_errors=True)
+            total -= size
@@ -24,6 +24,9 @@ import argparse
 from argparse import RawTextHelpFormatter
 import traceback
 import re
+import json
+import statistics
+import time
 import yaml
 import base_cmd
 
@@ -38,16 +41,39 @@ class InstallKernel(base_cmd.BaseCmd):
     kernel_pkg_cpy_cmd = "cp {} /tmp"
     install_kernel_cmd = "sudo /usr/bin/dpkg --force-all -i {}"
     install_kernel_cmd_chroot = "/usr/bin/dpkg --force-all -i {}"
+    extract_kernel_cmd = "dpkg-deb -x {} {}"
+    depmod_cmd = "depmod -a -b {} {}"
+    update_initrd_cmd_chroot = "/usr/sbin/update-initramfs -c -k {}"
     host_dir_mounts = ["tmp", "dev","proc","sys"]
     install_pkg_path = os.path.join(mount_path, "install_kernel")
     install_pkg_vm_path = "/install_kernel"
     move_kernel_script = "move-kernels.py"
     move_kernel_script_path = os.path.join(install_pkg_vm_path, move_kernel_script)    
     launch_cmd = "env {} python3 -B ../tests/vm/{} --image {} --debug {}"
+    overlay_create_cmd = "{} create -f qcow2 -F qcow2 -b {} {}"
+    nbd_connect_cmd = "{} --connect={} --cache=writeback --discard=unmap {}"
+    nbd_disconnect_cmd = "{} --disconnect {}"
+    nbd_sys_path = "/sys/class/block"
     default_image_type = "ubuntu.aarch64"
     default_image_name = "{}.img".format(default_image_type)
     default_config_file = "conf/conf_default.yml"
     build_path_rel = "build"
+    build_tree_image = "arch/arm64/boot/Image"
+    build_tree_release = "include/config/kernel.release"
+    modules_install_cmd = "make -C {} ARCH=arm64 INSTALL_MOD_PATH={} modules_install"
+    modules_tag = "lisa-modules"
+    # Without an initrd, the kernel needs these to mount its root and
+    # the modules share, and to bring up the network for ssh.
+    default_cmdline = "root=/dev/vda1 nokaslr console=ttyAMA0"
+    # Mount the root read write once and skip fsck.  The console is
+    # not made quiet, the boot monitor needs its Booting Linux line.
+    fast_cmdline = "root=/dev/vda1 rw rootwait nokaslr console=ttyAMA0 fsck.mode=skip"
+    # Built in, the kernel mounts its root without an initrd.
+    initrd_less_builtins = ["CONFIG_VIRTIO_PCI", "CONFIG_VIRTIO_BLK", "CONFIG_EXT4_FS"]
+    minimal_initrd_conf_path = os.path.join(host_tmp, "lisa-initramfs")
+    minimal_initrd_cmd_chroot = "/usr/sbin/mkinitramfs -d {} -o /boot/{} {}"
+    build_tree_builtins = ["CONFIG_VIRTIO_PCI", "CONFIG_VIRTIO_BLK", "CONFIG_EXT4_FS",
+                           "CONFIG_VIRTIO_NET", "CONFIG_NET_9P_VIRTIO", "CONFIG_9P_FS"]
         
     def __init__(self):
         super(InstallKernel, self).__init__()
@@ -59,6 +85,7 @@ class InstallKernel(base_cmd.BaseCmd):
         self._qemu_path = os.path.realpath(os.path.join(self._root_path, "external/qemu/build"))
         self._mount_path = os.path.realpath(os.path.join(self._qemu_path, self.mount_path))
         self._qemu_img_path = os.path.join(self._qemu_path, 'qemu-img')
+        self._qemu_nbd_path = os.path.join(self._qemu_path, 'qemu-nbd')
         
         if 'QEMU_CONFIG' in os.environ:
             self._default_config_path = os.environ['QEMU_CONFIG']
@@ -71,25 +98,96 @@ class InstallKernel(base_cmd.BaseCmd):
         self.parse_args()
         self.set_debug(self._args.debug)
         self.set_dry_run(self._args.dry_run)
+        self.set_trace_path(self._args.trace)
         self._image_path = os.path.abspath(getattr(self._args, 'image'))
         self._image_dir_path = os.path.dirname(self._image_path)
         self.vm_config_path = os.path.join(self._image_dir_path, "conf.yml")
         self.continue_on_error = self._args.debug
         self._raw_image_path = self._image_path + '.raw'
-        self.kernel_ver = self._args.kernel_ver
-        self._kernel_pkg_name = os.path.basename(self._args.kernel_pkg)
-        self._kernel_pkg_path = os.path.abspath(self._args.kernel_pkg)
-        self.get_kernel_pkg_version(self._kernel_pkg_path)
-        self.kernel_config_path = os.path.join(self._image_dir_path,
-                                               "conf-kernel-{}.yml".format(self.kernel_ver_minor))
-        self._output_image_path = self._image_path + '.kernel-' + self.kernel_ver_minor
+        self._overlay_image_path = self._image_path + '.overlay'
+        if self._args.kernel_ver and len(self._args.kernel_pkg) > 1:
+            raise Exception("--kernel_ver can only be used with a single kernel package.")
+        if self._args.build_tree:
+            self._kernels = [self.load_build_tree(self._args.build_tree)]
+        else:
+            self._kernels = [self.load_kernel(pkg) for pkg in self._args.kernel_pkg]
+            self.check_kernel_versions()
+        # The image we actually mount and modify.  This is either a raw copy
+        # of the image, or in overlay mode, a qcow2 overlay of the image.
+        # It is written out to the output image of every kernel at the end.
+        if self._args.overlay:
+            self._work_image_path = self._overlay_image_path
+        else:
+            self._work_image_path = self._raw_image_path
         self._config_path = os.path.abspath(self._args.config)
-        self._install_pkg_vm_path =os.path.join(self.install_pkg_vm_path, self._kernel_pkg_name)
         self.chroot_cmd = "chroot {} {}".format(self._mount_path, 
                                                 os.path.join(self.qemu_static_path, 
                                                              self.qemu_static_name))
         self.print("image_path: " + self._image_path)
-        self.print("kernel_pkg_name: " + self._kernel_pkg_name)
+        for kernel in self._kernels:
+            self.print("kernel_pkg_name: " + kernel['pkg_name'])
+        self.select_kernel(self._kernels[-1])
+
+    def load_kernel(self, kernel_pkg):
+        """Gather the names and paths used for one kernel package."""
+        self.kernel_ver = self._args.kernel_ver
+        self.kernel_ver_minor = None
+        pkg_path = os.path.abspath(kernel_pkg)
+        pkg_name = os.path.basename(kernel_pkg)
+        self.get_kernel_pkg_version(pkg_path)
+        return {'pkg_path': pkg_path,
+                'pkg_name': pkg_name,
+                'ver': self.kernel_ver,
+                'ver_minor': self.kernel_ver_minor,
+                'config_path': os.path.join(self._image_dir_path,
+                                            "conf-kernel-{}.yml".format(self.kernel_ver_minor)),
+                'output_path': self._image_path + '.kernel-' + self.kernel_ver_minor,
+                'vm_path': os.path.join(self.install_pkg_vm_path, pkg_name)}
+
+    def check_kernel_versions(self):
+        # All the kernels are installed into the same image, where a
+        # release owns /boot/vmlinuz-[release] and /lib/modules/[release].
+        # Two builds of one release would overwrite each other.
+        releases = {}
+        for kernel in self._kernels:
+            if kernel['ver'] in releases:
+                raise Exception("{} and {} are both release {}, install them in "\
+                                "separate runs.".format(releases[kernel['ver']],
+                                                        kernel['pkg_name'], kernel['ver']))
+            releases[kernel['ver']] = kernel['pkg_name']
+
+    def load_build_tree(self, build_tree):
+        """Gather the names and paths used for the kernel of a build tree."""
+        build_tree = os.path.abspath(build_tree)
+        release_path = os.path.join(build_tree, self.build_tree_release)
+        if not os.path.exists(release_path):
+            raise Exception("{} not found, is {} a built kernel tree?".format(release_path,
+                                                                              build_tree))
+        with open(release_path) as f:
+            self.kernel_ver = self.kernel_ver_minor = f.read().strip()
+        self.print("Kernel version is: {}".format(self.kernel_ver), debug=True)
+        return {'pkg_path': build_tree,
+                'pkg_name': os.path.basename(build_tree),
+                'ver': self.kernel_ver,
+                'ver_minor': self.kernel_ver_minor,
+                'config_path': os.path.join(self._image_dir_path,
+                                            "conf-kernel-{}.yml".format(self.kernel_ver_minor)),
+                'output_path': self._image_path,
+                'vm_path': None,
+                'image_path': os.path.join(build_tree, self.build_tree_image),
+                'modules_path': os.path.join(self._image_dir_path,
+                                             "modules-{}".format(self.kernel_ver_minor))}
+
+    def select_kernel(self, kernel):
+        """Make kernel the one the install steps operate on."""
+        self.kernel_ver = kernel['ver']
+        self.kernel_ver_minor = kernel['ver_minor']
+        self._kernel_pkg_name = kernel['pkg_name']
+        self._kernel_pkg_path = kernel['pkg_path']
+        self.kernel_config_path = kernel['config_path']
+        self._output_image_path = kernel['output_path']
+        self._install_pkg_vm_path = kernel['vm_path']
+        self._kernel = kernel
     
     def parse_args(self):
         parser = argparse.ArgumentParser(formatter_class=RawTextHelpFormatter,
@@ -105,19 +203,63 @@ class InstallKernel(base_cmd.BaseCmd):
                             help="enable debug output")
         parser.add_argument("--dry_run", action="store_true",
                             help="for debugging.  Just show commands to issue.")
-        parser.add_argument("--vm", action="store_true",
-                            help="Install kernel using a vm instead of a chroot.")
+        mode_group = parser.add_mutually_exclusive_group()
+        mode_group.add_argument("--vm", action="store_true",
+                                help="Install kernel using a vm instead of a chroot.")
+        mode_group.add_argument("--build_tree", default="",
+                                help="Boot the Image of this kernel build tree directly,\n"\
+                                "with its modules shared from the host over 9p.\n"\
+                                "Neither the image nor a package is needed or modified,\n"\
+                                "so a rebuilt kernel only needs a new launch.")
+        mode_group.add_argument("--host", action="store_true",
+                                help="Unpack the kernel package on the host instead of\n"\
+                                "running dpkg in an emulated chroot.\n"\
+                                "Maintainer scripts are not run and the package is not\n"\
+                                "recorded in the dpkg database of the image.")
+        parser.add_argument("--initrd", default="generate", choices=["generate", "reuse"],
+                            help="How to provide the initrd with --host.\n"\
+                            "generate: run update-initramfs in the emulated chroot.\n"\
+                            "reuse:    copy the newest initrd already in the image.\n"\
+                            "          Requires virtio-blk and ext4 built into the kernel.\n"\
+                            "default is generate")
+        parser.add_argument("--boot_profile", default="default", choices=["default", "fast"],
+                            help="default: boot with the distro initrd.\n"\
+                            "fast:    boot without initrd when virtio-blk and ext4\n"\
+                            "         are built into the kernel, otherwise with a\n"\
+                            "         minimal initrd of just those modules, and with\n"\
+                            "         a kernel command line trimmed for fast boot.\n"\
+                            "default is default")
+        parser.add_argument("--measure_boot", type=int, default=0,
+                            help="With --boot_profile fast, boot each kernel this many\n"\
+                            "times with each profile and record the median times\n"\
+                            "to ssh ready in its config.\n"\
+                            "default is 0, no measurement")
+        parser.add_argument("--trace", default=os.environ.get('LISA_QEMU_TRACE', ""),
+                            help="Write a timing trace of all commands and phases\n"\
+                            "to this file in Chrome trace format.\n"\
+                            "Can also be set with environment variable LISA_QEMU_TRACE.")
+        parser.add_argument("--overlay", action="store_true",
+                            help="Create the output image as a qcow2 overlay backed by\n"\
+                            "the input image and mount it with qemu-nbd.\n"\
+                            "Avoids converting the full image to raw and back.")
         parser.add_argument("--image", "-i", default=self._default_image_path,
                             help="vm image file name.\n"\
                             "ex. -i ../external/qemu/build/ubuntu.aarch64.img")
         parser.add_argument("--kernel_ver", "-v", default="",
                             help="kernel version like: -v 5.4.0+")
-        parser.add_argument("--kernel_pkg", "-p", default="", required=True,
-                            help="kernel package to use")
+        parser.add_argument("--kernel_pkg", "-p", nargs="+", default=[],
+                            help="kernel package to use.\n"\
+                            "Several packages can be given, they are all installed\n"\
+                            "in one session and each gets its own output image and config.\n"\
+                            "Each output image holds all of them, so the packages must\n"\
+                            "be of different kernel releases.\n"\
+                            "Required unless --build_tree is given.")
         parser.add_argument("--config", "-c", default=self._default_config_path,
                             help="config file. \n"\
                             "default is conf/conf_default.yml")
         self._args = parser.parse_args()
+        if not self._args.kernel_pkg and not self._args.build_tree:
+            parser.error("--kernel_pkg is required unless --build_tree is given")
         
         for arg in ['image', 'kernel_ver', 'kernel_pkg']:
             if getattr(self._args, arg):
@@ -126,10 +268,110 @@ class InstallKernel(base_cmd.BaseCmd):
     def convert_image(self, type, file_in, file_out):
         self.print("Converting to image type {} {} -> {}".format(type, file_in, file_out))
         cmd = "{} convert -p -O {} {} {}".format(self._qemu_img_path, type, file_in, file_out)
-        self.issue_cmd(cmd, enable_stdout=False)
+        with self.phase("convert"):
+            self.issue_cmd(cmd, enable_stdout=False)
 
         os.chmod(file_out, 0o666)
         
+    def create_overlay(self):
+        self.print("Creating overlay {} -> {}".format(self._overlay_image_path, self._image_path))
+        if os.path.exists(self._overlay_image_path):
+            self.print("remove existing {}".format(self._overlay_image_path), debug=True)
+            os.remove(self._overlay_image_path)
+        # The image may be a link into the image cache, which can be
+        # pointed elsewhere later, so back the overlay by the real file.
+        cmd = self.overlay_create_cmd.format(self._qemu_img_path,
+                                             os.path.realpath(self._image_path),
+                                             self._overlay_image_path)
+        self.issue_cmd(cmd, enable_stdout=False)
+        if not self._dry_run:
+            os.chmod(self._overlay_image_path, 0o666)
+
+    def write_output_images(self):
+        """Write the work image out to the output image of each kernel.
+           The outputs are independent, so they are written concurrently."""
+        outputs = [kernel['output_path'] for kernel in self._kernels]
+        # Written as new files, so that caches keyed by the image file,
+        # like the rt-app calibration, see the image changed.
+        for output in outputs:
+            if os.path.exists(output) and not self._dry_run:
+                os.remove(output)
+        if self._args.overlay:
+            # The overlay only holds the changed blocks, so copies are cheap.
+            # The last output just takes over the work overlay.
+            cmds = ["cp --sparse=always {} {}".format(self._work_image_path, output)
+                    for output in outputs[:-1]]
+            with self.phase("copy overlay"):
+                self.issue_cmds(cmds, enable_stdout=False)
+            if not self._dry_run:
+                os.rename(self._work_image_path, outputs[-1])
+        else:
+            for output in outputs:
+                self.print("Converting to image type qcow2 {} -> {}".format(self._raw_image_path,
+                                                                            output))
+            cmds = ["{} convert -p -O qcow2 {} {}".format(self._qemu_img_path,
+                                                          self._raw_image_path, output)
+                    for output in outputs]
+            with self.phase("convert"):
+                self.issue_cmds(cmds, enable_stdout=False)
+        if not self._dry_run:
+            for output in outputs:
+                os.chmod(output, 0o666)
+
+    def find_free_nbd(self):
+        for dev_path in sorted(glob.glob(os.path.join(self.nbd_sys_path, "nbd*"))):
+            name = os.path.basename(dev_path)
+            # Skip partitions, like nbd0p1.
+            if "p" in name:
+                continue
+            # The pid file only exists while the device is connected.
+            if not os.path.exists(os.path.join(dev_path, "pid")):
+                return os.path.join("/dev", name)
+        return None
+
+    def create_nbd(self):
+        self.issue_cmd("modprobe nbd max_part=8",
+                       err_msg="could not load nbd module")
+        self.device = self.find_free_nbd()
+        if self.device == None:
+            if not self._dry_run:
+                self.print("could not find a free nbd device")
+                self.terminate(1)
+            self.device = "/dev/nbd0"
+        self.print("connect {} to {}".format(self._work_image_path, self.device))
+        cmd = self.nbd_connect_cmd.format(self._qemu_nbd_path, self.device,
+                                          self._work_image_path)
+        self.issue_cmd(cmd, err_msg="could not connect nbd device")
+        if self._dry_run:
+            return
+        # Partitions show up asynchronously after the connect.
+        partition = "{}p1".format(self.device)
+        retry_count = 0
+        while not os.path.exists(partition) and retry_count < 30:
+            time.sleep(0.1)
+            retry_count += 1
+        if not os.path.exists(partition):
+            self.print("partition {} did not appear".format(partition))
+            self.terminate(1)
+
+    def destroy_nbd(self):
+        self.print("disconnect nbd device {}".format(self.device))
+        cmd = self.nbd_disconnect_cmd.format(self._qemu_nbd_path, self.device)
+        self.issue_cmd(cmd, err_msg="could not disconnect nbd device",
+                       fail_on_err=False)
+
+    def attach_image(self):
+        if self._args.overlay:
+            self.create_nbd()
+        else:
+            self.create_loopback()
+
+    def detach_image(self):
+        if self._args.overlay:
+            self.destroy_nbd()
+        else:
+            self.destroy_loopback()
+
     def create_loopback(self):
         self.print("create loopback device for {}".format(self._raw_image_path))
         rc, unused = self.issue_cmd("losetup -f -P {}".format(self._raw_image_path),
@@ -165,10 +407,14 @@ class InstallKernel(base_cmd.BaseCmd):
             self.unmount(mnt['dst'])
         
     def mount_image(self):
+        with self.phase("mount"):
+            self._mount_image()
+
+    def _mount_image(self):
         if not os.path.exists(self._mount_path):
             self.print("creating {}".format(os.path.abspath(self._mount_path)))
             os.mkdir(self._mount_path)
-        self.create_loopback()
+        self.attach_image()
         # After this point, we have to cleanup before exiting.
         self._image_mounted = True
         self.temp_pkg_path = os.path.abspath(self.install_pkg_path)
@@ -177,10 +423,14 @@ class InstallKernel(base_cmd.BaseCmd):
         self.mount_host_dirs()
         
     def umount_image(self):
+        with self.phase("umount"):
+            self._umount_image()
+
+    def _umount_image(self):
         self.umount_host_dirs()
         self.print("umount image from {}".format(self._mount_path))
         self.unmount(self._mount_path)
-        self.destroy_loopback()
+        self.detach_image()
         self._image_mounted = False
         os.rmdir(self._mount_path)
         
@@ -214,13 +464,61 @@ class InstallKernel(base_cmd.BaseCmd):
         self.print("install kernel image {}".format(self._kernel_pkg_name))        
         cmd = self.install_kernel_cmd_chroot.format(os.path.join(self.host_tmp, self._kernel_pkg_name))
         chroot_cmd = "{} {}".format(self.chroot_cmd, cmd)
-        self.issue_cmd(chroot_cmd, fail_on_err=False)
+        with self.phase("dpkg"):
+            self.issue_cmd(chroot_cmd, fail_on_err=False)
+
+    def extract_pkg(self):
+        self.print("extract kernel image {}".format(self._kernel_pkg_name))
+        cmd = self.extract_kernel_cmd.format(self._kernel_pkg_path, self._mount_path)
+        with self.phase("dpkg"):
+            self.issue_cmd(cmd)
+
+    def update_modules(self):
+        modules_path = os.path.join(self._mount_path, "lib", "modules", self.kernel_ver)
+        if not os.path.exists(modules_path) and not self._dry_run:
+            self.print("no modules found in {}, skipping depmod".format(modules_path))
+            return
+        self.print("generate module dependencies for {}".format(self.kernel_ver))
+        self.issue_cmd(self.depmod_cmd.format(self._mount_path, self.kernel_ver))
+
+    def find_initrd(self):
+        """Returns the newest initrd found in the image, if any."""
+        boot_path = os.path.join(self._mount_path, "boot")
+        initrd_files = []
+        for path in [boot_path, os.path.join(boot_path, "backup")]:
+            initrd_files += glob.glob(os.path.join(path, "initrd.img-*"))
+        if len(initrd_files) == 0:
+            return None
+        return max(initrd_files, key=os.path.getmtime)
+
+    def install_initrd(self):
+        initrd_dest = "initrd.img-{}".format(self.kernel_ver)
+        initrd_dest_path = os.path.join(self._mount_path, "boot", initrd_dest)
+        if self._args.initrd == "generate":
+            # Only this step needs the emulated chroot.
+            self.copy_qemu_static()
+            self.print("generate initrd for {}".format(self.kernel_ver))
+            cmd = self.update_initrd_cmd_chroot.format(self.kernel_ver)
+            with self.phase("initrd"):
+                self.issue_cmd("{} {}".format(self.chroot_cmd, cmd))
+            return
+        initrd_src_path = self.find_initrd()
+        if initrd_src_path == None:
+            if not self._dry_run:
+                self.print("no initrd found in image to reuse, "\
+                           "please use --initrd generate")
+                self.terminate(1)
+            initrd_src_path = os.path.join(self._mount_path, "boot", "initrd.img")
+        self.print("reuse initrd {}".format(initrd_src_path))
+        cmd = "cp {} {}".format(initrd_src_path, initrd_dest_path)
+        self.issue_cmd(cmd)
 
     def copy_files_to_image(self):
         if not os.path.exists(self.install_pkg_path):
             os.mkdir(self.install_pkg_path)
-        cmd = "cp {} {}".format(self._kernel_pkg_path, self.install_pkg_path)
-        self.issue_cmd(cmd)
+        for kernel in self._kernels:
+            cmd = "cp {} {}".format(kernel['pkg_path'], self.install_pkg_path)
+            self.issue_cmd(cmd)
         move_script_path = os.path.join(self._root_path, "scripts")
         move_script_path = os.path.join(move_script_path, self.move_kernel_script)
         cmd = "cp {} {}".format(move_script_path, self.install_pkg_path)
@@ -238,6 +536,62 @@ class InstallKernel(base_cmd.BaseCmd):
             traceback.print_exc()
 
     def copy_kernel_from_image(self):
+        with self.phase("copy kernel"):
+            self._copy_kernel_from_image()
+        if self._args.boot_profile == "fast":
+            self.prepare_fast_initrd()
+
+    def get_cmdline(self):
+        return self.fast_cmdline if self._args.boot_profile == "fast" else self.default_cmdline
+
+    def read_kernel_config(self, config_path):
+        config = {}
+        if not os.path.exists(config_path):
+            return config
+        with open(config_path) as f:
+            for line in f:
+                key, sep, value = line.strip().partition("=")
+                if sep and not key.startswith("#"):
+                    config[key] = value
+        return config
+
+    def get_fast_initrd_path(self):
+        if self._kernel['fast_initrd'] == "none":
+            return None
+        return os.path.join(self._image_dir_path,
+                            "initrd.img-{}.minimal".format(self.kernel_ver_minor))
+
+    def prepare_fast_initrd(self):
+        """Boot without initrd if the kernel can mount its root by itself,
+           otherwise generate an initrd with only the modules for that."""
+        config = self.read_kernel_config(os.path.join(self._mount_path, "boot",
+                                                      "config-{}".format(self.kernel_ver)))
+        missing = [key for key in self.initrd_less_builtins if config.get(key) != "y"]
+        if not missing:
+            self.print("{} has virtio-blk and ext4 built in, "\
+                       "booting without initrd".format(self.kernel_ver))
+            self._kernel['fast_initrd'] = "none"
+            return
+        self.print("{} not built in, generating a minimal initrd".format(" ".join(missing)))
+        self._kernel['fast_initrd'] = "minimal"
+        if not os.path.exists(self.minimal_initrd_conf_path):
+            os.makedirs(self.minimal_initrd_conf_path)
+        with open(os.path.join(self.minimal_initrd_conf_path, "initramfs.conf"), 'w') as f:
+            f.write("MODULES=list\nBUSYBOX=n\n")
+        with open(os.path.join(self.minimal_initrd_conf_path, "modules"), 'w') as f:
+            f.write("virtio_pci\nvirtio_blk\next4\n")
+        initrd_name = os.path.basename(self.get_fast_initrd_path())
+        # /tmp of the host is mounted in the image.
+        cmd = self.minimal_initrd_cmd_chroot.format(self.minimal_initrd_conf_path,
+                                                    initrd_name, self.kernel_ver)
+        self.copy_qemu_static()
+        with self.phase("initrd"):
+            self.issue_cmd("{} {}".format(self.chroot_cmd, cmd))
+        self.issue_cmd("mv {} {}".format(os.path.join(self._mount_path, "boot", initrd_name),
+                                         self.get_fast_initrd_path()))
+        shutil.rmtree(self.minimal_initrd_conf_path, ignore_errors=True)
+
+    def _copy_kernel_from_image(self):
         kernel_src = "vmlinuz-{}".format(self.kernel_ver)
         kernel_path = os.path.join(self.mount_path, "boot")
         kernel_src_path = os.path.join(kernel_path, kernel_src)
@@ -265,15 +619,32 @@ class InstallKernel(base_cmd.BaseCmd):
         else:
             return None
 
-    def get_qemu_args_for_kernel(self, existing_args):
-        vmlinuz_path = os.path.join(self._image_dir_path,
-                                    "vmlinuz-{}".format(self.kernel_ver_minor))
-        initrd_path = os.path.join(self._image_dir_path,
-                                   "initrd.img-{}".format(self.kernel_ver_minor))
-        args = "-kernel {} --initrd {}".format(vmlinuz_path, initrd_path)
-        args += ' -append "root=/dev/vda1 nokaslr console=ttyAMA0"'
+    def get_qemu_args_for_kernel(self, existing_args, vmlinuz_path=None, initrd_path="",
+                                 cmdline=None):
+        # By default the kernel and initrd copied out of the image.
+        # An initrd_path of None boots without initrd.
+        if vmlinuz_path == None:
+            vmlinuz_path = os.path.join(self._image_dir_path,
+                                        "vmlinuz-{}".format(self.kernel_ver_minor))
+        if initrd_path == "":
+            initrd_path = os.path.join(self._image_dir_path,
+                                       "initrd.img-{}".format(self.kernel_ver_minor))
+        args = "-kernel {}".format(vmlinuz_path)
+        if initrd_path:
+            args += " --initrd {}".format(initrd_path)
+        args += ' -append "{}"'.format(cmdline or self.default_cmdline)
         return existing_args + " " + args
 
+    def get_qemu_args_for_build_tree(self, existing_args):
+        kernel = self._kernels[-1]
+        args = self.get_qemu_args_for_kernel(existing_args, kernel['image_path'], None,
+                                             self.get_cmdline())
+        share_path = os.path.join(kernel['modules_path'], "lib", "modules")
+        args += " -fsdev local,id={0},path={1},security_model=none,readonly=on "\
+                "-device virtio-9p-pci,fsdev={0},mount_tag={0}".format(self.modules_tag,
+                                                                       share_path)
+        return args
+
     def create_config_file(self):
         # Rewrite the config file.
         yaml_dict = self.read_config()
@@ -281,7 +652,19 @@ class InstallKernel(base_cmd.BaseCmd):
             return;
         if 'qemu_args' not in yaml_dict['qemu-conf']:
             raise Exception("qemu_args not found in {}".format(self.vm_config_path))
-        new_args = self.get_qemu_args_for_kernel(yaml_dict['qemu-conf']['qemu_args'])
+        if self._args.build_tree:
+            new_args = self.get_qemu_args_for_build_tree(yaml_dict['qemu-conf']['qemu_args'])
+            # Tells launch_image.py to mount the share over /lib/modules.
+            yaml_dict['qemu-conf']['modules_share'] = self.modules_tag
+        elif self._args.boot_profile == "fast":
+            new_args = self.get_qemu_args_for_kernel(yaml_dict['qemu-conf']['qemu_args'],
+                                                     initrd_path=self.get_fast_initrd_path(),
+                                                     cmdline=self.get_cmdline())
+            yaml_dict['boot-profile'] = {'profile': "fast",
+                                         'initrd': self._kernel['fast_initrd'],
+                                         'cmdline': self.get_cmdline()}
+        else:
+            new_args = self.get_qemu_args_for_kernel(yaml_dict['qemu-conf']['qemu_args'])
         yaml_dict['qemu-conf']['qemu_args'] = new_args
         with open(self.kernel_config_path, 'w') as f:
             yaml_dict = yaml.dump(yaml_dict, f)
@@ -292,62 +675,171 @@ class InstallKernel(base_cmd.BaseCmd):
         env_vars += "QEMU_CONFIG={} ".format(self._config_path)
         cpy_cmd = "sudo python3 {} {}".format(self.move_kernel_script_path,
                                               self.kernel_ver)
-        install_cmd = self.install_kernel_cmd.format(self._install_pkg_vm_path)
-        cmd = self.launch_cmd.format(env_vars, "ubuntu.aarch64", self._raw_image_path, 
+        install_cmd = " ; ".join([self.install_kernel_cmd.format(kernel['vm_path'])
+                                  for kernel in self._kernels])
+        cmd = self.launch_cmd.format(env_vars, "ubuntu.aarch64", self._work_image_path, 
                                      '"{} ; {}"'.format(cpy_cmd, install_cmd))
         
-        self.issue_cmd(cmd, no_capture=True)
+        with self.phase("dpkg"):
+            self.issue_cmd(cmd, no_capture=True)
         
-    def install_kernel_vm(self):
-        self.create_config_file()
+    def install_kernels_vm(self):
+        # All the kernels are installed in a single boot of the vm.
         self.copy_files_to_image()
         self.umount_image()
         self.run_cmd_in_vm()
         self.mount_image()
-        self.copy_kernel_from_image()
+        for kernel in self._kernels:
+            self.select_kernel(kernel)
+            self.copy_kernel_from_image()
+            self.create_config_file()
         self.remove_temp_files()
-        self.umount_image()
         
     def install_kernel_chroot(self):
-        self.create_config_file()
         self.copy_qemu_static()
         # modify the share to move old kernels out of the way.
         self.move_old_kernels()
         # install the new kernel.
         self.install_pkg()
         self.copy_kernel_from_image()
+        self.create_config_file()
         self.remove_temp_files()
-        self.umount_image()
             
+    def install_kernel_host(self):
+        # modify the share to move old kernels out of the way.
+        self.move_old_kernels()
+        # unpack the new kernel natively, then fix up modules and initrd.
+        self.extract_pkg()
+        self.update_modules()
+        self.install_initrd()
+        self.copy_kernel_from_image()
+        self.create_config_file()
+        self.remove_temp_files()
+
+    def install_modules(self):
+        # modules_install replaces the modules of this release in the
+        # share, which the guest sees on its next launch.
+        kernel = self._kernels[-1]
+        os.makedirs(kernel['modules_path'], exist_ok=True)
+        cmd = self.modules_install_cmd.format(self._kernel_pkg_path, kernel['modules_path'])
+        with self.phase("modules"):
+            self.issue_cmd(cmd, enable_stdout=self._debug)
+
+    def install_build_tree(self):
+        kernel = self._kernels[-1]
+        if not os.path.exists(kernel['image_path']):
+            raise Exception("{} not found, build the kernel first.".format(kernel['image_path']))
+        config = self.read_kernel_config(os.path.join(self._kernel_pkg_path, ".config"))
+        missing = [key for key in self.build_tree_builtins if config.get(key) != "y"]
+        if missing:
+            raise Exception("{} must be built in to boot without initrd, set them "\
+                            "to y in {}".format(" ".join(missing),
+                                                os.path.join(self._kernel_pkg_path, ".config")))
+        if config.get("CONFIG_MODULES") == "y":
+            self.install_modules()
+        self.create_config_file()
+        launch_path = os.path.join(self._script_path, "launch_image.py")
+        print("To boot {} run this command:".format(kernel['image_path']))
+        print("python3 {} --overlay --image_path {} --config {}\n".format(launch_path,
+                                                                           self._image_path,
+                                                                           self.kernel_config_path))
+
+    def measure_boot(self, config_path, image_path):
+        """Time to ssh ready of a boot of image_path with config_path."""
+        trace_path = os.path.join(self.host_tmp, "lisa-boot-{}.json".format(os.getpid()))
+        lisa_config_path = os.path.join(self.host_tmp, "lisa-boot-{}.yml".format(os.getpid()))
+        cmd = "{} {} --image_path {} --config {} --overlay --guest_cmd true --ssh_port auto "\
+              "--rtapp_calib off --lisa_config {} --trace {}".format(sys.executable,
+              os.path.join(self._script_path, "launch_image.py"), image_path, config_path,
+              lisa_config_path, trace_path)
+        with self.phase("measure boot"):
+            self.issue_cmd(cmd, enable_stdout=False)
+        if self._dry_run:
+            return 0
+        with open(trace_path) as f:
+            phases = json.load(f)['metadata']['phases']
+        for path in glob.glob(os.path.splitext(lisa_config_path)[0] + "*.yml") + [trace_path]:
+            os.remove(path)
+        return phases['boot']['wall_s']
+
+    def measure_boot_profiles(self):
+        # Boots alternate between the profiles, so that a change in the
+        # load of the host affects both alike.
+        for kernel in self._kernels:
+            self.select_kernel(kernel)
+            if not os.path.exists(self.kernel_config_path):
+                continue
+            with open(self.kernel_config_path) as f:
+                yaml_dict = yaml.safe_load(f)
+            default_dict = self.read_config()
+            default_dict['qemu-conf']['qemu_args'] = \
+                self.get_qemu_args_for_kernel(default_dict['qemu-conf']['qemu_args'])
+            default_config_path = os.path.join(self.host_tmp,
+                                               "lisa-boot-default-{}.yml".format(os.getpid()))
+            with open(default_config_path, 'w') as f:
+                yaml.dump(default_dict, f)
+            times = {'default': [], 'fast': []}
+            for sample in range(self._args.measure_boot):
+                times['default'].append(self.measure_boot(default_config_path,
+                                                          kernel['output_path']))
+                times['fast'].append(self.measure_boot(self.kernel_config_path,
+                                                       kernel['output_path']))
+            os.remove(default_config_path)
+            boot_time = {profile: round(statistics.median(samples), 2)
+                         for profile, samples in times.items()}
+            boot_time['samples'] = self._args.measure_boot
+            yaml_dict['boot-profile']['boot_time'] = boot_time
+            with open(self.kernel_config_path, 'w') as f:
+                yaml.dump(yaml_dict, f)
+            print("{} time to ssh ready: default profile {}s, fast profile {}s".format(
+                  self.kernel_ver_minor, boot_time['default'], boot_time['fast']))
+
     def remove_temporaries(self):
         self.print("remove temporary files")
-        if os.path.exists(self._raw_image_path):
-            os.remove(self._raw_image_path)
+        for path in [self._raw_image_path, self._overlay_image_path]:
+            if os.path.exists(path):
+                os.remove(path)
 
     def cleanup(self):
         if self._image_mounted:
             # Cleanup as needed.
             self.umount_image()
-            self.remove_temporaries()    
+        self.remove_temporaries()
 
     def run(self):
         try:
+            if self._args.build_tree:
+                self.install_build_tree()
+                return 0
             os.chdir(self._qemu_path)
-            # setup, convert image to raw, mount it.
-            self.convert_image('raw', self._image_path, self._raw_image_path)
+            if self._args.overlay:
+                # setup, create an overlay on top of the image, mount it.
+                self.create_overlay()
+            else:
+                # setup, convert image to raw, mount it.
+                self.convert_image('raw', self._image_path, self._raw_image_path)
             self.mount_image()
             if self._args.vm:
-                self.install_kernel_vm()
+                self.install_kernels_vm()
             else:
-                self.install_kernel_chroot()
-            # cleanup and convert image back to qcow2
-            self.convert_image('qcow2', self._raw_image_path, self._output_image_path)
+                for kernel in self._kernels:
+                    self.select_kernel(kernel)
+                    if self._args.host:
+                        self.install_kernel_host()
+                    else:
+                        self.install_kernel_chroot()
+            self.umount_image()
+            # convert image back to qcow2 for each kernel
+            self.write_output_images()
             self.remove_temporaries()
+            if self._args.boot_profile == "fast" and self._args.measure_boot:
+                self.measure_boot_profiles()
             print("Install kernel successful.")
-            print("Image path: {}\n".format(self._output_image_path))
-            print("To start this image run this command:")
             launch_path = os.path.join(self._script_path, "launch_image.py")
-            print("python3 {} --image_path {}".format(launch_path, self._output_image_path))
+            for kernel in self._kernels:
+                print("Image path: {}\n".format(kernel['output_path']))
+                print("To start this image run this command:")
+                print("python3 {} --image_path {}\n".format(launch_path, kernel['output_path']))
         except Exception as e:
             sys.stderr.write("Exception hit\n")
             if isinstance(e, SystemExit) and e.code == 0:
@@ -0,0 +1,224 @@
+#
+# Copyright 2020 Linaro
+#
+# Generates the guest CPU and NUMA topology from a compact spec.
+#
+# A topology key in qemu-conf replaces hand written -smp and -numa
+# qemu_args, for example 256 vCPUs in 8 NUMA nodes with 3 distance levels:
+#
+#    memory: 32G
+#    topology:
+#        sockets: 2
+#        cores: 128          # per socket
+#        threads: 1          # per core, default 1
+#        nodes: 8
+#        memory_backend: ram # ram or memfd, default ram
+#        # Node groups of increasing size and the distance between nodes
+#        # of the same group.  The last group holds all the nodes.
+#        tiers: [[2, 16], [4, 24], [8, 32]]
+#        # Or the full node distance matrix instead of tiers.
+#        #distances: [[10, 20], [20, 10]]
+#
+# The memory is split evenly between the nodes.  Without tiers or
+# distances all remote nodes are at distance 20.
+#
+
+from host_topology import TopologyError, parse_size
+
+local_distance = 10
+default_remote_distance = 20
+max_distance = 255
+backend_ids = "ram-node{}"
+backends = {'ram': "memory-backend-ram",
+            'memfd': "memory-backend-memfd"}
+
+def get_max_vcpus(machine):
+    """Most vCPUs the machine type supports, None if not known."""
+    machine_type = machine.split(",")[0]
+    if machine_type == "virt":
+        # virt defaults to GICv2, which only supports 8 cpus.
+        props = dict(prop.replace("_", "-").partition("=")[::2]
+                     for prop in machine.split(",")[1:])
+        if props.get("gic-version") in ["3", "max", "host"]:
+            return 512
+        return 8
+    if machine_type.startswith("pc-q35") or machine_type == "q35":
+        return 288
+    if machine_type.startswith("pc"):
+        return 255
+    return None
+
+def strip_topology_args(qemu_args):
+    """Remove any -smp, -numa and memory backend arguments from qemu_args."""
+    args = qemu_args.split()
+    result = []
+    skip = False
+    for index, arg in enumerate(args):
+        if skip:
+            skip = False
+            continue
+        next_arg = args[index + 1] if index + 1 < len(args) else ""
+        if arg in ["-smp", "-numa"] or \
+           (arg == "-object" and next_arg.startswith("memory-backend-")):
+            skip = True
+            continue
+        result.append(arg)
+    return " ".join(result)
+
+class NumaTopology:
+    def __init__(self, spec, memory, machine=""):
+        self.spec = spec
+        self.sockets = self.get_int('sockets', 1)
+        self.cores = self.get_int('cores', 1)
+        self.threads = self.get_int('threads', 1)
+        self.nodes = self.get_int('nodes', 1)
+        self.vcpus = self.sockets * self.cores * self.threads
+        self.memory_backend = spec.get('memory_backend', "ram")
+        if self.memory_backend not in backends:
+            raise TopologyError("invalid memory_backend: {}, valid values: {}"\
+                                .format(self.memory_backend, ", ".join(backends)))
+        self.node_memory_mb = self.get_node_memory(memory)
+        self.check_cpus(machine)
+        self.distances = self.get_distances()
+
+    def get_int(self, key, default):
+        value = self.spec.get(key, default)
+        if not isinstance(value, int) or value < 1:
+            raise TopologyError("topology {} must be a positive number, "\
+                                "not {}".format(key, value))
+        return value
+
+    def get_node_memory(self, memory):
+        memory_mb = parse_size(memory) >> 20
+        if memory_mb % self.nodes:
+            raise TopologyError("memory of {} MB cannot be split evenly "\
+                                "between {} nodes".format(memory_mb, self.nodes))
+        return memory_mb // self.nodes
+
+    def check_cpus(self, machine):
+        max_vcpus = get_max_vcpus(machine)
+        if max_vcpus and self.vcpus > max_vcpus:
+            hint = ", use gic-version=3 for more" if max_vcpus == 8 else ""
+            raise TopologyError("machine {} supports up to {} vCPUs{}, "\
+                                "topology has {}".format(machine, max_vcpus, hint, self.vcpus))
+        if self.vcpus % self.nodes:
+            raise TopologyError("{} vCPUs cannot be split evenly between {} nodes"\
+                                .format(self.vcpus, self.nodes))
+        # A node should not span part of a socket.
+        node_cpus = self.vcpus // self.nodes
+        socket_cpus = self.cores * self.threads
+        if socket_cpus % node_cpus and node_cpus % socket_cpus:
+            raise TopologyError("nodes of {} vCPUs do not align with sockets "\
+                                "of {} vCPUs".format(node_cpus, socket_cpus))
+        if node_cpus % self.threads:
+            raise TopologyError("nodes of {} vCPUs split cores of {} threads"\
+                                .format(node_cpus, self.threads))
+
+    def check_distance(self, distance):
+        if not isinstance(distance, int) or \
+           not local_distance < distance <= max_distance:
+            raise TopologyError("distance {} is invalid, remote distances are "\
+                                "{} to {}".format(distance, local_distance + 1, max_distance))
+
+    def get_distances(self):
+        if 'distances' in self.spec and 'tiers' in self.spec:
+            raise TopologyError("topology has both distances and tiers, only use one")
+        if 'distances' in self.spec:
+            return self.get_matrix_distances(self.spec['distances'])
+        if self.nodes == 1 and 'tiers' not in self.spec:
+            return [[local_distance]]
+        tiers = self.spec.get('tiers', [[self.nodes, default_remote_distance]])
+        return self.get_tier_distances(tiers)
+
+    def get_matrix_distances(self, matrix):
+        if len(matrix) != self.nodes or \
+           any([len(row) != self.nodes for row in matrix]):
+            raise TopologyError("distances must be a {0}x{0} matrix".format(self.nodes))
+        for src, row in enumerate(matrix):
+            for dst, distance in enumerate(row):
+                if src == dst:
+                    if distance != local_distance:
+                        raise TopologyError("distance of node {} to itself must be {}"\
+                                            .format(src, local_distance))
+                else:
+                    self.check_distance(distance)
+        return [list(row) for row in matrix]
+
+    def get_tier_distances(self, tiers):
+        prev_size = 1
+        prev_distance = local_distance
+        for tier in tiers:
+            if not isinstance(tier, list) or len(tier) != 2 or \
+               not isinstance(tier[0], int):
+                raise TopologyError("tier {} is invalid, tiers are [nodes, distance]"\
+                                    .format(tier))
+            size, distance = tier
+            if size <= prev_size or size % prev_size or self.nodes % size:
+                raise TopologyError("tier of {} nodes is invalid, tiers must grow "\
+                                    "and divide the {} nodes".format(size, self.nodes))
+            self.check_distance(distance)
+            if distance <= prev_distance:
+                raise TopologyError("tier distances must grow, {} after {}"\
+                                    .format(distance, prev_distance))
+            prev_size, prev_distance = size, distance
+        if prev_size != self.nodes:
+            raise TopologyError("the last tier must hold all {} nodes".format(self.nodes))
+        distances = []
+        for src in range(self.nodes):
+            row = []
+            for dst in range(self.nodes):
+                distance = local_distance
+                if src != dst:
+                    distance = [d for size, d in tiers if src // size == dst // size][0]
+                row.append(distance)
+            distances.append(row)
+        return distances
+
+    def node_cpus(self, node):
+        node_cpus = self.vcpus // self.nodes
+        return range(node * node_cpus, (node + 1) * node_cpus)
+
+    def get_qemu_args(self):
+        args = ["-smp cpus={0},maxcpus={0},sockets={1},cores={2},threads={3}"\
+                .format(self.vcpus, self.sockets, self.cores, self.threads)]
+        if self.nodes == 1:
+            return " ".join(args)
+        for node in range(self.nodes):
+            args.append("-object {},size={}M,id={}".format(backends[self.memory_backend],
+                                                           self.node_memory_mb,
+                                                           backend_ids.format(node)))
+        for node in range(self.nodes):
+            cpus = self.node_cpus(node)
+            args.append("-numa node,memdev={},cpus={}-{},nodeid={}"\
+                        .format(backend_ids.format(node), cpus[0], cpus[-1], node))
+        symmetric = all([self.distances[s][d] == self.distances[d][s]
+                         for s in range(self.nodes) for d in range(self.nodes)])
+        for src in range(self.nodes):
+            for dst in range(self.nodes):
+                # QEMU fills in the reverse of each distance when all are symmetric.
+                if src == dst or (symmetric and dst < src):
+                    continue
+                args.append("-numa dist,src={},dst={},val={}"\
+                            .format(src, dst, self.distances[src][dst]))
+        return " ".join(args)
+
+    def get_name(self):
+        return "qemu-{}cpu-{}node".format(self.vcpus, self.nodes)
+
+    def get_platform_info(self):
+        """The keys of the LISA platform-info conf describing the topology."""
+        return {'name': self.get_name(),
+                'cpus-count': self.vcpus,
+                'numa-nodes-count': self.nodes}
+
+    def describe(self):
+        """Summary of the topology, including the distance matrix."""
+        return {'vcpus': self.vcpus,
+                'sockets': self.sockets,
+                'cores': self.cores,
+                'threads': self.threads,
+                'nodes': self.nodes,
+                'node_memory_mb': self.node_memory_mb,
+                'node_cpus': ["{}-{}".format(self.node_cpus(n)[0], self.node_cpus(n)[-1])
+                              for n in range(self.nodes)],
+                'distances': self.distances}
@@ -0,0 +1,125 @@
+#
+# Copyright 2020 Linaro
+#
+# Client of the controller, see controller.py.
+#
+# qemu_ctl.py launch --name vm1 [--snapshot] [-- launch_image.py args]
+# qemu_ctl.py run --name vm1 -- uname -a
+# qemu_ctl.py list
+# qemu_ctl.py stop --name vm1
+# qemu_ctl.py snapshot
+# qemu_ctl.py shutdown
+#
+#    The controller is started in the background if it is not running.
+#
+
+import sys
+import os
+import argparse
+from argparse import RawTextHelpFormatter
+import subprocess
+import yaml
+import qmp
+
+script_path = os.path.dirname(os.path.realpath(__file__))
+root_path = os.path.realpath(os.path.join(script_path, "../"))
+default_socket = os.path.join(root_path, "build", "controller.sock")
+
+def parse_args():
+    parser = argparse.ArgumentParser(formatter_class=RawTextHelpFormatter,
+                                     description="Send requests to the lisa-qemu controller.",
+                                     epilog="examples:\n"\
+                                     "    {0} launch --name vm1\n"\
+                                     "    {0} run --name vm1 -- uname -a\n"\
+                                     "    {0} stop --name vm1\n".format(sys.argv[0]))
+    parser.add_argument("--socket", default=default_socket,
+                        help="Unix socket of the controller.\n"\
+                        "default is build/controller.sock")
+    parser.add_argument("--idle_timeout", type=float, default=1800,
+                        help="Idle timeout of VMs, when the controller is started.\n"\
+                        "default is 1800")
+    subparsers = parser.add_subparsers(dest="request")
+    subparsers.required = True
+    launch = subparsers.add_parser("launch", help="Start a VM, or return the running one.")
+    launch.add_argument("--name", required=True)
+    launch.add_argument("--image_type", default="ubuntu.aarch64")
+    launch.add_argument("--config", default=None)
+    launch.add_argument("--snapshot", action="store_true",
+                        help="Restore the VM from its warm start snapshot.")
+    launch.add_argument("--no_wait", action="store_true",
+                        help="Return without waiting for the VM to be ready.")
+    launch.add_argument("launch_args", nargs=argparse.REMAINDER,
+                        help="Arguments after -- are passed to launch_image.py")
+    stop = subparsers.add_parser("stop", help="Power off a VM.")
+    stop.add_argument("--name", required=True)
+    run = subparsers.add_parser("run", help="Run a command in a VM.")
+    run.add_argument("--name", required=True)
+    run.add_argument("--timeout", type=float, default=None)
+    run.add_argument("command", nargs=argparse.REMAINDER)
+    snapshot = subparsers.add_parser("snapshot", help="Create the warm start snapshot.")
+    snapshot.add_argument("--image_type", default="ubuntu.aarch64")
+    snapshot.add_argument("--config", default=None)
+    snapshot.add_argument("launch_args", nargs=argparse.REMAINDER,
+                          help="Arguments after -- are passed to launch_image.py")
+    subparsers.add_parser("list", help="List the VMs.")
+    subparsers.add_parser("shutdown", help="Stop all VMs and the controller.")
+    args = parser.parse_args()
+    for key in ["launch_args", "command"]:
+        values = getattr(args, key, None)
+        if values and values[0] == "--":
+            setattr(args, key, values[1:])
+    return args
+
+def connect(args):
+    client = qmp.QMPClient(args.socket)
+    try:
+        client.connect(timeout=0)
+        return client
+    except qmp.QMPError:
+        if args.request == "shutdown":
+            raise
+    log_path = os.path.join(os.path.dirname(args.socket), "controller.log")
+    if not os.path.exists(os.path.dirname(log_path)):
+        os.makedirs(os.path.dirname(log_path))
+    with open(log_path, 'a') as log:
+        subprocess.Popen([sys.executable, os.path.join(script_path, "controller.py"),
+                          "--socket", args.socket, "--idle_timeout", str(args.idle_timeout)],
+                         stdout=log, stderr=subprocess.STDOUT, start_new_session=True)
+    client.connect(timeout=30)
+    return client
+
+def main():
+    args = parse_args()
+    client = connect(args)
+    rc = 0
+    try:
+        if args.request == "launch":
+            result = client.cmd("launch", vm_name=args.name, image_type=args.image_type,
+                                config=args.config and os.path.realpath(args.config),
+                                snapshot=args.snapshot, wait=not args.no_wait,
+                                launch_args=args.launch_args)
+        elif args.request == "snapshot":
+            result = client.cmd("snapshot", image_type=args.image_type,
+                                config=args.config and os.path.realpath(args.config),
+                                launch_args=args.launch_args)
+        elif args.request == "run":
+            result = client.cmd("run", vm_name=args.name, command=" ".join(args.command),
+                                timeout=args.timeout)
+            sys.stdout.write(result['stdout'])
+            sys.stderr.write(result['stderr'])
+            return result['rc']
+        elif args.request in ["stop"]:
+            result = client.cmd(args.request, vm_name=args.name)
+        else:
+            result = client.cmd(args.request)
+        if result:
+            print(yaml.dump(result, default_flow_style=False), end="")
+    except qmp.QMPError as e:
+        print("{}: {}".format(sys.argv[0], e))
+        rc = 1
+    finally:
+        client.close()
+    return rc
+
+if __name__ == "__main__":
+    exit(main())
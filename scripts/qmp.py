@@ -0,0 +1,88 @@
+#
+# Copyright 2020 Linaro
+#
+# Minimal client for the QEMU Machine Protocol (QMP).
+#
+# QEMU is started with: -qmp unix:[socket path],server,nowait
+# and this client connects to that socket to issue commands.
+#
+
+import os
+import json
+import socket
+import time
+
+class QMPError(Exception):
+    pass
+
+class QMPClient:
+    def __init__(self, socket_path):
+        self.socket_path = socket_path
+        self.sock = None
+        self.events = []
+        self._buffer = b""
+
+    def connect(self, timeout=60):
+        """Connect to QEMU, retrying until the socket shows up."""
+        deadline = time.time() + timeout
+        while True:
+            try:
+                self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                self.sock.connect(self.socket_path)
+                break
+            except (FileNotFoundError, ConnectionRefusedError):
+                self.sock.close()
+                self.sock = None
+                if time.time() > deadline:
+                    raise QMPError("could not connect to {}".format(self.socket_path))
+                time.sleep(0.2)
+        greeting = self._read_msg()
+        if 'QMP' not in greeting:
+            raise QMPError("unexpected greeting {}".format(greeting))
+        self.cmd("qmp_capabilities")
+
+    def close(self):
+        if self.sock:
+            self.sock.close()
+            self.sock = None
+
+    def _read_msg(self):
+        while b"\n" not in self._buffer:
+            data = self.sock.recv(65536)
+            if not data:
+                raise QMPError("connection to {} closed".format(self.socket_path))
+            self._buffer += data
+        line, self._buffer = self._buffer.split(b"\n", 1)
+        return json.loads(line)
+
+    def cmd(self, name, **args):
+        """Issue a command and return its result.  Events which arrive
+           in the meantime are kept in self.events."""
+        msg = {'execute': name}
+        if args:
+            msg['arguments'] = args
+        self.sock.sendall(json.dumps(msg).encode() + b"\n")
+        while True:
+            resp = self._read_msg()
+            if 'event' in resp:
+                self.events.append(resp)
+            elif 'error' in resp:
+                raise QMPError("{}: {}".format(name, resp['error'].get('desc', resp['error'])))
+            elif 'return' in resp:
+                return resp['return']
+
+    def hmp(self, command_line):
+        """Issue a human monitor command."""
+        return self.cmd("human-monitor-command", **{'command-line': command_line})
+
+    def wait_migration(self, timeout=600):
+        """Wait for an outgoing or incoming migration to finish."""
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            status = self.cmd("query-migrate").get('status')
+            if status == "completed":
+                return
+            if status in ["failed", "cancelled"]:
+                raise QMPError("migration {}".format(status))
+            time.sleep(0.2)
+        raise QMPError("migration did not complete in {}s".format(timeout))
@@ -0,0 +1,121 @@
+#
+# Copyright 2020 Linaro
+#
+# Cache of the rt-app calibration of a VM.
+#
+# rt-app workloads such as Periodic(duty_cycle_pct=50) only produce the
+# intended load with a calibration measured on the VM they run on.
+# Under TCG it depends on the host CPU, the accelerator and the guest
+# topology, so the calibration is cached next to the image, keyed by
+# the image file, its kernel, the qemu_args, the accelerator and the
+# host CPU.
+#
+# When run as a script, calibrates a running VM using LISA:
+#    rtapp_calib.py --target_conf [LISA target conf] --output [yaml]
+#
+
+import os
+import argparse
+import hashlib
+import importlib.util
+import platform
+import time
+import yaml
+
+def lisa_available():
+    return importlib.util.find_spec("lisa") != None
+
+def get_host_cpu():
+    """Model of the host CPU, from /proc/cpuinfo."""
+    fields = ["model name", "CPU implementer", "CPU architecture", "CPU variant", "CPU part"]
+    values = []
+    with open("/proc/cpuinfo") as f:
+        for line in f:
+            key, _, value = line.partition(":")
+            entry = "{}={}".format(key.strip(), value.strip())
+            if key.strip() in fields and entry not in values:
+                values.append(entry)
+    return "{} {}".format(platform.machine(), " ".join(values))
+
+class CalibrationCache:
+    file_prefix = "rtapp-calib-"
+
+    def __init__(self, image_dir_path, image_path, yaml_dict):
+        self.image_path = image_path
+        self.yaml_dict = yaml_dict
+        self.path = os.path.join(image_dir_path, "{}{}.yml".format(self.file_prefix,
+                                                                   os.path.basename(image_path)))
+        self.inputs = self.get_inputs()
+        self.key = self.compute_key()
+
+    def get_inputs(self):
+        conf = self.yaml_dict['qemu-conf']
+        inputs = {'image': self.get_image_id(),
+                  'cpu': conf.get('cpu', ""),
+                  'machine': conf.get('machine', ""),
+                  'qemu_args': " ".join(conf.get('qemu_args', "").split()),
+                  'accel': conf.get('accel_selected', ""),
+                  'host_cpu': get_host_cpu()}
+        # The kernel is either installed in the image, which then has
+        # it in its name, or given to QEMU with -kernel.
+        image_name = os.path.basename(self.image_path)
+        if ".kernel-" in image_name:
+            inputs['kernel'] = image_name.split(".kernel-")[-1]
+        args = inputs['qemu_args'].split()
+        for index, arg in enumerate(args[:-1]):
+            if arg == "-kernel" and os.path.exists(args[index + 1]):
+                st = os.stat(args[index + 1])
+                inputs['kernel'] = "{}:{}:{}".format(args[index + 1], st.st_size, st.st_mtime_ns)
+        return inputs
+
+    def get_image_id(self):
+        # An image rebuilt at the same path is a new file, so its inode
+        # changes.  The size and mtime change with every launch which
+        # writes to the image, so are not used.
+        image_path = os.path.realpath(self.image_path)
+        if not os.path.exists(image_path):
+            return image_path
+        return "{}:{}".format(image_path, os.stat(image_path).st_ino)
+
+    def compute_key(self):
+        sha = hashlib.sha256()
+        for key, value in sorted(self.inputs.items()):
+            sha.update("{}={}\n".format(key, value).encode())
+        return sha.hexdigest()[:16]
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return {}
+        with open(self.path) as f:
+            return yaml.safe_load(f) or {}
+
+    def lookup(self):
+        entry = self.load().get(self.key)
+        return entry['calib'] if entry else None
+
+    def commit(self, calib):
+        entries = self.load()
+        entries[self.key] = {'calib': calib,
+                             'created': time.time(),
+                             'inputs': self.inputs}
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, 'w') as f:
+            yaml.dump(entries, f)
+        os.rename(tmp_path, self.path)
+
+def calibrate(target_conf, output):
+    from lisa.target import Target
+    from lisa.wlgen.rta import RTA
+    target = Target.from_one_conf(target_conf)
+    calib = RTA.get_cpu_calibrations(target)
+    with open(output, 'w') as f:
+        yaml.dump({'calib': {int(cpu): int(value) for cpu, value in calib.items()}}, f)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Measure the rt-app calibration of a VM.")
+    parser.add_argument("--target_conf", required=True,
+                        help="LISA target conf of the running VM.")
+    parser.add_argument("--output", required=True,
+                        help="yaml file to write the calibration to.")
+    args = parser.parse_args()
+    calibrate(args.target_conf, args.output)
@@ -0,0 +1,331 @@
+#
+# Copyright 2020 Linaro
+#
+# Runs LISA tests in parallel on a pool of VMs.
+#
+# run_tests.py --vms [N] --tests [test ids] -- [launch_image.py args]
+#
+#    Launches N VMs of the same image, each on its own overlay and ssh
+#    port with its own LISA target conf.  The tests are handed out to
+#    the VMs as they become idle, and the VMs are shut down at the end.
+#    Logs and artifacts of each test are in [results_dir]/vm[N]/[test],
+#    and a summary is written to [results_dir]/summary.yml.
+#
+
+import sys
+import os
+import re
+import shlex
+import argparse
+from argparse import RawTextHelpFormatter
+import collections
+import time
+import yaml
+import base_cmd
+import boot_monitor
+import host_topology
+import numa_topology
+
+class TestVM:
+    """A VM of the pool and the files of its launch."""
+
+    def __init__(self, index, path):
+        self.index = index
+        self.name = "vm{}".format(index)
+        self.path = path
+        self.lisa_config_path = os.path.join(path, "target_vm.yml")
+        self.platform_info_path = os.path.join(path, "target_vm_platform_info.yml")
+        self.launch_marker_path = os.path.join(path, "target_vm_launching.yml")
+        self.target_conf_path = os.path.join(path, "target.yml")
+        self.launch_log_path = os.path.join(path, "launch.log")
+        self.launch = None
+        self.monitor = None
+        self.lisa_config = None
+        self.test = None
+        self.failed = False
+
+    def poll_ready(self):
+        """Returns True once the guest ssh is ready."""
+        if self.monitor == None:
+            if not os.path.exists(self.lisa_config_path):
+                return False
+            with open(self.lisa_config_path) as f:
+                self.lisa_config = yaml.safe_load(f)
+            if not self.lisa_config:
+                return False
+            self.monitor = boot_monitor.BootMonitor(self.lisa_config['port'])
+            self.monitor.start()
+        return self.monitor.poll()
+
+    def write_target_conf(self):
+        target_conf = {'target-conf': self.lisa_config}
+        if os.path.exists(self.platform_info_path):
+            with open(self.platform_info_path) as f:
+                target_conf['platform-info'] = yaml.safe_load(f)
+        with open(self.target_conf_path, 'w') as f:
+            yaml.dump(target_conf, f)
+
+class RunTests(base_cmd.BaseCmd):
+    build_path_rel = "build"
+    default_config_file = "conf/conf_default.yml"
+    default_lisa_cmd = "lisa-test {test} --conf {conf} --artifact-dir {artifact_dir}"
+    # The guest command keeps the VM up until it is powered off.
+    guest_cmd = "sleep 1000000"
+    ssh_opts = "-o StrictHostKeyChecking=no -o UserKnownHostsFile=/dev/null -o LogLevel=QUIET"
+    shutdown_timeout = 120
+
+    def __init__(self):
+        super(RunTests, self).__init__()
+        self.script_path = os.path.dirname(os.path.realpath(__file__))
+        self.root_path = os.path.realpath(os.path.join(self.script_path, "../"))
+        self.build_path = os.path.join(self.root_path, self.build_path_rel)
+        self.parse_args()
+        self.set_debug(self._args.debug)
+        self.set_dry_run(self._args.dry_run)
+        self.set_trace_path(self._args.trace)
+        self.continue_on_error = True
+        self.results_path = os.path.realpath(self._args.results_dir)
+        self.summary_path = os.path.join(self.results_path, "summary.yml")
+        self.vms = []
+
+    def parse_args(self):
+        parser = argparse.ArgumentParser(formatter_class=RawTextHelpFormatter,
+                                         description="Run LISA tests in parallel on a pool of VMs.",
+                                         epilog="examples:\n"\
+                                         "    {} --vms 4 --tests "\
+                                         "NUMAMultipleTasksPlacement:test_task_remains "\
+                                         "-- --image_type ubuntu.aarch64\n".format(sys.argv[0]))
+        parser.add_argument("--debug", action="store_true",
+                            help="enable debug output")
+        parser.add_argument("--dry_run", action="store_true",
+                            help="Just show the commands, do not execute them.")
+        parser.add_argument("--trace", default=os.environ.get('LISA_QEMU_TRACE', ""),
+                            help="Write a timing trace of all commands and phases\n"\
+                            "to this file in Chrome trace format.\n"\
+                            "Can also be set with environment variable LISA_QEMU_TRACE.")
+        parser.add_argument("--tests", nargs="+", default=[],
+                            help="LISA test ids to run.")
+        parser.add_argument("--tests_file", default="",
+                            help="File with one LISA test id per line.")
+        parser.add_argument("--vms", type=int, default=0,
+                            help="Number of VMs to run the tests on.\n"\
+                            "default is the host cores divided by the vCPUs of a VM")
+        parser.add_argument("--config", default=os.path.join(self.root_path,
+                                                             self.default_config_file),
+                            help="config file of the VMs.\n"\
+                            "default is conf/conf_default.yml")
+        parser.add_argument("--results_dir",
+                            default=os.path.join(self.build_path, "test-results",
+                                                 time.strftime("%Y%m%d-%H%M%S")),
+                            help="Directory for the per VM results and the summary.\n"\
+                            "default is build/test-results/[date-time]")
+        parser.add_argument("--lisa_cmd", default=self.default_lisa_cmd,
+                            help="Command running one test, with {test}, {conf}\n"\
+                            "and {artifact_dir} filled in.\n"\
+                            "default is " + self.default_lisa_cmd)
+        parser.add_argument("--test_timeout", type=float, default=None,
+                            help="Seconds after which a test is stopped.")
+        parser.add_argument("--boot_timeout", type=float, default=1800,
+                            help="Seconds to wait for the VMs to be ready.\n"\
+                            "default is 1800")
+        parser.add_argument("launch_args", nargs=argparse.REMAINDER,
+                            help="Arguments after -- are passed to launch_image.py")
+        self._args = parser.parse_args()
+        if self._args.launch_args and self._args.launch_args[0] == "--":
+            self._args.launch_args = self._args.launch_args[1:]
+
+    def get_tests(self):
+        tests = list(self._args.tests)
+        if self._args.tests_file:
+            with open(self._args.tests_file) as f:
+                tests += [line.strip() for line in f
+                          if line.strip() and not line.startswith("#")]
+        return tests
+
+    def get_vm_count(self, tests):
+        if self._args.vms:
+            return min(self._args.vms, len(tests))
+        with open(self._args.config) as f:
+            conf = yaml.safe_load(f)['qemu-conf']
+        if 'topology' in conf:
+            vcpus = numa_topology.NumaTopology(conf['topology'], conf['memory'],
+                                               conf.get('machine', "")).vcpus
+        else:
+            vcpus = host_topology.get_smp_cpus(conf.get('qemu_args', ""))
+        return max(1, min(os.cpu_count() // vcpus, len(tests)))
+
+    def start_vm(self, vm):
+        if not os.path.exists(vm.path):
+            os.makedirs(vm.path)
+        for path in [vm.lisa_config_path, vm.platform_info_path, vm.launch_marker_path]:
+            if os.path.exists(path):
+                os.remove(path)
+        args = ["--config", os.path.realpath(self._args.config),
+                "--overlay", "--ssh_port", "auto",
+                "--lisa_config", vm.lisa_config_path,
+                "--guest_cmd", self.guest_cmd]
+        if self._debug:
+            args.append("--debug")
+        # Commands are split like a shell would, so quote each argument.
+        argv = [sys.executable, os.path.join(self.script_path, "launch_image.py")]
+        cmd = " ".join([shlex.quote(arg) for arg in argv + args + self._args.launch_args])
+        vm.launch = self.start_command(cmd, show_cmd=self._dry_run, enable_stdout=False,
+                                       log_path=vm.launch_log_path)
+        self.print("{} launching, log: {}".format(vm.name, vm.launch_log_path))
+
+    def start_vms(self, count):
+        # The first launch fills the caches, such as the rt-app calibration,
+        # so the others are started once it is about to boot, which it
+        # marks after the calibration is cached.
+        self.vms = [TestVM(index, os.path.join(self.results_path, "vm{}".format(index)))
+                    for index in range(count)]
+        self.start_vm(self.vms[0])
+        if not self._dry_run:
+            self.wait_commands([self.vms[0].launch],
+                               until=lambda: os.path.exists(self.vms[0].launch_marker_path))
+        for vm in self.vms[1:]:
+            self.start_vm(vm)
+
+    def wait_vms_ready(self):
+        deadline = time.time() + self._args.boot_timeout
+        def all_settled():
+            for vm in self.vms:
+                if vm.launch.done() and not vm.failed:
+                    self.print("{} exited before it was ready, see {}".format(vm.name,
+                                                                            vm.launch_log_path))
+                    vm.failed = True
+            return time.time() > deadline or \
+                   all([vm.failed or vm.poll_ready() for vm in self.vms])
+        with self.phase("boot"):
+            self.wait_commands([vm.launch for vm in self.vms], until=all_settled)
+        for vm in self.vms:
+            if not vm.failed and not vm.poll_ready():
+                self.print("{} not ready after {}s".format(vm.name, self._args.boot_timeout))
+                vm.failed = True
+            if not vm.failed:
+                vm.write_target_conf()
+                self.print("{} ready on port {} after {:.1f}s".format(vm.name, vm.lisa_config['port'],
+                           vm.monitor.ready_time - vm.launch.start_time))
+        return [vm for vm in self.vms if not vm.failed]
+
+    def start_test(self, vm, test):
+        test_dir = os.path.join(vm.path, re.sub(r"[^\w.-]", "_", test))
+        if not os.path.exists(test_dir):
+            os.makedirs(test_dir)
+        cmd = self._args.lisa_cmd.format(test=test, conf=vm.target_conf_path,
+                                         artifact_dir=os.path.join(test_dir, "artifacts"))
+        log_path = os.path.join(test_dir, "test.log")
+        command = self.start_command(cmd, enable_stdout=False, log_path=log_path,
+                                     timeout=self._args.test_timeout)
+        vm.test = {'test': test, 'vm': vm.name, 'log': log_path,
+                   'command': command, 'start': time.time()}
+        self.print("{} running {}".format(vm.name, test))
+
+    def finish_test(self, vm):
+        result = vm.test
+        command = result.pop('command')
+        result['rc'] = command.rc
+        result['status'] = "passed" if command.rc == 0 else "failed"
+        if command.timed_out:
+            result['status'] = "timed out"
+        result['duration'] = round(time.time() - result.pop('start'), 1)
+        self.print("{} {} {} in {}s".format(vm.name, result['test'], result['status'],
+                                           result['duration']))
+        vm.test = None
+        return result
+
+    def run_tests(self, vms, tests):
+        pending = collections.deque(tests)
+        results = []
+        with self.phase("tests"):
+            while pending or any([vm.test for vm in vms]):
+                for vm in vms:
+                    if vm.test and vm.test['command'].done():
+                        results.append(self.finish_test(vm))
+                    if vm.launch.done() and not vm.failed:
+                        self.print("{} exited, no more tests run on it".format(vm.name))
+                        vm.failed = True
+                    if not vm.test and not vm.failed and pending:
+                        self.start_test(vm, pending.popleft())
+                running = [vm.test['command'] for vm in vms if vm.test]
+                if not running:
+                    break
+                # The launches are waited on too, to drain their output.
+                self.wait_commands(running + [vm.launch for vm in vms],
+                                   until=lambda: any([c.done() for c in running]))
+        for test in pending:
+            results.append({'test': test, 'status': "not run"})
+        return results
+
+    def stop_vms(self):
+        launches = []
+        for vm in self.vms:
+            if vm.launch == None or vm.launch.done():
+                continue
+            if vm.failed or vm.monitor == None or not vm.monitor.ready:
+                # Not ready for ssh, so it cannot be powered off.
+                vm.launch.cancel()
+                self.finish_command(vm.launch)
+                continue
+            launches.append(vm.launch)
+            if vm.lisa_config:
+                self.issue_cmd("ssh {} -p {} -i {} root@127.0.0.1 poweroff"\
+                               .format(self.ssh_opts, vm.lisa_config['port'],
+                                       vm.lisa_config['keyfile']),
+                               fail_on_err=False, enable_stdout=False)
+        deadline = time.time() + self.shutdown_timeout
+        with self.phase("shutdown"):
+            self.wait_commands(launches, until=lambda: time.time() > deadline)
+        for launch in launches:
+            if not launch.done():
+                launch.cancel()
+                self.finish_command(launch)
+
+    def write_summary(self, results, duration):
+        summary = {'duration': round(duration, 1),
+                   'vms': len(self.vms),
+                   'failed': len([r for r in results if r['status'] != "passed"]),
+                   'tests': results}
+        with open(self.summary_path, 'w') as f:
+            yaml.dump(summary, f)
+        print("")
+        print("{:<60} {:>6} {:>10} {:>10}".format("test", "vm", "status", "duration"))
+        for result in results:
+            print("{:<60} {:>6} {:>10} {:>9}s".format(result['test'], result.get('vm', "-"),
+                                                       result['status'],
+                                                       result.get('duration', "-")))
+        print("total: {}s on {} VMs, {} of {} failed".format(summary['duration'], summary['vms'],
+                                                             summary['failed'], len(results)))
+        print("summary: {}".format(self.summary_path))
+
+    def run(self):
+        tests = self.get_tests()
+        if not tests:
+            self.print("no tests given, use --tests or --tests_file")
+            return 1
+        if not os.path.exists(self.results_path):
+            os.makedirs(self.results_path)
+        start = time.time()
+        count = self.get_vm_count(tests)
+        self.print("running {} tests on {} VMs".format(len(tests), count))
+        results = []
+        try:
+            self.start_vms(count)
+            if self._dry_run:
+                for test in tests:
+                    print(self._args.lisa_cmd.format(test=test, conf="[vm]/target.yml",
+                                                     artifact_dir="[vm]/[test]/artifacts"))
+                return 0
+            vms = self.wait_vms_ready()
+            if vms:
+                results = self.run_tests(vms, tests)
+            else:
+                results = [{'test': test, 'status': "not run"} for test in tests]
+        finally:
+            self.stop_vms()
+        self.write_summary(results, time.time() - start)
+        return 0 if all([r['status'] == "passed" for r in results]) else 1
+
+if __name__ == "__main__":
+    inst_obj = RunTests()
+    exit(inst_obj.run())
@@ -0,0 +1,139 @@
+#
+# Copyright 2020 Linaro
+#
+# Runs the steps of a workflow as a dependency graph.
+#
+# Each step declares the steps it depends on, and the files it reads
+# and writes.  A step starts as soon as the steps it depends on are
+# done, so independent steps run concurrently.  A step is skipped when
+# its outputs are newer than its inputs, or when its own check says it
+# is up to date.  The time each step took is kept, to estimate the
+# time of the next run.
+#
+#    graph = StepGraph(times_path, print_fn)
+#    graph.add("keys", create_keys, inputs=[src], outputs=[dst])
+#    graph.add("image", build_image, deps=["keys"])
+#    graph.print_plan()
+#    graph.run()
+#
+
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import yaml
+
+class Step:
+    def __init__(self, name, fn, deps, inputs, outputs, check):
+        self.name = name
+        self.fn = fn
+        self.deps = deps
+        self.inputs = inputs
+        self.outputs = outputs
+        self.check = check
+
+    @staticmethod
+    def resolve(paths):
+        # Paths can be given as a function, for paths only known once
+        # the steps before have run.
+        return paths() if callable(paths) else paths
+
+    def up_to_date(self):
+        if self.check:
+            return self.check()
+        outputs = self.resolve(self.outputs)
+        if not outputs or not all(os.path.exists(path) for path in outputs):
+            return False
+        inputs = [path for path in self.resolve(self.inputs) if os.path.exists(path)]
+        if not inputs:
+            return True
+        return min(os.stat(path).st_mtime for path in outputs) >= \
+               max(os.stat(path).st_mtime for path in inputs)
+
+class StepGraph:
+    def __init__(self, times_path, print_fn=print, dry_run=False):
+        self.times_path = times_path
+        self.print = print_fn
+        self.dry_run = dry_run
+        self.steps = {}
+        self.times = {}
+        if os.path.exists(times_path):
+            with open(times_path) as f:
+                self.times = yaml.safe_load(f) or {}
+
+    def add(self, name, fn, deps=[], inputs=[], outputs=[], check=None):
+        """Add a step.  Without inputs, outputs or check it always runs."""
+        for dep in deps:
+            if dep not in self.steps:
+                raise Exception("step {} depends on unknown step {}".format(name, dep))
+        self.steps[name] = Step(name, fn, deps, inputs, outputs, check)
+
+    def get_plan(self):
+        """The steps in the order they start, with whether they run
+           and the estimated times they start and end."""
+        plan = []
+        end = {}
+        for step in self.steps.values():
+            runs = not step.up_to_date()
+            estimate = self.times.get(step.name) if runs else 0
+            start = max([end[dep] for dep in step.deps], default=0)
+            end[step.name] = start + (estimate or 0)
+            plan.append({'step': step.name, 'runs': runs, 'estimate': estimate,
+                         'start': start, 'deps': step.deps})
+        return sorted(plan, key=lambda entry: entry['start'])
+
+    def print_plan(self):
+        plan = self.get_plan()
+        self.print("plan:")
+        for entry in plan:
+            if not entry['runs']:
+                estimate = "up to date"
+            elif entry['estimate'] == None:
+                estimate = "no estimate"
+            else:
+                estimate = "{:.1f}s".format(entry['estimate'])
+            deps = " after {}".format(", ".join(entry['deps'])) if entry['deps'] else ""
+            self.print("  +{:7.1f}s  {:<12} {}{}".format(entry['start'], entry['step'],
+                                                          estimate, deps))
+        total = max([e['start'] + (e['estimate'] or 0) for e in plan if e['runs']], default=0)
+        self.print("estimated time: {:.1f}s".format(total))
+
+    def run_step(self, step):
+        if step.up_to_date():
+            self.print("{}: up to date".format(step.name))
+            return None
+        start = time.time()
+        step.fn()
+        return time.time() - start
+
+    def run(self):
+        """Run the steps, each as soon as the steps it depends on are done.
+           A failing step stops new steps from starting and is raised
+           once the running steps are done."""
+        done = set()
+        pending = list(self.steps.values())
+        running = {}
+        error = None
+        with ThreadPoolExecutor(max_workers=len(self.steps) or 1) as executor:
+            while pending or running:
+                if error == None:
+                    for step in [s for s in pending if all(d in done for d in s.deps)]:
+                        pending.remove(step)
+                        running[executor.submit(self.run_step, step)] = step
+                if not running:
+                    break
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    step = running.pop(future)
+                    try:
+                        duration = future.result()
+                    except BaseException as e:
+                        error = error or e
+                        continue
+                    done.add(step.name)
+                    if duration != None:
+                        self.times[step.name] = round(duration, 1)
+        if not self.dry_run:
+            with open(self.times_path, 'w') as f:
+                yaml.dump(self.times, f)
+        if error != None:
+            raise error
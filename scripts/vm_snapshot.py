@@ -0,0 +1,106 @@
+#
+# Copyright 2020 Linaro
+#
+# Saved VM state used for warm starts by launch_image.py --snapshot.
+#
+# A snapshot lives in a directory next to the image and holds:
+#    disk.qcow2    overlay backed by the image, frozen when the state was saved.
+#    state.mig     migration stream of the VM, saved once ssh was ready.
+#    snapshot.yml  metadata describing what the snapshot was taken from.
+#    conf.yml      config for the launcher, with the extra qemu_args.
+#
+# The directory name contains a hash of the image, kernel files,
+# qemu_args and QEMU binary, so any change to these selects a new
+# snapshot and the stale one is removed.
+#
+
+import os
+import glob
+import shutil
+import hashlib
+import time
+import yaml
+
+class VMSnapshot:
+    disk_name = "disk.qcow2"
+    state_name = "state.mig"
+    metadata_name = "snapshot.yml"
+    config_name = "conf.yml"
+
+    def __init__(self, image_dir_path, image_path, yaml_dict, qemu_build_path):
+        self.image_dir_path = image_dir_path
+        self.image_path = image_path
+        self.yaml_dict = yaml_dict
+        self.qemu_build_path = qemu_build_path
+        self.key = self.compute_key()
+        self.prefix = "snapshot-{}-".format(os.path.basename(image_path))
+        self.path = os.path.join(image_dir_path, self.prefix + self.key)
+        self.disk_path = os.path.join(self.path, self.disk_name)
+        self.state_path = os.path.join(self.path, self.state_name)
+        self.metadata_path = os.path.join(self.path, self.metadata_name)
+        self.config_path = os.path.join(self.path, self.config_name)
+
+    @staticmethod
+    def file_fingerprint(path):
+        st = os.stat(path)
+        return "{}:{}:{}".format(os.path.realpath(path), st.st_size, st.st_mtime_ns)
+
+    def get_input_files(self):
+        """The image, QEMU binaries and any files referenced by qemu_args,
+           such as the kernel and initrd."""
+        files = [self.image_path]
+        files += sorted(glob.glob(os.path.join(self.qemu_build_path,
+                                               "*-softmmu", "qemu-system-*")))
+        qemu_args = self.yaml_dict['qemu-conf'].get('qemu_args', "")
+        for arg in qemu_args.split():
+            for value in arg.split(","):
+                value = value.split("=")[-1]
+                if os.path.isabs(value) and os.path.isfile(value):
+                    files.append(value)
+        return files
+
+    def compute_key(self):
+        sha = hashlib.sha256()
+        conf = self.yaml_dict['qemu-conf']
+        for key in ['cpu', 'machine', 'memory', 'qemu_args']:
+            sha.update("{}={}\n".format(key, conf.get(key, "")).encode())
+        for file in self.get_input_files():
+            if os.path.exists(file):
+                sha.update(self.file_fingerprint(file).encode())
+        return sha.hexdigest()[:16]
+
+    def valid(self):
+        return os.path.exists(self.metadata_path) and \
+               os.path.exists(self.state_path) and \
+               os.path.exists(self.disk_path)
+
+    def remove_stale(self):
+        for path in glob.glob(os.path.join(self.image_dir_path, self.prefix + "*")):
+            if path != self.path:
+                shutil.rmtree(path, ignore_errors=True)
+
+    def prepare(self):
+        """Start a new snapshot, removing any stale or partial one."""
+        self.remove_stale()
+        if os.path.exists(self.path):
+            shutil.rmtree(self.path, ignore_errors=True)
+        os.makedirs(self.path)
+
+    def write_config(self, extra_args, config_path=None):
+        config_path = config_path or self.config_path
+        yaml_dict = dict(self.yaml_dict)
+        yaml_dict['qemu-conf'] = dict(yaml_dict['qemu-conf'])
+        qemu_args = yaml_dict['qemu-conf'].get('qemu_args', "")
+        yaml_dict['qemu-conf']['qemu_args'] = "{} {}".format(qemu_args, extra_args)
+        with open(config_path, 'w') as f:
+            yaml.dump(yaml_dict, f)
+        return config_path
+
+    def commit(self, boot_time):
+        metadata = {'key': self.key,
+                    'image': self.image_path,
+                    'inputs': self.get_input_files(),
+                    'created': time.time(),
+                    'boot_time': round(boot_time, 1)}
+        with open(self.metadata_path, 'w') as f:
+            yaml.dump(metadata, f)
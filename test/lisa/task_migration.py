@@ -0,0 +1,124 @@
+#
+# Copyright 2020 Linaro
+#
+# Task migration analysis of a sched_switch trace.
+#
+# All tasks are analyzed in one vectorized pass over the sched_switch
+# frame, so the cost grows with the number of events rather than with
+# tasks times events.  This keeps 256 CPU traces tractable.
+#
+#    df = trace.df_events('sched_switch')
+#    cpu_nodes = get_cpu_nodes(target)
+#    migrations = task_migrations(df, cpu_nodes)
+#    residency = task_residency(df, cpu_nodes)
+#
+
+import pandas as pd
+
+def parse_cpulist(cpulist):
+    """Parse a cpu list like 0-3,8,10-11 into a list of ints."""
+    cpus = []
+    for entry in cpulist.strip().split(","):
+        if not entry:
+            continue
+        if "-" in entry:
+            first, last = entry.split("-")
+            cpus += list(range(int(first), int(last) + 1))
+        else:
+            cpus.append(int(entry))
+    return cpus
+
+def get_cpu_nodes(target):
+    """Map of CPU to NUMA node of target, read from sysfs.
+       All CPUs are in node 0 if the kernel has no NUMA support."""
+    node_path = "/sys/devices/system/node"
+    cpu_nodes = {}
+    if target.file_exists(node_path):
+        for name in target.list_directory(node_path):
+            if not name.startswith("node") or not name[len("node"):].isdigit():
+                continue
+            cpulist = target.read_value("{}/{}/cpulist".format(node_path, name))
+            for cpu in parse_cpulist(cpulist):
+                cpu_nodes[cpu] = int(name[len("node"):])
+    if not cpu_nodes:
+        cpu_nodes = {cpu: 0 for cpu in range(target.number_of_cpus)}
+    return cpu_nodes
+
+def get_task_pids(df, comms, pid_col='next_pid', comm_col='next_comm'):
+    """pid of the first task switched in with each of comms."""
+    tasks = df[df[comm_col].isin(comms)]
+    pids = tasks.groupby(comm_col)[pid_col].first()
+    return [int(pids[comm]) for comm in comms if comm in pids]
+
+def _switch_in(df, pid_col, comm_col, cpu_col):
+    """Events of tasks being switched in, without the idle tasks."""
+    events = df[[pid_col, comm_col, cpu_col]]
+    events = events[events[pid_col] != 0]
+    return events.rename(columns={pid_col: 'pid', comm_col: 'comm', cpu_col: 'cpu'})
+
+def task_migrations(df, cpu_nodes=None, pid_col='next_pid', comm_col='next_comm',
+                    cpu_col='__cpu'):
+    """Every migration of every task in a sched_switch frame.
+
+    A task migrated when it is switched in on another CPU than the one
+    it was last switched in on.  Returns a frame indexed by the time the
+    task was switched in on the destination CPU, with columns pid, comm,
+    src_cpu, dst_cpu, last_src_time (last switch in on the source CPU),
+    and with cpu_nodes also src_node, dst_node and node_crossing.
+    """
+    events = _switch_in(df, pid_col, comm_col, cpu_col)
+    times = events.index.to_series(index=events.index)
+    by_pid = events.groupby('pid', sort=False)
+    prev_cpu = by_pid['cpu'].shift()
+    prev_time = times.groupby(events['pid'], sort=False).shift()
+    moved = prev_cpu.notna() & (prev_cpu != events['cpu'])
+    migrations = pd.DataFrame({'pid': events['pid'][moved],
+                               'comm': events['comm'][moved],
+                               'src_cpu': prev_cpu[moved].astype(int),
+                               'dst_cpu': events['cpu'][moved],
+                               'last_src_time': prev_time[moved]})
+    if cpu_nodes is not None:
+        migrations['src_node'] = migrations['src_cpu'].map(cpu_nodes)
+        migrations['dst_node'] = migrations['dst_cpu'].map(cpu_nodes)
+        migrations['node_crossing'] = migrations['src_node'] != migrations['dst_node']
+    return migrations
+
+def task_residency(df, cpu_nodes=None, end=None, pid_col='next_pid',
+                   comm_col='next_comm', cpu_col='__cpu'):
+    """Time each task ran on each CPU, and with cpu_nodes on each node.
+
+    A task runs on a CPU from being switched in until the next
+    sched_switch of that CPU.  The last task of each CPU runs until end,
+    the end of the trace by default.  Returns a frame indexed by pid
+    with one column per CPU, and one per node when cpu_nodes is given.
+    """
+    if end is None:
+        end = df.index[-1]
+    times = df.index.to_series(index=df.index)
+    # The time each task was switched out: the next event on its CPU.
+    switched_out = times.groupby(df[cpu_col], sort=False).shift(-1).fillna(end)
+    running = pd.DataFrame({'pid': df[pid_col],
+                            'cpu': df[cpu_col],
+                            'duration': switched_out - times})
+    running = running[running['pid'] != 0]
+    residency = running.groupby(['pid', 'cpu'])['duration'].sum().unstack(fill_value=0)
+    residency.columns = ["cpu{}".format(cpu) for cpu in residency.columns]
+    if cpu_nodes is not None:
+        running['node'] = running['cpu'].map(cpu_nodes)
+        nodes = running.groupby(['pid', 'node'])['duration'].sum().unstack(fill_value=0)
+        nodes.columns = ["node{}".format(node) for node in nodes.columns]
+        residency = residency.join(nodes)
+    return residency
+
+def migration_summary(migrations, residency):
+    """Per task count of migrations and node crossings, with the residency."""
+    by_pid = migrations.groupby('pid')
+    summary = pd.DataFrame({'comm': by_pid['comm'].last(),
+                            'migrations': by_pid.size()})
+    if 'node_crossing' in migrations:
+        summary['node_crossings'] = by_pid['node_crossing'].sum()
+    summary = residency.join(summary, how='left')
+    summary['migrations'] = summary['migrations'].fillna(0).astype(int)
+    if 'node_crossings' in summary:
+        summary['node_crossings'] = summary['node_crossings'].fillna(0).astype(int)
+    return summary
@@ -0,0 +1,108 @@
+#
+# Copyright 2020 Linaro
+#
+# Columnar cache of the event frames parsed from a trace.dat.
+#
+# Parsing a long trace.dat takes minutes, so the parsed frames are
+# kept next to it in feather files, one per event, under
+# trace-cache/[trace hash]-[events hash].  Later runs memory map them
+# and only read the columns asked for, without parsing the trace.
+#
+#    cache = TraceEventCache(trace_path, ["sched_switch"], target.plat_info)
+#    df = cache.df_events('sched_switch', columns=['next_pid', '__cpu'])
+#
+
+import os
+import hashlib
+import yaml
+
+try:
+    import pyarrow.feather as feather
+except ImportError:
+    feather = None
+
+class TraceEventCache:
+    cache_dir_name = "trace-cache"
+    hash_memo_name = "hashes.yml"
+    index_name = "Time"
+
+    def __init__(self, trace_path, events, plat_info=None):
+        self.trace_path = os.path.realpath(trace_path)
+        self.events = sorted(events)
+        self.plat_info = plat_info
+        self._trace = None
+        self.cache_root = os.path.join(os.path.dirname(self.trace_path), self.cache_dir_name)
+        events_hash = hashlib.sha256(" ".join(self.events).encode()).hexdigest()[:8]
+        self.path = os.path.join(self.cache_root, "{}-{}".format(self.get_trace_hash()[:16],
+                                                                 events_hash))
+
+    @property
+    def enabled(self):
+        return feather is not None
+
+    def get_trace_hash(self):
+        # Hashing a large trace takes a while, so the hash is remembered
+        # for the size and modification time of the trace.
+        st = os.stat(self.trace_path)
+        stamp = "{}:{}".format(st.st_size, st.st_mtime_ns)
+        memo_path = os.path.join(self.cache_root, self.hash_memo_name)
+        memo = {}
+        if os.path.exists(memo_path):
+            with open(memo_path) as f:
+                memo = yaml.safe_load(f) or {}
+        entry = memo.get(self.trace_path)
+        if entry and entry['stamp'] == stamp:
+            return entry['hash']
+        sha = hashlib.sha256()
+        with open(self.trace_path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                sha.update(chunk)
+        memo[self.trace_path] = {'stamp': stamp, 'hash': sha.hexdigest()}
+        os.makedirs(self.cache_root, exist_ok=True)
+        # Renamed into place, so concurrent analyses never read a partial memo.
+        tmp_path = self.tmp_path(memo_path)
+        with open(tmp_path, 'w') as f:
+            yaml.dump(memo, f)
+        os.rename(tmp_path, memo_path)
+        return sha.hexdigest()
+
+    @staticmethod
+    def tmp_path(path):
+        # Per process, so concurrent writers do not share a temp file.
+        return "{}.{}.tmp".format(path, os.getpid())
+
+    @property
+    def trace(self):
+        """The LISA trace, only parsed when an event is not cached."""
+        if self._trace is None:
+            from lisa.trace import Trace
+            self._trace = Trace(self.trace_path, self.plat_info, events=self.events)
+        return self._trace
+
+    def event_path(self, event):
+        return os.path.join(self.path, "{}.feather".format(event))
+
+    def store(self, event, df):
+        os.makedirs(self.path, exist_ok=True)
+        df = df.rename_axis(self.index_name).reset_index()
+        # Feather needs string column names.
+        df.columns = [str(column) for column in df.columns]
+        tmp_path = self.tmp_path(self.event_path(event))
+        feather.write_feather(df, tmp_path)
+        os.rename(tmp_path, self.event_path(event))
+
+    def df_events(self, event, columns=None):
+        """Frame of event indexed by time.  With columns, only those are
+           read from the cache."""
+        if event not in self.events:
+            raise ValueError("event {} is not one of the cached events {}".format(event,
+                                                                                self.events))
+        if not self.enabled:
+            df = self.trace.df_events(event)
+            return df[columns] if columns else df
+        if not os.path.exists(self.event_path(event)):
+            self.store(event, self.trace.df_events(event))
+        read_columns = [self.index_name] + columns if columns else None
+        table = feather.read_table(self.event_path(event), columns=read_columns,
+                                   memory_map=True)
+        return table.to_pandas().set_index(self.index_name)
@@ -0,0 +1,14 @@
+#
+# Copyright 2020 Linaro
+#
+# Unit tests of the host independent modules of scripts and test/lisa.
+#
+#    python3 -m pytest test/unit
+#
+
+import os
+import sys
+
+root_path = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+for path in ["scripts", os.path.join("test", "lisa")]:
+    sys.path.insert(0, os.path.join(root_path, path))
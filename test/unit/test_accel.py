@@ -0,0 +1,34 @@
+#
+# Copyright 2020 Linaro
+#
+
+import accel
+
+def fake_host(monkeypatch, machine, kvm_access):
+    monkeypatch.setattr(accel.platform, "machine", lambda: machine)
+    monkeypatch.setattr(accel.os, "access", lambda path, mode: kvm_access)
+
+def test_auto_selects_kvm_on_same_arch(monkeypatch):
+    fake_host(monkeypatch, "aarch64", True)
+    assert accel.select_accel("auto", "aarch64", 4) == ("kvm", "-accel kvm")
+    fake_host(monkeypatch, "AMD64", True)
+    assert accel.select_accel("auto", "x86_64", 4) == ("kvm", "-accel kvm")
+
+def test_auto_falls_back_to_tcg(monkeypatch):
+    fake_host(monkeypatch, "x86_64", True)
+    assert accel.select_accel("auto", "aarch64", 4) == \
+           ("tcg", "-accel tcg,thread=multi,tb-size=256")
+    fake_host(monkeypatch, "aarch64", False)
+    assert accel.select_accel("auto", "aarch64", 8)[0] == "tcg"
+
+def test_explicit_accel(monkeypatch):
+    fake_host(monkeypatch, "x86_64", False)
+    assert accel.select_accel("kvm", "aarch64", 4) == ("kvm", "-accel kvm")
+    fake_host(monkeypatch, "aarch64", True)
+    assert accel.select_accel("tcg", "aarch64", 16) == \
+           ("tcg", "-accel tcg,thread=multi,tb-size=1024")
+
+def test_tb_size_limits():
+    assert accel.get_tb_size(1) == 256
+    assert accel.get_tb_size(8) == 512
+    assert accel.get_tb_size(256) == 2048
@@ -0,0 +1,39 @@
+#
+# Copyright 2020 Linaro
+#
+
+from boot_monitor import BootMonitor
+
+def make_monitor(console_path=None):
+    monitor = BootMonitor(0, str(console_path) if console_path else None)
+    monitor.probes = 0
+    monitor.sshd_up = False
+    def probe_ssh():
+        monitor.probes += 1
+        return monitor.sshd_up
+    monitor.probe_ssh = probe_ssh
+    monitor.start()
+    return monitor
+
+def test_console_triggers_probes(tmp_path):
+    console_path = tmp_path / "console.log"
+    console_path.write_text("Booting Linux on physical CPU 0x0\n")
+    monitor = make_monitor(console_path)
+    assert not monitor.poll()
+    assert 'kernel' in monitor.milestones
+    assert monitor.get_probe_interval() == BootMonitor.fallback_interval
+    with open(str(console_path), 'a') as f:
+        f.write("[  OK  ] Started OpenBSD Secure Shell server.\n")
+    monitor.sshd_up = True
+    monitor._last_probe = 0
+    assert monitor.poll()
+    assert monitor.get_probe_interval() == BootMonitor.probe_interval
+    assert set(monitor.report()['milestones']) == {'kernel', 'sshd', 'ssh'}
+
+def test_without_console():
+    monitor = make_monitor()
+    assert monitor.get_probe_interval() == BootMonitor.probe_interval
+    assert not monitor.poll()
+    # Probes are spaced by the interval.
+    assert not monitor.poll()
+    assert monitor.probes == 1
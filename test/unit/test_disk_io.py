@@ -0,0 +1,56 @@
+#
+# Copyright 2020 Linaro
+#
+
+import pytest
+import disk_io
+
+def test_default_is_untouched():
+    assert disk_io.get_drive_args({}) == ""
+    assert disk_io.get_device_args({'disk_io': "default"}, 4) == ""
+
+def test_benchmark():
+    conf = {'disk_io': "benchmark"}
+    assert disk_io.get_drive_args(conf) == "-set drive.drive0.aio=io_uring "\
+                                           "-set drive.drive0.cache=none "\
+                                           "-set drive.drive0.discard=unmap"
+    assert disk_io.get_device_args(conf, 4) == "-object iothread,id=lisa-iothread0 "\
+           "-global virtio-blk-pci.iothread=lisa-iothread0 "\
+           "-global virtio-blk-pci.num-queues=4"
+
+def test_keys_override_benchmark():
+    conf = {'disk_io': "benchmark", 'drive_aio': "threads", 'drive_cache': "writeback",
+            'drive_iothread': False, 'drive_queues': 2}
+    assert "aio=threads" in disk_io.get_drive_args(conf)
+    assert disk_io.get_device_args(conf, 8) == "-global virtio-blk-pci.num-queues=2"
+
+def test_invalid_settings():
+    for conf in [{'disk_io': "fast"}, {'drive_aio': "posix"},
+                 {'drive_aio': "native", 'drive_cache': "writeback"}]:
+        with pytest.raises(ValueError):
+            disk_io.get_drive_args(conf)
+
+def test_device_args_refuse_other_virtio_drives():
+    conf = {'drive_queues': "auto"}
+    for qemu_args in ["-drive file=data.img,if=virtio",
+                      "-drive file=data.img,if=none,id=data -device virtio-blk-pci,drive=data"]:
+        with pytest.raises(ValueError):
+            disk_io.get_device_args(conf, 4, qemu_args)
+    # Drive options only apply to the image drive, so they are fine.
+    assert disk_io.get_drive_args({'drive_cache': "none"}) == "-set drive.drive0.cache=none"
+    assert disk_io.get_device_args({'drive_cache': "none"}, 4,
+                                   "-drive file=data.img,if=virtio") == ""
+
+def test_io_uring_support(tmp_path):
+    assert disk_io.io_uring_supported(str(tmp_path)) == None
+    (tmp_path / "config-host.mak").write_text("CONFIG_LINUX_AIO=y\n")
+    assert disk_io.io_uring_supported(str(tmp_path)) == False
+    (tmp_path / "config-host.mak").write_text("CONFIG_LINUX_AIO=y\nCONFIG_LINUX_IO_URING=y\n")
+    assert disk_io.io_uring_supported(str(tmp_path)) == True
+
+def test_benchmark_without_io_uring():
+    for io_uring in [False, None]:
+        assert "aio=native" in disk_io.get_drive_args({'disk_io': "benchmark"}, io_uring)
+    assert "aio=io_uring" in disk_io.get_drive_args({'drive_aio': "io_uring"}, None)
+    with pytest.raises(ValueError, match="liburing"):
+        disk_io.get_drive_args({'disk_io': "benchmark", 'drive_aio': "io_uring"}, False)
@@ -0,0 +1,81 @@
+#
+# Copyright 2020 Linaro
+#
+
+import pytest
+from host_topology import GuestNumaLayout, TopologyError, get_smp_cpus, parse_cpulist, parse_size
+
+two_nodes = "-smp 8 "\
+            "-object memory-backend-ram,size=2G,id=ram-node0 "\
+            "-object memory-backend-ram,size=2G,id=ram-node1 "\
+            "-numa node,memdev=ram-node0,cpus=0-3,nodeid=0 "\
+            "-numa node,memdev=ram-node1,cpus=4-7,nodeid=1"
+
+class FakeHost:
+    def __init__(self, node_cpus, mem_free=8 << 30, hugepages={}):
+        self.nodes = {node: {'cpus': cpus, 'mem_free': mem_free, 'hugepages': dict(hugepages)}
+                      for node, cpus in enumerate(node_cpus)}
+
+def test_parse():
+    assert parse_cpulist("0-3,8,10-11\n") == [0, 1, 2, 3, 8, 10, 11]
+    assert parse_size("16G") == 16 << 30
+    assert parse_size("512") == 512 << 20
+    with pytest.raises(TopologyError):
+        parse_size("lots")
+    assert get_smp_cpus("-smp cpus=6,sockets=1") == 6
+    assert get_smp_cpus("-smp 4") == 4
+    assert get_smp_cpus("-m 1G") == 1
+
+def test_layout():
+    layout = GuestNumaLayout(two_nodes, "4G")
+    assert [(n['nodeid'], n['cpus'], n['size']) for n in layout.nodes] == \
+           [(0, [0, 1, 2, 3], 2 << 30), (1, [4, 5, 6, 7], 2 << 30)]
+
+def test_layout_without_numa():
+    layout = GuestNumaLayout("-smp 2", "1G")
+    assert [(n['nodeid'], n['cpus'], n['size']) for n in layout.nodes] == [(0, [0, 1], 1 << 30)]
+    placement = layout.place(FakeHost([[0, 1, 2, 3]]))
+    assert layout.get_qemu_args(placement) == "-smp 2 "\
+           "-object memory-backend-ram,size=1024M,policy=bind,host-nodes=0,id=lisa-ram-node0 "\
+           "-machine memory-backend=lisa-ram-node0"
+
+def test_place_pins_dedicated_cores():
+    layout = GuestNumaLayout(two_nodes, "4G")
+    placement = layout.place(FakeHost([[0, 1, 2, 3, 4], [5, 6, 7, 8]]), pin=True)
+    assert [p['host_node'] for p in placement] == [0, 1]
+    assert placement[0]['vcpus'] == {0: 0, 1: 1, 2: 2, 3: 3}
+    assert placement[1]['vcpus'] == {4: 5, 5: 6, 6: 7, 7: 8}
+
+def test_place_shares_a_host_node():
+    # Both guest nodes land on the single host node, each vCPU on its own core.
+    layout = GuestNumaLayout(two_nodes, "4G")
+    placement = layout.place(FakeHost([list(range(8))]), pin=True)
+    assert [p['host_node'] for p in placement] == [0, 0]
+    cores = [core for p in placement for core in p['vcpus'].values()]
+    assert sorted(cores) == list(range(8))
+
+def test_place_fails_without_enough_cores():
+    layout = GuestNumaLayout(two_nodes, "4G")
+    host = FakeHost([[0, 1, 2, 3], [4, 5, 6]])
+    with pytest.raises(TopologyError, match="host node 1 has 3 free cores"):
+        layout.place(host, pin=True)
+    # Without pinning the cores are not needed.
+    assert layout.place(host)[1]['vcpus'] == {}
+
+def test_place_fails_without_enough_memory():
+    layout = GuestNumaLayout(two_nodes, "4G")
+    with pytest.raises(TopologyError, match="host node 0 has 1024 MB of free ram memory"):
+        layout.place(FakeHost([[0], [1]], mem_free=1 << 30))
+    with pytest.raises(TopologyError, match="hugepages"):
+        layout.place(FakeHost([[0], [1]]), memory_type="hugepages")
+    hugepages = {2 << 20: 1024}
+    assert len(layout.place(FakeHost([[0], [1]], hugepages=hugepages), "hugepages")) == 2
+
+def test_qemu_args_bind_memory():
+    layout = GuestNumaLayout(two_nodes, "4G")
+    placement = layout.place(FakeHost([[0, 1], [2, 3]]))
+    args = layout.get_qemu_args(placement, "memfd")
+    assert "ram-node0" not in args.replace("lisa-ram-node0", "")
+    assert "-numa node,cpus=0-3,nodeid=0,memdev=lisa-ram-node0" in args
+    assert "-object memory-backend-memfd,size=2048M,policy=bind,host-nodes=1,"\
+           "id=lisa-ram-node1" in args
@@ -0,0 +1,100 @@
+#
+# Copyright 2020 Linaro
+#
+
+import os
+import struct
+import time
+from image_cache import ImageCache
+
+slot_bytes = 64 * 1024
+
+def make_cache(tmp_path, max_slots):
+    cache_path = str(tmp_path / "cache")
+    max_size_gb = (max_slots * slot_bytes + slot_bytes // 2) / (1024 * 1024 * 1024)
+    return ImageCache(cache_path, max_size_gb, print_fn=lambda *args: None)
+
+def add_slot(cache, key, last_used=None, committed=True):
+    cache.prepare(key)
+    with open(cache.image_path(key, "image.qcow2"), 'wb') as f:
+        f.write(os.urandom(slot_bytes))
+    if committed:
+        cache.write_metadata(key, {'image_name': "image.qcow2", 'created': last_used,
+                                   'last_used': last_used})
+
+def write_qcow2(path, backing):
+    backing = backing.encode()
+    header = ImageCache.qcow2_magic + struct.pack(">IQI", 3, 64, len(backing))
+    with open(path, 'wb') as f:
+        f.write(header.ljust(64, b"\0") + backing)
+
+def conf(**keys):
+    qemu_conf = {'memory': "4G", 'qemu_args': "-smp 4"}
+    qemu_conf.update(keys)
+    return {'qemu-conf': qemu_conf}
+
+def test_key_ignores_host_settings():
+    key = ImageCache.compute_key(conf(), "ubuntu.aarch64", "rev")
+    assert ImageCache.compute_key(conf(ssh_port=5556), "ubuntu.aarch64", "rev") == key
+    generated = conf(qemu_args="-smp 4 -accel kvm", accel_args="-accel kvm")
+    assert ImageCache.compute_key(generated, "ubuntu.aarch64", "rev") == key
+
+def test_key_follows_image_inputs(tmp_path):
+    key = ImageCache.compute_key(conf(), "ubuntu.aarch64", "rev")
+    assert ImageCache.compute_key(conf(memory="8G"), "ubuntu.aarch64", "rev") != key
+    assert ImageCache.compute_key(conf(), "ubuntu.x86_64", "rev") != key
+    assert ImageCache.compute_key(conf(), "ubuntu.aarch64", "rev2") != key
+    key_path = tmp_path / "id_rsa.pub"
+    key_path.write_text("key1")
+    with_key = ImageCache.compute_key(conf(), "ubuntu.aarch64", "rev", [str(key_path)])
+    key_path.write_text("key2")
+    assert ImageCache.compute_key(conf(), "ubuntu.aarch64", "rev", [str(key_path)]) != with_key
+
+def test_lookup(tmp_path):
+    cache = make_cache(tmp_path, 2)
+    assert cache.lookup("a") == None
+    add_slot(cache, "a", last_used=1)
+    assert cache.lookup("a") == cache.image_path("a", "image.qcow2")
+    assert cache.read_metadata("a")['last_used'] > 1
+    add_slot(cache, "b", committed=False)
+    assert cache.lookup("b") == None
+
+def test_evict_least_recently_used(tmp_path):
+    cache = make_cache(tmp_path, 2)
+    now = time.time()
+    for index, key in enumerate(["old", "mid", "new"]):
+        add_slot(cache, key, last_used=now + index)
+    cache.evict()
+    assert sorted(key for last_used, key, size in cache.slots()) == ["mid", "new"]
+
+def test_evict_keeps_slots_being_built(tmp_path):
+    cache = make_cache(tmp_path, 1)
+    add_slot(cache, "building", committed=False)
+    add_slot(cache, "done", last_used=time.time())
+    cache.evict(keep=["done"])
+    assert sorted(key for last_used, key, size in cache.slots()) == ["building", "done"]
+
+def test_evict_skips_referenced_slots(tmp_path):
+    cache = make_cache(tmp_path, 1)
+    now = time.time()
+    add_slot(cache, "linked", last_used=now)
+    add_slot(cache, "backing", last_used=now + 1)
+    add_slot(cache, "unused", last_used=now + 2)
+    add_slot(cache, "new", last_used=now + 3)
+    image_dir = tmp_path / "VM-ubuntu.aarch64"
+    image_dir.mkdir()
+    os.symlink(cache.image_path("linked", "image.qcow2"), str(image_dir / "ubuntu.aarch64.img"))
+    # An overlay with a backing file relative to it.
+    write_qcow2(str(image_dir / "overlay.qcow2"),
+                os.path.relpath(cache.image_path("backing", "image.qcow2"), str(image_dir)))
+    assert cache.referenced_keys() == {"linked", "backing"}
+    cache.evict(keep=["new"])
+    assert sorted(key for last_used, key, size in cache.slots()) == ["backing", "linked", "new"]
+
+def test_backing_file(tmp_path):
+    path = str(tmp_path / "overlay.qcow2")
+    write_qcow2(path, "/images/base.qcow2")
+    assert ImageCache.backing_file(path) == "/images/base.qcow2"
+    raw_path = tmp_path / "image.raw"
+    raw_path.write_bytes(b"\0" * 512)
+    assert ImageCache.backing_file(str(raw_path)) == None
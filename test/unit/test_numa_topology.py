@@ -0,0 +1,69 @@
+#
+# Copyright 2020 Linaro
+#
+
+import pytest
+from host_topology import GuestNumaLayout, TopologyError
+from numa_topology import NumaTopology, get_max_vcpus, strip_topology_args
+
+def test_max_vcpus():
+    assert get_max_vcpus("virt") == 8
+    assert get_max_vcpus("virt,gic-version=2") == 8
+    assert get_max_vcpus("virt,gic-version=3") == 512
+    assert get_max_vcpus("virt,gic_version=max") == 512
+    assert get_max_vcpus("q35") == 288
+    assert get_max_vcpus("pc-i440fx-5.0") == 255
+    assert get_max_vcpus("") == None
+
+def test_gicv2_limit():
+    spec = {'sockets': 1, 'cores': 16}
+    with pytest.raises(TopologyError, match="gic-version=3"):
+        NumaTopology(spec, "4G", "virt")
+    assert NumaTopology(spec, "4G", "virt,gic-version=3").vcpus == 16
+
+def test_tiers():
+    spec = {'sockets': 2, 'cores': 4, 'nodes': 4, 'tiers': [[2, 16], [4, 32]]}
+    topology = NumaTopology(spec, "4G", "virt,gic-version=3")
+    assert topology.distances == [[10, 16, 32, 32],
+                                  [16, 10, 32, 32],
+                                  [32, 32, 10, 16],
+                                  [32, 32, 16, 10]]
+    assert topology.node_memory_mb == 1024
+    assert list(topology.node_cpus(3)) == [6, 7]
+
+def test_qemu_args():
+    spec = {'sockets': 2, 'cores': 2, 'nodes': 2, 'distances': [[10, 20], [30, 10]]}
+    args = NumaTopology(spec, "2G").get_qemu_args()
+    assert args.startswith("-smp cpus=4,maxcpus=4,sockets=2,cores=2,threads=1 ")
+    assert "-numa node,memdev=ram-node1,cpus=2-3,nodeid=1" in args
+    # Asymmetric distances are given both ways.
+    assert "-numa dist,src=0,dst=1,val=20" in args
+    assert "-numa dist,src=1,dst=0,val=30" in args
+    # The generated args describe the same guest layout.
+    layout = GuestNumaLayout(args, "2G")
+    assert [(n['cpus'], n['size']) for n in layout.nodes] == [([0, 1], 1 << 30),
+                                                              ([2, 3], 1 << 30)]
+    assert strip_topology_args("-m 2G " + args + " -nographic") == "-m 2G -nographic"
+
+def test_single_node():
+    topology = NumaTopology({'cores': 4}, "1G")
+    assert topology.get_qemu_args() == "-smp cpus=4,maxcpus=4,sockets=1,cores=4,threads=1"
+    assert topology.get_platform_info() == {'name': "qemu-4cpu-1node", 'cpus-count': 4,
+                                            'numa-nodes-count': 1}
+
+@pytest.mark.parametrize("spec, memory, error", [
+    ({'cores': 0}, "1G", "positive"),
+    ({'cores': 6, 'nodes': 4}, "4G", "split evenly"),
+    ({'cores': 4, 'nodes': 2}, "1025M", "memory of 1025 MB"),
+    ({'sockets': 3, 'cores': 2, 'nodes': 2}, "2G", "do not align"),
+    ({'cores': 2, 'threads': 2, 'nodes': 4}, "4G", "split cores"),
+    ({'cores': 4, 'nodes': 4, 'tiers': [[2, 20], [4, 20]]}, "4G", "must grow"),
+    ({'cores': 4, 'nodes': 4, 'tiers': [[3, 20], [4, 30]]}, "4G", "tier of 3 nodes"),
+    ({'cores': 4, 'nodes': 4, 'tiers': [[2, 20]]}, "4G", "last tier"),
+    ({'cores': 2, 'nodes': 2, 'distances': [[10, 10], [20, 10]]}, "2G", "distance 10"),
+    ({'cores': 2, 'nodes': 2, 'distances': [[10, 20]]}, "2G", "2x2 matrix"),
+    ({'cores': 2, 'memory_backend': "file"}, "2G", "memory_backend"),
+])
+def test_invalid(spec, memory, error):
+    with pytest.raises(TopologyError, match=error):
+        NumaTopology(spec, memory)
@@ -0,0 +1,104 @@
+#
+# Copyright 2020 Linaro
+#
+
+import os
+import threading
+import pytest
+import yaml
+from step_graph import StepGraph
+
+def make_graph(tmp_path, dry_run=False):
+    return StepGraph(str(tmp_path / "times.yml"), print_fn=lambda *args: None, dry_run=dry_run)
+
+def touch(path, mtime):
+    with open(str(path), 'w'):
+        pass
+    os.utime(str(path), (mtime, mtime))
+
+def test_unknown_dep(tmp_path):
+    graph = make_graph(tmp_path)
+    with pytest.raises(Exception, match="unknown step"):
+        graph.add("image", lambda: None, deps=["keys"])
+
+def test_deps_run_first(tmp_path):
+    graph = make_graph(tmp_path)
+    order = []
+    graph.add("qemu", lambda: order.append("qemu"))
+    graph.add("keys", lambda: order.append("keys"))
+    graph.add("image", lambda: order.append("image"), deps=["qemu", "keys"])
+    graph.add("install", lambda: order.append("install"), deps=["image"])
+    graph.run()
+    assert sorted(order[:2]) == ["keys", "qemu"]
+    assert order[2:] == ["image", "install"]
+    assert sorted(yaml.safe_load((tmp_path / "times.yml").read_text())) == \
+           ["image", "install", "keys", "qemu"]
+
+def test_independent_steps_run_concurrently(tmp_path):
+    graph = make_graph(tmp_path)
+    # Each step waits for the other, so this only finishes if they overlap.
+    barrier = threading.Barrier(2, timeout=5)
+    graph.add("qemu", barrier.wait)
+    graph.add("keys", barrier.wait)
+    graph.run()
+
+def test_up_to_date(tmp_path):
+    graph = make_graph(tmp_path)
+    src, dst = tmp_path / "src", tmp_path / "dst"
+    ran = []
+    graph.add("copy", lambda: ran.append("copy"), inputs=[str(src)], outputs=[str(dst)])
+    touch(src, 100)
+    touch(dst, 200)
+    assert not graph.get_plan()[0]['runs']
+    graph.run()
+    touch(src, 300)
+    assert graph.get_plan()[0]['runs']
+    graph.run()
+    assert ran == ["copy"]
+
+def test_missing_output_runs(tmp_path):
+    graph = make_graph(tmp_path)
+    # Outputs given as a function are resolved when checked.
+    outputs = []
+    graph.add("image", lambda: None, outputs=lambda: outputs)
+    assert graph.get_plan()[0]['runs']
+    outputs.append(str(tmp_path / "missing.img"))
+    assert graph.get_plan()[0]['runs']
+    touch(tmp_path / "missing.img", 100)
+    assert not graph.get_plan()[0]['runs']
+
+def test_check(tmp_path):
+    graph = make_graph(tmp_path)
+    graph.add("qemu", lambda: None, check=lambda: True)
+    graph.add("always", lambda: None)
+    assert [entry['runs'] for entry in graph.get_plan()] == [False, True]
+
+def test_plan_estimates(tmp_path):
+    (tmp_path / "times.yml").write_text(yaml.dump({'qemu': 60.0, 'image': 300.0}))
+    graph = make_graph(tmp_path)
+    graph.add("qemu", lambda: None)
+    graph.add("keys", lambda: None)
+    graph.add("image", lambda: None, deps=["qemu", "keys"])
+    plan = {entry['step']: entry for entry in graph.get_plan()}
+    assert plan['keys']['estimate'] == None
+    assert plan['image']['start'] == 60.0
+    assert plan['image']['estimate'] == 300.0
+
+def test_failure_stops_later_steps(tmp_path):
+    graph = make_graph(tmp_path)
+    ran = []
+    def fail():
+        raise RuntimeError("qemu build failed")
+    graph.add("qemu", fail)
+    graph.add("keys", lambda: ran.append("keys"))
+    graph.add("image", lambda: ran.append("image"), deps=["qemu", "keys"])
+    with pytest.raises(RuntimeError, match="qemu build failed"):
+        graph.run()
+    assert "image" not in ran
+    assert "qemu" not in yaml.safe_load((tmp_path / "times.yml").read_text())
+
+def test_dry_run_keeps_times(tmp_path):
+    graph = make_graph(tmp_path, dry_run=True)
+    graph.add("qemu", lambda: None)
+    graph.run()
+    assert not (tmp_path / "times.yml").exists()
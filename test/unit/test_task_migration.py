@@ -0,0 +1,87 @@
+#
+# Copyright 2020 Linaro
+#
+
+import pytest
+
+pd = pytest.importorskip("pandas")
+
+from task_migration import get_cpu_nodes, get_task_pids, migration_summary, parse_cpulist, \
+                           task_migrations, task_residency
+
+cpu_nodes = {0: 0, 1: 1}
+
+def sched_switch():
+    # a runs on cpu0 then twice on cpu1, b moves from cpu1 to cpu0,
+    # c only runs on cpu1.  pid 0 is the idle task.
+    events = [(0, 10, "a", 0),
+              (1, 11, "b", 1),
+              (2, 0, "swapper/0", 0),
+              (3, 10, "a", 1),
+              (4, 11, "b", 0),
+              (5, 10, "a", 1),
+              (6, 12, "c", 1)]
+    df = pd.DataFrame([event[1:] for event in events],
+                      index=pd.Index([event[0] for event in events], name="Time"),
+                      columns=['next_pid', 'next_comm', '__cpu'])
+    return df
+
+class FakeTarget:
+    number_of_cpus = 4
+
+    def __init__(self, nodes):
+        self.nodes = nodes
+
+    def file_exists(self, path):
+        return bool(self.nodes)
+
+    def list_directory(self, path):
+        return list(self.nodes) + ["possible", "has_cpu"]
+
+    def read_value(self, path):
+        return self.nodes[path.split("/")[-2]]
+
+def test_cpu_nodes():
+    assert parse_cpulist("0-1,4") == [0, 1, 4]
+    target = FakeTarget({'node0': "0-1", 'node1': "2-3"})
+    assert get_cpu_nodes(target) == {0: 0, 1: 0, 2: 1, 3: 1}
+    assert get_cpu_nodes(FakeTarget({})) == {0: 0, 1: 0, 2: 0, 3: 0}
+
+def test_task_pids():
+    assert get_task_pids(sched_switch(), ["b", "a", "missing"]) == [11, 10]
+
+def test_migrations():
+    migrations = task_migrations(sched_switch(), cpu_nodes)
+    assert list(migrations.index) == [3, 4]
+    assert migrations['pid'].tolist() == [10, 11]
+    assert migrations['src_cpu'].tolist() == [0, 1]
+    assert migrations['dst_cpu'].tolist() == [1, 0]
+    assert migrations['last_src_time'].tolist() == [0, 1]
+    assert migrations['node_crossing'].tolist() == [True, True]
+    # The idle task is switched in on both CPUs without migrating.
+    assert 0 not in migrations['pid'].tolist()
+
+def test_migrations_within_a_node():
+    migrations = task_migrations(sched_switch(), {0: 0, 1: 0})
+    assert migrations['node_crossing'].tolist() == [False, False]
+    assert 'node_crossing' not in task_migrations(sched_switch())
+
+def test_residency():
+    residency = task_residency(sched_switch(), cpu_nodes, end=8)
+    assert sorted(residency.index) == [10, 11, 12]
+    assert residency.loc[10, ['cpu0', 'cpu1']].tolist() == [2, 3]
+    assert residency.loc[11, ['cpu0', 'cpu1']].tolist() == [4, 2]
+    assert residency.loc[12, ['cpu0', 'cpu1']].tolist() == [0, 2]
+    assert residency.loc[11, ['node0', 'node1']].tolist() == [4, 2]
+    # By default the last task of each CPU runs until the last event.
+    assert task_residency(sched_switch()).loc[12, 'cpu1'] == 0
+
+def test_summary():
+    df = sched_switch()
+    summary = migration_summary(task_migrations(df, cpu_nodes),
+                                task_residency(df, cpu_nodes, end=8))
+    assert summary.loc[10, 'migrations'] == 1
+    assert summary.loc[11, 'node_crossings'] == 1
+    # Tasks which never migrated are kept, with no migrations.
+    assert summary.loc[12, 'migrations'] == 0
+    assert summary.loc[12, 'node_crossings'] == 0